@@ -1,66 +1,142 @@
+import time
+APP_IMPORT_STARTED = time.perf_counter()
 import os
 import base64
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
 from flask import Flask, request, jsonify
 from google.cloud import firestore
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
-from google.cloud import secretmanager
 import json
 import sys
-from cloud_logging_helper import setup_logging
-from crews.ai_research_crew.research_crew import AIResearchCrew
-from google.cloud import datastore
+from cloud_logging_helper import logging_stats, setup_logging
+from crews.ai_research_crew.research_cache import research_cache
+from email_compaction import compact_email
+from email_dedup import EmailDeduplicator
+from email_sender import EmailSender, build_reply
+from job_queue import PRIORITY_HIGH, PRIORITY_NORMAL, FairReadyQueue, JobWorkerPool, get_job_queue
+from result_sink import get_result_sink
+from secret_store import get_secret, prefetch_secrets
+from tracing_helper import extract_context, inject_context, setup_tracing, stage_latency
+from triage import Triage
 
 
 app = Flask(__name__)
 
 # Set up logging
 logger = setup_logging()
-
-# Initialize Firestore client
-db = firestore.Client()
+tracer = setup_tracing('ai-agent-processor')
 
 PROJECT_ID = os.environ.get('PROJECT_ID')
 SECRET_ID = os.environ.get('SECRET_ID')
+WARMUP_ON_START = os.environ.get('WARMUP_ON_START', 'false').lower() == 'true'
+LLM_SECRET_IDS = ['OPENAI_API_KEY', 'ANTHROPIC_API_KEY', 'SERPER_API_KEY']
+# Backpressure: past these queue depths new emails are nacked and Pub/Sub redelivers later
+MAX_QUEUED_JOBS = int(os.environ.get('SCHEDULER_MAX_QUEUED', '200'))
+MAX_QUEUED_JOBS_PER_USER = int(os.environ.get('SCHEDULER_MAX_QUEUED_PER_USER', '20'))
+SHORT_EMAIL_CHARS = int(os.environ.get('SCHEDULER_SHORT_EMAIL_CHARS', '2000'))
+
+# Seconds spent importing the app and initialising each lazily built component
+startup_timings = {}
+
+@contextmanager
+def timed_init(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = round(time.perf_counter() - started, 3)
+        logger.info(f"Initialised {name} in {startup_timings[name]}s")
 
-def access_secret_version(secret_id, version_id="latest"):
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/{PROJECT_ID}/secrets/{secret_id}/versions/{version_id}"
-    response = client.access_secret_version(request={"name": name})
-    return response.payload.data.decode('UTF-8')
+# Heavy clients and the crew are built on first use so /health is served right away
+@lru_cache(maxsize=1)
+def get_db():
+    with timed_init('firestore_client'):
+        return firestore.Client()
 
-OPENAI_API_KEY = access_secret_version('OPENAI_API_KEY')
-ANTHROPIC_API_KEY = access_secret_version('ANTHROPIC_API_KEY')
+@lru_cache(maxsize=1)
+def get_crew_class():
+    with timed_init('crew_import'):
+        from crews.ai_research_crew.research_crew import AIResearchCrew
+    return AIResearchCrew
+
+def warm_up():
+    with timed_init('warm_up'):
+        with timed_init('secrets'):
+            prefetch_secrets(LLM_SECRET_IDS + [SECRET_ID])
+        get_db()
+        get_crew_class()
+        from crews.ai_research_crew.crew_factory import crew_factory
+        from crews.ai_research_crew.model_router import STAGE_ROUTES, stage_llm
+        with timed_init('crew_templates'):
+            crew_factory.warm_up()
+            for stage in STAGE_ROUTES:
+                crew_factory.llm(stage_llm(stage))
 
 
 def get_gmail_service(user_email):
-    service_account_info = json.loads(access_secret_version(SECRET_ID))
+    service_account_info = json.loads(get_secret(SECRET_ID))
     credentials = service_account.Credentials.from_service_account_info(
         service_account_info,
         scopes=['https://www.googleapis.com/auth/gmail.send']
     )
     delegated_credentials = credentials.with_subject(user_email)
-    return build('gmail', 'v1', credentials=delegated_credentials)
-
-# Add this function to check if an email has been processed
-def is_email_processed(email_id):
-    datastore_client = datastore.Client()
-    key = datastore_client.key('ProcessedEmail', email_id)
-    return datastore_client.get(key) is not None
-
-# Add this function to mark an email as processed
-def mark_email_processed(email_id):
-    datastore_client = datastore.Client()
-    key = datastore_client.key('ProcessedEmail', email_id)
-    entity = datastore.Entity(key=key)
-    entity['processed'] = True
-    datastore_client.put(entity)
+    return build('gmail', 'v1', credentials=delegated_credentials, cache_discovery=False)
+
+dedup = EmailDeduplicator()
+email_sender = EmailSender(get_gmail_service)
+triage = Triage()
+
+REQUIRED_FIELDS = ['subject', 'body', 'from', 'user_email', 'id']
+
+def job_priority(email_data):
+    # Follow-ups in an ongoing thread and short questions go ahead of long research asks
+    if email_data.get('references') or len(email_data['body']) <= SHORT_EMAIL_CHARS:
+        return PRIORITY_HIGH
+    return PRIORITY_NORMAL
+
+def is_saturated(user_email):
+    return job_queue.depth() >= MAX_QUEUED_JOBS or job_queue.depth(user_email) >= MAX_QUEUED_JOBS_PER_USER
 
 @app.route('/health', methods=['GET'])
 def health_check():
     logger.info("Health check called")
     return jsonify({"status": "healthy"}), 200
 
+@app.route('/warmup', methods=['GET'])
+def warmup():
+    warm_up()
+    return jsonify({"status": "warm", "startup": startup_timings}), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    stats = {
+        "dedup": dedup.stats(),
+        "jobs": worker_pool.stats(),
+        "research_cache": research_cache.stats(),
+        "triage": triage.stats(),
+        "result_sink": result_sink.stats(),
+        "sender": email_sender.stats(),
+        "startup": startup_timings,
+        "stage_latency": stage_latency.snapshot(),
+        "logging": logging_stats(),
+    }
+    agents_module = sys.modules.get('crews.ai_research_crew.ai_research_agents')
+    if agents_module:
+        stats["llm_concurrency"] = agents_module.llm_limiter.stats()
+    research_tools = sys.modules.get('crews.ai_research_crew.research_tools')
+    if research_tools:
+        stats["search"] = research_tools.cached_search.stats()
+    model_router = sys.modules.get('crews.ai_research_crew.model_router')
+    if model_router:
+        stats["model_routing"] = model_router.route_stats.stats()
+    crew_factory_module = sys.modules.get('crews.ai_research_crew.crew_factory')
+    if crew_factory_module:
+        stats["crew_factory"] = crew_factory_module.crew_factory.stats()
+    return jsonify(stats), 200
+
 @app.route('/', methods=['POST'])
 def process_email():
     print("Function started", file=sys.stderr)
@@ -81,21 +157,50 @@ def process_email():
 
         if isinstance(pubsub_message, dict) and "data" in pubsub_message:
             data = base64.b64decode(pubsub_message["data"]).decode("utf-8").strip()
-            logger.info(f"Received message: {data}")
+            logger.debug("Received message: %s", data)
             
             # Parse the email data
             email_data = json.loads(data)
+            missing = [field for field in REQUIRED_FIELDS if field not in email_data]
+            if missing:
+                msg = f"missing required fields: {missing}"
+                logger.error(f"error: {msg}")
+                return f"Bad Request: {msg}", 400
             
-            # Check if the email has already been processed
-            if is_email_processed(email_data['id']):
-                logger.info(f"Email {email_data['id']} has already been processed. Skipping.")
-                return ("", 204)
-            
-            # Process the email data
-            process_email_data(email_data)
-            
-            # Mark the email as processed
-            mark_email_processed(email_data['id'])
+            # Continue the trace the watcher started when it published this email
+            parent = extract_context(pubsub_message.get("attributes"))
+            with tracer.start_as_current_span('agent.receive', context=parent, attributes={'email.id': email_data['id']}):
+                # Newsletters, receipts and auto-replies never need the crew
+                with tracer.start_as_current_span('triage'):
+                    run_crew = triage.should_run_crew(email_data)
+                if not run_crew:
+                    return ("", 204)
+                
+                # Nack while this user's (or everyone's) backlog is full, Pub/Sub retries with backoff
+                if is_saturated(email_data['user_email']):
+                    logger.warning(f"Queue saturated, deferring email {email_data['id']} for {email_data['user_email']}")
+                    return ("Too Many Requests", 429, {"Retry-After": "60"})
+                
+                # Atomically claim the email so redeliveries never run the crew twice
+                with tracer.start_as_current_span('dedup.claim'):
+                    claimed = dedup.claim(email_data['id'])
+                if not claimed:
+                    logger.info(f"Email {email_data['id']} has already been processed. Skipping.")
+                    return ("", 204)
+                
+                # The crew takes minutes, far longer than the push ack deadline, so it runs on
+                # the worker pool and the message is acked right away
+                try:
+                    queued = job_queue.enqueue(email_data['id'], email_data, trace_context=inject_context(),
+                                               user=email_data['user_email'], priority=job_priority(email_data))
+                except Exception as e:
+                    dedup.release(email_data['id'], e)
+                    raise
+                if not queued:
+                    # The claim lapsed while a job for this email was queued, running or done
+                    logger.info(f"Email {email_data['id']} already has a job, not running the crew again")
+                    return ("", 204)
+                logger.info(f"Email {email_data['id']} queued for processing")
             
             return ("", 204)
         else:
@@ -112,26 +217,32 @@ def process_email_data(email_data):
         logger.info(f"Processing email for user: {email_data['user_email']}")
         
         # Ensure all required fields are present
-        required_fields = ['subject', 'body', 'from', 'user_email', 'id']
-        for field in required_fields:
+        for field in REQUIRED_FIELDS:
             if field not in email_data:
                 raise ValueError(f"Missing required field: {field}")
 
+        # Quoted history, signatures and footers only cost prompt tokens
+        with tracer.start_as_current_span('email.compaction'):
+            compacted = compact_email(email_data['body'])
+        logger.info(f"Compacted email {email_data['id']} body from {compacted.tokens_before} to "
+                    f"{compacted.tokens_after} tokens ({compacted.reduction:.0%} saved)")
+
         # Create the AIResearchCrew instance with the email details
-        crew = AIResearchCrew(
+        crew = get_crew_class()(
             email_subject=email_data['subject'],
-            email_body=email_data['body'],
+            email_body=compacted.text,
             email_from=email_data['from']
         )
-        result = crew.run()
-        logger.info(f"Result: {result}")
+        with tracer.start_as_current_span('crew.run'):
+            result = crew.run()
+        logger.debug("Result: %s", result)
         result_content = result.tasks_output[2].research_report # Index 2 is the rewrite_the_report task
 
         # Send the response email
-        send_email(email_data['user_email'], email_data['from'], email_data['subject'], result_content)
+        send_email(email_data, result_content)
 
-        # Update Firestore with the result
-        db.collection('processed_emails').add({
+        # Record the result in Firestore, written behind in batches
+        result_sink.submit(email_data['id'], {
             'user_email': email_data['user_email'],
             'email_id': email_data['id'],
             'subject': email_data['subject'],
@@ -144,25 +255,45 @@ def process_email_data(email_data):
         logger.error(f"Error processing email: {e}")
         raise
 
-def send_email(user_email, to_email, subject, content):
-    try:
-        service = get_gmail_service(user_email)
-        message = create_message(user_email, to_email, subject, content)
-        sent_message = service.users().messages().send(userId='me', body=message).execute()
-        logger.info(f"Response email sent. Message Id: {sent_message['id']}")
-    except Exception as e:
-        logger.error(f"An error occurred while sending email: {e}")
-
-def create_message(sender, to, subject, message_text):
-    message = {
-        'raw': base64.urlsafe_b64encode(
-            f"From: {sender}\n"
-            f"To: {to}\n"
-            f"Subject: Re: {subject}\n\n"
-            f"{message_text}".encode('utf-8')
-        ).decode('utf-8')
-    }
-    return message
+def send_email(email_data, content):
+    # Reply in the original thread, failures propagate so the job is retried
+    message = build_reply(
+        email_data['user_email'], email_data['from'], email_data['subject'], content,
+        in_reply_to=email_data.get('message_id'), references=email_data.get('references'),
+    )
+    email_sender.send(email_data['user_email'], message, thread_id=email_data.get('thread_id'))
+
+def run_job(job):
+    email_data = job['payload']
+    parent = extract_context(job.get('trace_context'))
+    with tracer.start_as_current_span('agent.process_email', context=parent, attributes={'email.id': email_data['id'], 'job.attempt': job['attempts']}):
+        process_email_data(email_data)
+
+def complete_job(job):
+    # Mark the email as processed, outside the handler so a failure here never resends the reply
+    dedup.complete(job['id'])
+
+def renew_claim(job):
+    # The claim's lease would otherwise run out during a long queue wait or crew run, and a
+    # redelivery after that would claim the email again
+    if not dedup.renew(job['id']):
+        logger.warning(f"Claim for email {job['id']} is no longer held by this job")
+
+def dead_letter_job(job, error):
+    dedup.release(job['id'], error)
+
+result_sink = get_result_sink(get_db)
+result_sink.start()
+
+job_queue = get_job_queue(ready=FairReadyQueue())
+worker_pool = JobWorkerPool(job_queue, run_job, on_complete=complete_job, on_dead_letter=dead_letter_job,
+                            on_heartbeat=renew_claim)
+worker_pool.start()
+
+if WARMUP_ON_START:
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+startup_timings['app_import'] = round(time.perf_counter() - APP_IMPORT_STARTED, 3)
 
 if __name__ == '__main__':
     logger.info("Application starting...")
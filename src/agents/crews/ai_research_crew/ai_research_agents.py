@@ -1,10 +1,47 @@
-from crewai import Agent
+import os
+from functools import partial
+from typing import ClassVar
 from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
-from crews.ai_research_crew.research_tools import serper_tool
+from crews.ai_research_crew.llm_tracing import tracing_handler
+from crews.ai_research_crew.research_tools import serper_tool, multi_search_tool
+from rate_limit import ConcurrencyLimiter
+from secret_store import get_secret
 
-# Define your agents with roles and goals
-administrative_assistant = Agent(
+
+# Concurrent requests each provider gets from this instance, across all crews. Calls over
+# the limit wait here instead of turning into provider 429s and retry storms.
+llm_limiter = ConcurrencyLimiter({
+    'openai': int(os.environ.get('OPENAI_MAX_CONCURRENCY', '8')),
+    'anthropic': int(os.environ.get('ANTHROPIC_MAX_CONCURRENCY', '4')),
+})
+
+class ConcurrencyLimited:
+    provider: ClassVar[str]
+
+    def _generate(self, *args, **kwargs):
+        with llm_limiter.slot(self.provider):
+            return super()._generate(*args, **kwargs)
+
+    def _stream(self, *args, **kwargs):
+        with llm_limiter.slot(self.provider):
+            yield from super()._stream(*args, **kwargs)
+
+class LimitedChatOpenAI(ConcurrencyLimited, ChatOpenAI):
+    provider: ClassVar[str] = 'openai'
+
+class LimitedChatAnthropic(ConcurrencyLimited, ChatAnthropic):
+    provider: ClassVar[str] = 'anthropic'
+
+def openai_llm(**kwargs):
+    return LimitedChatOpenAI(api_key=get_secret('OPENAI_API_KEY'), callbacks=[tracing_handler], **kwargs)
+
+def anthropic_llm(**kwargs):
+    return LimitedChatAnthropic(api_key=get_secret('ANTHROPIC_API_KEY'), callbacks=[tracing_handler], **kwargs)
+
+# Define your agents with roles and goals. The configs are plain data, the crew factory
+# builds the LLM clients once and fresh agents for every request.
+administrative_assistant_config = dict(
     role='A polite and helpful administrative assistant',
     goal="""You will receive a user email {email_from} in the form of a subject {email_subject} and body {email_body}. 
     The email is a request for research on a topic or topics related to the email.
@@ -15,7 +52,7 @@ administrative_assistant = Agent(
     You will also add a signature to the email. The output will be the subject and body of the email.
     """,
     backstory='You are a polite and helpful administrattive assistant with years of experience in research and writing.',
-    llm=ChatOpenAI(
+    llm=partial(anthropic_llm,
         temperature=0.5,
         model="claude-3-5-sonnet-20240620"
     ),
@@ -23,7 +60,7 @@ administrative_assistant = Agent(
 )
 
 
-researcher = Agent(
+researcher_config = dict(
     role='AI Research Specialist',
     goal='Leverage advanced search techniques to surface the most relevant, credible, and impactful information on AI and Large Language Models',
     backstory="""As a top AI Research Specialist at a renowned technology
@@ -44,17 +81,17 @@ researcher = Agent(
     the go-to expert for keeping your organization at the forefront of the AI revolution.""",
     verbose=True,
     allow_delegation=False,
-    llm=ChatOpenAI(
+    llm=partial(openai_llm,
         temperature=0,
         model="gpt-4o"
     ),
     max_iter=5,
     memory=True,
-    tools=[serper_tool]
+    tools=[serper_tool, multi_search_tool]
 )
 
 
-writer = Agent(
+writer_config = dict(
     role='Tech Content Writer and rewriter',
     goal='Generate compelling content via first drafts and subsequent polishing to get a final product. ',
     backstory="""As a renowned Tech Content Strategist, you have a gift for transforming complex technical
@@ -83,7 +120,7 @@ writer = Agent(
     You have a meticulous eye for detail and a commitment to delivering content that not only informs
     but also engages and inspires. With your expertise, even the most technical and dry subject matter
     can be transformed into a riveting read.""",
-    llm=ChatAnthropic(
+    llm=partial(anthropic_llm,
         temperature=0.5,
         model="claude-3-5-sonnet-20240620"
     ),
@@ -94,3 +131,4 @@ writer = Agent(
     allow_delegation=True,
     # tools=[search_tool], # Passing human tools to the agent,
 )
+
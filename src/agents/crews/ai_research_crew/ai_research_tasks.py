@@ -1,5 +1,5 @@
-from crewai import Task
-from crews.ai_research_crew.ai_research_agents import administrative_assistant, researcher, writer
+from typing import List
+
 from pydantic import BaseModel
 
 
@@ -10,23 +10,40 @@ class ResearchReport(BaseModel):
   email_body: str
 
 
-# Create tasks for your agents
-parse_research_request = Task(
+class ResearchTopics(BaseModel):
+  topics: List[str]
+
+
+# Task templates for your agents. Agents and context tasks are referenced by name, the
+# crewai Task objects are built per run by the crew.
+parse_research_request = dict(
   description="""Parse the email subject {email_subject} and body {email_body} to determine the topic or topics for the research""",
-  expected_output="""Clearly state the topic or topics that the email is referring to as {list_of_topics}""",
-  agent=administrative_assistant,
+  expected_output="""The topic or topics that the email is referring to, one short noun phrase per topic and nothing else""",
+  agent='administrative_assistant',
+  output_json=ResearchTopics,
 )
 
-conduct_research = Task(
+conduct_research = dict(
   description="""
     You will receive a topic or list of topics as {list_of_topics} to research. You will research each topic and provide a detailed report of the information you find.
   """,
   expected_output='A comprehensive report on the topic or topics researched as {research_report}',
-  agent=researcher,
-  context=[parse_research_request]
+  agent='researcher',
+  context=['parse_research_request']
+)
+
+# Parallel research mode runs one of these per topic
+research_topic = dict(
+  description="""
+    Research the topic {topic}. It is one of several topics from the request {list_of_topics}, the others are researched separately, so stay on this one.
+    You have a budget of {search_budget} searches, plan your queries to make the most of them.
+  """,
+  expected_output='A detailed report on {topic} with the sources used',
+  agent='researcher',
+  context=['parse_research_request']
 )
 
-rewrite_the_report = Task(
+rewrite_the_report = dict(
   description="""Using the research reports from the researcher's report,
   develop a nicely formated research report. Your final answer MUST be a full report and should also contain
   a set of bullet points with the key facts at the beginning for a summary. 
@@ -38,14 +55,14 @@ rewrite_the_report = Task(
   </RESEARCH_REPORT>
   """,
   expected_output="""A well-formated research report in an easy readable manner.""",
-  agent=writer,
-  context=[conduct_research]
+  agent='writer',
+  context=['conduct_research']
 )
 
-rewrite_report_to_email = Task(
+rewrite_report_to_email = dict(
   description="""Take the research report and rewrite it to be an email response to the original email request from {email_from}, with the subject {email_subject} and body {email_body}""",
   expected_output="""A well-formated email response to the original email request.""",
-  agent=administrative_assistant,
-  context=[rewrite_the_report, parse_research_request],
+  agent='administrative_assistant',
+  context=['rewrite_the_report', 'parse_research_request'],
   output_json=ResearchReport,
 )
\ No newline at end of file
@@ -0,0 +1,180 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from types import SimpleNamespace
+from crewai import LLM, Agent, Task
+from crewai.memory.unified_memory import Memory
+from crews.ai_research_crew import ai_research_agents, ai_research_tasks
+from email_compaction import count_tokens, truncate_tokens
+from secret_store import get_secret
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on each text input a single request can put into its crew's prompts, in
+# tokens as counted by tiktoken (or estimated from characters without it)
+max_input_tokens = int(os.environ.get('CREW_MAX_INPUT_TOKENS', '12000'))
+# Crews remember within a run, e.g. the rewrite stage can recall what the research stage
+# stored, but each run gets its own memory scope that is dropped when the run ends
+crew_memory = os.environ.get('CREW_MEMORY', 'true').lower() == 'true'
+memory_model = os.environ.get('CREW_MEMORY_MODEL', 'gpt-4o-mini')
+
+AGENT_CONFIGS = {
+    'administrative_assistant': ai_research_agents.administrative_assistant_config,
+    'researcher': ai_research_agents.researcher_config,
+    'writer': ai_research_agents.writer_config,
+}
+TASK_TEMPLATES = {
+    'parse_research_request': ai_research_tasks.parse_research_request,
+    'conduct_research': ai_research_tasks.conduct_research,
+    'research_topic': ai_research_tasks.research_topic,
+    'rewrite_the_report': ai_research_tasks.rewrite_the_report,
+    'rewrite_report_to_email': ai_research_tasks.rewrite_report_to_email,
+}
+
+
+def llm_key(llm_factory):
+    return (llm_factory.func.__name__, tuple(sorted(llm_factory.keywords.items())))
+
+class CrewFactory:
+    # Compiles the agent templates once and hands out fresh agents per request. Memory
+    # is scoped to a single run, so concurrent requests never share conversation state;
+    # only the LLM clients (and their HTTP connection pools) and the memory store are shared.
+
+    def __init__(self, agent_configs=AGENT_CONFIGS, task_templates=TASK_TEMPLATES):
+        self.agent_configs = agent_configs
+        self.task_templates = task_templates
+        self._llms = {}
+        self._agent_templates = None
+        self._memory = None
+        self._lock = threading.Lock()
+        self.instances_built = 0
+        self.build_seconds_total = 0.0
+
+    def llm(self, llm_factory):
+        key = llm_key(llm_factory)
+        if key not in self._llms:
+            with self._lock:
+                if key not in self._llms:
+                    self._llms[key] = llm_factory()
+        return self._llms[key]
+
+    def agent_templates(self):
+        # Without the LLM, whose client is only built when an agent is built without one,
+        # and without memory, which the crew's run scope provides
+        if self._agent_templates is None:
+            templates = {}
+            for name, config in self.agent_configs.items():
+                template = {key: value for key, value in config.items() if key not in ('llm', 'memory')}
+                if 'respect_context_window' in getattr(Agent, 'model_fields', {}):
+                    template['respect_context_window'] = True
+                templates[name] = template
+            self._agent_templates = templates
+        return self._agent_templates
+
+    def build_agents(self):
+        return SimpleNamespace(**{name: self.build_agent(name) for name in self.agent_configs})
+
+    def build_agent(self, name, **overrides):
+        # A single fresh agent, e.g. one on a routed LLM or with its own budgeted tools
+        if 'llm' not in overrides:
+            overrides['llm'] = self.llm(self.agent_configs[name]['llm'])
+        started = time.perf_counter()
+        agent = Agent(**{**self.agent_templates()[name], **overrides})
+        with self._lock:
+            self.instances_built += 1
+            self.build_seconds_total += time.perf_counter() - started
+        return agent
+
+    def build_task(self, name, agents, extra_description=''):
+        template = self.task_templates[name]
+        return Task(
+            description=template['description'] + extra_description,
+            expected_output=template['expected_output'],
+            agent=getattr(agents, template['agent']),
+            output_json=template.get('output_json'),
+        )
+
+    def memory_store(self):
+        # One store, with its analysis LLM and embedder clients, behind every run's scope
+        if self._memory is None:
+            with self._lock:
+                if self._memory is None:
+                    api_key = get_secret('OPENAI_API_KEY')
+                    self._memory = Memory(
+                        llm=LLM(model=memory_model, api_key=api_key),
+                        embedder={'provider': 'openai', 'config': {'api_key': api_key}},
+                    )
+        return self._memory
+
+    @contextmanager
+    def run_memory(self):
+        # A fresh scope for one crew run. Its memories are deleted when the run ends, so
+        # runs never recall each other's emails and the store does not grow per request.
+        if not crew_memory:
+            yield None
+            return
+        scope = self.memory_store().scope(f'/run/{uuid.uuid4().hex}')
+        try:
+            yield scope
+        finally:
+            try:
+                scope.reset()
+            except Exception as e:
+                logger.warning(f"Could not drop the memory scope {scope.root_path}: {str(e)}")
+
+    def cap_inputs(self, inputs):
+        capped = {}
+        for key, value in inputs.items():
+            if isinstance(value, str):
+                tokens = count_tokens(value)
+                if tokens > max_input_tokens:
+                    logger.info(f"Truncating crew input {key} from {tokens} to {max_input_tokens} tokens")
+                    value = truncate_tokens(value, max_input_tokens)
+            capped[key] = value
+        return capped
+
+    def warm_up(self):
+        self.agent_templates()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'shared_llms': len(self._llms),
+                'instances_built': self.instances_built,
+                'build_ms_avg': round(1000 * self.build_seconds_total / self.instances_built, 3) if self.instances_built else 0.0,
+            }
+
+crew_factory = CrewFactory()
+
+
+# Agent construction cost and peak RSS under parallel requests:
+# python -m crews.ai_research_crew.crew_factory
+# Every request builds its own agents, first on the factory's shared LLM client and then,
+# as before the factory, on new clients per request. Peak RSS should stay flat across
+# rounds with the shared client.
+if __name__ == '__main__':
+    import resource
+    from concurrent.futures import ThreadPoolExecutor
+    from functools import partial
+
+    def new_client():
+        return LLM(model='gpt-4o', api_key='benchmark')
+
+    def build_request(shared):
+        started = time.perf_counter()
+        llm = crew_factory.llm(partial(LLM, model='gpt-4o', api_key='benchmark')) if shared else new_client()
+        for name in crew_factory.agent_configs:
+            crew_factory.build_agent(name, llm=llm)
+        return time.perf_counter() - started
+
+    crew_factory.warm_up()
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for label, shared in (('shared client', True), ('client per request', False)):
+            for round_number in range(1, 6):
+                seconds = list(executor.map(lambda _: build_request(shared), range(200)))
+                peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+                print(f"{label:>18}, round {round_number}: {1000 * sum(seconds) / len(seconds):6.2f}ms per request, peak RSS {peak_mb:.0f} MB")
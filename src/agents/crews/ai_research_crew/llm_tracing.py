@@ -0,0 +1,66 @@
+import threading
+from langchain_core.callbacks import BaseCallbackHandler
+from opentelemetry import trace
+from opentelemetry.trace import Status, StatusCode
+
+
+tracer = trace.get_tracer(__name__)
+
+
+def token_usage(llm_output):
+    # (prompt, completion) tokens from a langchain llm_output, OpenAI and Anthropic name them differently
+    usage = (llm_output or {}).get('token_usage') or (llm_output or {}).get('usage') or {}
+    if not isinstance(usage, dict):
+        usage = getattr(usage, '__dict__', {})
+    return usage.get('prompt_tokens', usage.get('input_tokens')), usage.get('completion_tokens', usage.get('output_tokens'))
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    # Opens a span per LLM call, tool calls are traced in research_tools. Spans are keyed
+    # on the langchain run id since start and end arrive as separate callbacks.
+
+    def __init__(self):
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id, name, attributes):
+        span = tracer.start_span(name, attributes={key: value for key, value in attributes.items() if value is not None})
+        with self._lock:
+            self._spans[run_id] = span
+
+    def _end(self, run_id, attributes=None, error=None):
+        with self._lock:
+            span = self._spans.pop(run_id, None)
+        if span is None:
+            return
+        for key, value in (attributes or {}).items():
+            if value is not None:
+                span.set_attribute(key, value)
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(Status(StatusCode.ERROR, str(error)))
+        span.end()
+
+    def _start_llm(self, serialized, run_id, kwargs):
+        params = kwargs.get('invocation_params') or {}
+        self._start(run_id, 'llm.call', {
+            'llm.provider': (serialized or {}).get('id', [None])[-1],
+            'llm.model': params.get('model') or params.get('model_name'),
+        })
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start_llm(serialized, run_id, kwargs)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start_llm(serialized, run_id, kwargs)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        prompt_tokens, completion_tokens = token_usage(response.llm_output)
+        self._end(run_id, {
+            'llm.prompt_tokens': prompt_tokens,
+            'llm.completion_tokens': completion_tokens,
+        })
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=error)
+
+tracing_handler = TracingCallbackHandler()
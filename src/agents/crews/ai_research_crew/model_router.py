@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import threading
+import time
+from functools import partial
+from typing import Any, List
+
+import anthropic
+import openai
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatResult
+
+from crews.ai_research_crew.ai_research_agents import anthropic_llm, openai_llm
+from crews.ai_research_crew.llm_tracing import token_usage, tracing_handler
+from tracing_helper import LatencyHistogram
+
+
+logger = logging.getLogger(__name__)
+
+# Models per tier in fallback order, as provider:model. MODEL_TIERS overrides whole tiers.
+MODEL_TIERS = {
+    'fast': ['anthropic:claude-3-haiku-20240307', 'openai:gpt-4o-mini'],
+    'standard': ['openai:gpt-4o', 'anthropic:claude-3-5-sonnet-20240620'],
+    'strong': ['anthropic:claude-3-5-sonnet-20240620', 'openai:gpt-4o'],
+}
+MODEL_TIERS.update(json.loads(os.environ.get('MODEL_TIERS', '{}')))
+
+# Tier and temperature per crew stage, 'planning' is the crew's planning pass.
+# MODEL_ROUTES overrides single stages, e.g. {"rewrite_report_to_email": {"tier": "standard"}}
+STAGE_ROUTES = {
+    'parse_research_request': {'tier': 'fast', 'temperature': 0},
+    'planning': {'tier': 'fast', 'temperature': 0.5},
+    'conduct_research': {'tier': 'standard', 'temperature': 0},
+    'research_topic': {'tier': 'standard', 'temperature': 0},
+    'rewrite_report_to_email': {'tier': 'fast', 'temperature': 0.5},
+}
+for _stage, _route in json.loads(os.environ.get('MODEL_ROUTES', '{}')).items():
+    STAGE_ROUTES[_stage] = {**STAGE_ROUTES.get(_stage, {'temperature': 0}), **_route}
+
+# A call that has not answered by then moves on to the next model in the tier
+llm_timeout = float(os.environ.get('LLM_TIMEOUT_SECONDS', '60'))
+llm_max_retries = int(os.environ.get('LLM_MAX_RETRIES', '1'))
+# 'auto' only plans requests with several topics or a long body, 'always' and 'never' force it
+planning_mode = os.environ.get('CREW_PLANNING', 'auto')
+planning_min_topics = int(os.environ.get('PLANNING_MIN_TOPICS', '2'))
+planning_min_body_chars = int(os.environ.get('PLANNING_MIN_BODY_CHARS', '1500'))
+
+PROVIDERS = {'openai': openai_llm, 'anthropic': anthropic_llm}
+FALLBACK_ERRORS = (
+    TimeoutError,
+    openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError,
+    anthropic.APIConnectionError, anthropic.RateLimitError, anthropic.InternalServerError,
+)
+
+
+def stage_models(stage):
+    return [model.split(':', 1) for model in MODEL_TIERS[STAGE_ROUTES[stage]['tier']]]
+
+def route_fingerprint(stage):
+    route = STAGE_ROUTES[stage]
+    return f"{route['tier']}:{route['temperature']}:{','.join(MODEL_TIERS[route['tier']])}"
+
+def needs_planning(topics, email_body):
+    if planning_mode in ('always', 'never'):
+        return planning_mode == 'always'
+    return len(topics) >= planning_min_topics or len(email_body or '') >= planning_min_body_chars
+
+def result_usage(result: ChatResult):
+    prompt_tokens, completion_tokens = token_usage(result.llm_output)
+    if prompt_tokens is None and result.generations:
+        # Newer langchain versions only report usage on the message
+        metadata = getattr(result.generations[0].message, 'usage_metadata', None) or {}
+        prompt_tokens, completion_tokens = metadata.get('input_tokens'), metadata.get('output_tokens')
+    return prompt_tokens, completion_tokens
+
+class RouteStats:
+    # Calls, fallbacks, tokens and latency per stage and model, to tune the routing table
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self._stages = {}
+        self._lock = threading.Lock()
+        self.planned = 0
+        self.planning_skipped = 0
+
+    def _stage(self, stage, model):
+        stats = self._stages.setdefault(stage, {})
+        return stats.setdefault(model, {'calls': 0, 'failures': 0, 'fallbacks': 0, 'prompt_tokens': 0, 'completion_tokens': 0})
+
+    def record(self, stage, model, seconds, prompt_tokens, completion_tokens):
+        self.latency.record(f'{stage} {model}', seconds)
+        with self._lock:
+            stats = self._stage(stage, model)
+            stats['calls'] += 1
+            stats['prompt_tokens'] += prompt_tokens or 0
+            stats['completion_tokens'] += completion_tokens or 0
+
+    def record_failure(self, stage, model, fell_back):
+        with self._lock:
+            self._stage(stage, model)['fallbacks' if fell_back else 'failures'] += 1
+
+    def record_planning(self, planned):
+        with self._lock:
+            if planned:
+                self.planned += 1
+            else:
+                self.planning_skipped += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'routes': {stage: route_fingerprint(stage) for stage in STAGE_ROUTES},
+                'stages': {stage: {model: dict(stats) for model, stats in models.items()} for stage, models in self._stages.items()},
+                'latency': self.latency.snapshot(buckets=False),
+                'planned': self.planned,
+                'planning_skipped': self.planning_skipped,
+            }
+
+route_stats = RouteStats()
+
+class RoutedChatModel(BaseChatModel):
+    # Chat model for one crew stage: tries the tier's models in order and moves to the
+    # next provider when a call times out, cannot connect, is rate limited or overloaded.
+
+    stage: str
+    models: List[str]
+    candidates: List[Any]
+
+    @property
+    def _llm_type(self):
+        return 'routed-chat'
+
+    @property
+    def _identifying_params(self):
+        return {'stage': self.stage, 'model': self.models[0]}
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        for index, (model, candidate) in enumerate(zip(self.models, self.candidates)):
+            started = time.monotonic()
+            try:
+                result = candidate._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except FALLBACK_ERRORS as e:
+                fell_back = index + 1 < len(self.candidates)
+                route_stats.record_failure(self.stage, model, fell_back)
+                if not fell_back:
+                    raise
+                logger.warning(f"{self.stage} call to {model} failed after {time.monotonic() - started:.1f}s "
+                               f"({type(e).__name__}), falling back to {self.models[index + 1]}")
+                continue
+            prompt_tokens, completion_tokens = result_usage(result)
+            route_stats.record(self.stage, model, time.monotonic() - started, prompt_tokens, completion_tokens)
+            return result
+
+def routed_llm(stage):
+    route = STAGE_ROUTES[stage]
+    models = stage_models(stage)
+    return RoutedChatModel(
+        stage=stage,
+        models=[f'{provider}:{model}' for provider, model in models],
+        candidates=[
+            PROVIDERS[provider](model=model, temperature=route['temperature'], timeout=llm_timeout, max_retries=llm_max_retries)
+            for provider, model in models
+        ],
+        callbacks=[tracing_handler],
+    )
+
+def stage_llm(stage):
+    # Factory for crew_factory.llm, which keeps one client per stage
+    return partial(routed_llm, stage=stage)
+
+
+# Prints the routing table: python -m crews.ai_research_crew.model_router
+if __name__ == '__main__':
+    for stage, route in STAGE_ROUTES.items():
+        print(f"{stage:>24}: {route['tier']:<8} temperature {route['temperature']:<4} {' -> '.join(MODEL_TIERS[route['tier']])}")
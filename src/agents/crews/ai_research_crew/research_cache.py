@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from google.cloud import firestore
+
+from ttl_cache import TTLCache
+
+
+logger = logging.getLogger(__name__)
+
+cache_backend = os.environ.get('RESEARCH_CACHE_BACKEND', 'firestore')
+cache_collection = os.environ.get('RESEARCH_CACHE_COLLECTION', 'research_cache')
+cache_size = int(os.environ.get('RESEARCH_CACHE_SIZE', '256'))
+cache_ttl = int(os.environ.get('RESEARCH_CACHE_TTL', str(24 * 3600)))
+# Firestore documents are capped at 1 MiB
+MAX_PERSISTED_CHARS = 900000
+
+_LIST_MARKER = re.compile(r'^\s*(?:[-*•]+|\d+[.)]|[a-z][.)])\s+', re.IGNORECASE)
+_SEPARATORS = re.compile(r'[\n;]+')
+_NON_WORD = re.compile(r'[^\w\s+#.-]+')
+_WHITESPACE = re.compile(r'\s+')
+_LEAD_IN = re.compile(r'^(?:the\s+)?(?:topics?|list of topics|research topics?)\s*(?:are|is|:)\s*', re.IGNORECASE)
+
+
+def normalize_topic(topic):
+    topic = _LEAD_IN.sub('', _LIST_MARKER.sub('', topic))
+    return _WHITESPACE.sub(' ', _NON_WORD.sub(' ', topic)).strip(' .-').lower()
+
+def topic_list(topics):
+    # topics is the parse task's structured list, free text is only split into lines
+    # when the model's answer could not be read as one. Keeps the request's order.
+    if isinstance(topics, str):
+        topics = _SEPARATORS.split(topics)
+    return list(dict.fromkeys(topic for topic in map(normalize_topic, topics or []) if topic))
+
+def normalize_topics(topics):
+    return sorted(topic_list(topics))
+
+def cache_key(topics, fingerprint):
+    payload = json.dumps({'topics': topics, 'config': fingerprint}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class FirestoreCacheBackend:
+    def __init__(self, collection=cache_collection, client=None):
+        self.collection = collection
+        self._client = client
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = firestore.Client()
+        return self._client
+
+    def get(self, key):
+        snapshot = self.client.collection(self.collection).document(key).get()
+        if not snapshot.exists:
+            return None
+        entry = snapshot.to_dict()
+        if entry.get('expires_at', 0) < time.time():
+            return None
+        return entry
+
+    def set(self, key, entry):
+        self.client.collection(self.collection).document(key).set(entry)
+
+class ResearchResultCache:
+    # Research reports keyed on the normalized topic list and the prompt/model
+    # configuration. An in-process LRU sits in front of an optional persistent backend.
+
+    def __init__(self, backend=None, max_size=cache_size, ttl_seconds=cache_ttl):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self._memory = TTLCache(max_size=max_size, ttl_seconds=ttl_seconds)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.llm_seconds_saved = 0.0
+
+    def get(self, key):
+        entry = self._memory.get(key)
+        if entry is None and self.backend is not None:
+            try:
+                entry = self.backend.get(key)
+            except Exception as e:
+                logger.warning(f"Research cache backend lookup failed: {str(e)}")
+            if entry is not None:
+                self._memory.set(key, entry, ttl_seconds=max(1, entry['expires_at'] - time.time()))
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.llm_seconds_saved += entry.get('research_seconds', 0.0)
+        return entry
+
+    def set(self, key, topics, report, research_seconds):
+        entry = {
+            'topics': topics,
+            'report': report,
+            'research_seconds': research_seconds,
+            'created_at': time.time(),
+            'expires_at': time.time() + self.ttl_seconds,
+        }
+        self._memory.set(key, entry)
+        if self.backend is not None and len(report) <= MAX_PERSISTED_CHARS:
+            try:
+                self.backend.set(key, entry)
+            except Exception as e:
+                logger.warning(f"Research cache backend write failed: {str(e)}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'llm_seconds_saved': round(self.llm_seconds_saved, 1),
+                'memory': self._memory.stats(),
+            }
+
+def get_research_cache():
+    if cache_backend == 'firestore':
+        return ResearchResultCache(FirestoreCacheBackend())
+    if cache_backend == 'memory':
+        return ResearchResultCache()
+    raise ValueError(f"Unknown RESEARCH_CACHE_BACKEND: {cache_backend}")
+
+research_cache = get_research_cache()
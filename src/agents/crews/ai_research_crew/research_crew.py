@@ -1,34 +1,186 @@
+import hashlib
+import logging
+import time
+from types import SimpleNamespace
 from crewai import Crew
-from langchain_anthropic import ChatAnthropic
+from opentelemetry import trace
 from crews.ai_research_crew.ai_research_tasks import *
 from crews.ai_research_crew.ai_research_agents import *
+from crews.ai_research_crew.crew_factory import crew_factory
+from crews.ai_research_crew.model_router import needs_planning, route_fingerprint, route_stats, stage_llm
+from crews.ai_research_crew.research_cache import cache_key, normalize_topics, research_cache, topic_list
+from crews.ai_research_crew.research_fanout import fan_out, max_parallel_topics, merge_reports, research_mode, searches_per_topic, split_topics
+from crews.ai_research_crew.research_tools import budgeted_tools
+
+
+logger = logging.getLogger(__name__)
+tracer = trace.get_tracer(__name__)
+
+# The stages run as separate crews, so later stages get earlier outputs as inputs
+# instead of through Task.context.
+RESEARCH_REPORT_SECTION = """
+<RESEARCH_REPORT>
+{research_report}
+</RESEARCH_REPORT>
+"""
+
+
+def stage_agent(stage, **overrides):
+    # A fresh agent for the stage's task, on the model the router picked for the stage
+    agent_name = crew_factory.task_templates[stage]['agent']
+    return crew_factory.build_agent(agent_name, llm=crew_factory.llm(stage_llm(stage)), **overrides)
+
+def stage_task(stage, agent, extra_description=''):
+    agents = SimpleNamespace(**{crew_factory.task_templates[stage]['agent']: agent})
+    return crew_factory.build_task(stage, agents, extra_description)
+
+def research_config_fingerprint(stage, *extra):
+    # Anything that changes what the research stage would produce invalidates the cache
+    task = crew_factory.task_templates[stage]
+    parts = [
+        task['description'],
+        task['expected_output'],
+        researcher_config['role'],
+        researcher_config['goal'],
+        researcher_config['backstory'],
+        route_fingerprint(stage),
+        ','.join(tool.name for tool in researcher_config['tools']),
+        *map(str, extra),
+    ]
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+def cached_research(key):
+    with tracer.start_as_current_span('research_cache.lookup') as span:
+        cached = research_cache.get(key)
+        span.set_attribute('cache.hit', bool(cached))
+    return cached
+
+def parsed_topics(parse_output):
+    # The topics the parse task returned as ResearchTopics, the raw answer only when the
+    # model's output could not be read as JSON
+    topics = (getattr(parse_output, 'json_dict', None) or {}).get('topics')
+    if isinstance(topics, list) and all(isinstance(topic, str) for topic in topics):
+        return topics
+    logger.warning(f"Parse task returned no structured topic list, splitting its answer: {parse_output.raw[:200]!r}")
+    return parse_output.raw
+
+def kickoff_stage(task_name, crew, inputs):
+    with tracer.start_as_current_span(f'crew.task.{task_name}'):
+        return crew.kickoff(inputs)
+
+class ResearchCrewResult:
+    def __init__(self, tasks_output, raw, cache_hit):
+        self.tasks_output = tasks_output
+        self.raw = raw
+        self.cache_hit = cache_hit
+
+    def __str__(self):
+        return str(self.raw)
 
 class AIResearchCrew:
     def __init__(self, email_subject, email_body, email_from):
         self.email_subject = email_subject
         self.email_body = email_body
         self.email_from = email_from
+        self.memory = None
 
     def run(self):
-        crew = Crew(
-            agents=[administrative_assistant,
-                    researcher,
-                    writer],
-            tasks=[parse_research_request,
-                   conduct_research,
-                   rewrite_report_to_email],
+        # Fresh agents and a fresh memory scope per request so no conversation state leaks
+        # between emails
+        with crew_factory.run_memory() as memory:
+            self.memory = memory
+            return self.run_stages()
+
+    def crew(self, **options):
+        # Every stage of the run shares the run's memory scope
+        return Crew(memory=self.memory or False, **options)
+
+    def run_stages(self):
+        inputs = crew_factory.cap_inputs({
+            "email_subject": self.email_subject,
+            "email_body": self.email_body,
+            "email_from": self.email_from,
+            "list_of_topics": "the topics requested in the email",
+            "research_report": "the research report",
+        })
+
+        assistant = stage_agent('parse_research_request')
+        parse_output = kickoff_stage('parse_research_request', self.crew(
+            agents=[assistant],
+            tasks=[stage_task('parse_research_request', assistant)],
             verbose=2,
-            manager_llm=ChatAnthropic(
-                temperature=0.5,
-                model="claude-3-5-sonnet-20240620"
-            ),
-            planning=True,
-            planning_llm=ChatAnthropic(
-                temperature=0.5,
-                model="claude-3-5-sonnet-20240620"
-            ),
-            max_iter=15,
+        ), inputs)
+        topics = topic_list(parsed_topics(parse_output))
+        inputs.update(crew_factory.cap_inputs({"list_of_topics": '\n'.join(f'- {topic}' for topic in topics)}))
+
+        if research_mode == 'parallel' and len(topics) > 1:
+            research_output, cache_hit = self.research_in_parallel(inputs, topics)
+        else:
+            research_output, cache_hit = self.research(inputs, normalize_topics(topics))
+        inputs.update(crew_factory.cap_inputs({"research_report": research_output.raw}))
+
+        assistant = stage_agent('rewrite_report_to_email')
+        email_output = kickoff_stage('rewrite_report_to_email', self.crew(
+            agents=[assistant],
+            tasks=[stage_task('rewrite_report_to_email', assistant, RESEARCH_REPORT_SECTION)],
+            verbose=2,
+        ), inputs)
+
+        logger.info(f"Research cache stats: {research_cache.stats()}")
+        return ResearchCrewResult(
+            [parse_output.tasks_output[0], research_output, email_output.tasks_output[0]],
+            email_output.raw,
+            cache_hit=cache_hit,
         )
 
-        results = crew.kickoff({"email_subject": self.email_subject, "email_body": self.email_body, "email_from": self.email_from})
-        return results
+    def research(self, inputs, topics):
+        # One researcher works through every topic
+        key = cache_key(topics, research_config_fingerprint('conduct_research'))
+        cached = cached_research(key)
+        if cached:
+            logger.info(f"Research cache hit for topics {topics}, skipping the research stage")
+            return SimpleNamespace(raw=cached['report'], cached=True), True
+        # A planning pass only pays off for requests with several topics or a long body
+        planning = needs_planning(topics, inputs['email_body'])
+        route_stats.record_planning(planning)
+        planning_options = {'planning': True, 'planning_llm': crew_factory.llm(stage_llm('planning'))} if planning else {}
+        started = time.monotonic()
+        researcher = stage_agent('conduct_research')
+        research_output = kickoff_stage('conduct_research', self.crew(
+            agents=[researcher],
+            tasks=[stage_task('conduct_research', researcher)],
+            verbose=2,
+            max_iter=15,
+            **planning_options,
+        ), inputs).tasks_output[0]
+        research_cache.set(key, topics, research_output.raw, time.monotonic() - started)
+        return research_output, False
+
+    def research_in_parallel(self, inputs, topics):
+        # One research task per topic with its own search budget, cached per topic. The
+        # single-topic tasks skip the planning pass the combined task needs.
+        fingerprint = research_config_fingerprint('research_topic', searches_per_topic)
+        topics = split_topics(topics)
+        reports = {}
+        for topic in topics:
+            cached = cached_research(cache_key([topic], fingerprint))
+            if cached:
+                reports[topic] = cached['report']
+        misses = [topic for topic in topics if topic not in reports]
+
+        def research_one(topic):
+            started = time.monotonic()
+            researcher = stage_agent('research_topic', tools=budgeted_tools(searches_per_topic))
+            output = kickoff_stage('research_topic', self.crew(
+                agents=[researcher],
+                tasks=[stage_task('research_topic', researcher)],
+                verbose=2,
+            ), {**inputs, 'topic': topic, 'search_budget': searches_per_topic}).tasks_output[0]
+            research_cache.set(cache_key([topic], fingerprint), [topic], output.raw, time.monotonic() - started)
+            return output.raw
+
+        started = time.monotonic()
+        reports.update(fan_out(misses, research_one, max_parallel_topics))
+        logger.info(f"Researched {len(misses)} of {len(topics)} topics in parallel in {time.monotonic() - started:.1f}s, "
+                    f"{len(topics) - len(misses)} from cache")
+        return SimpleNamespace(raw=merge_reports(topics, reports), cached=not misses), not misses
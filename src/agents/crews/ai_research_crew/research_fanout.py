@@ -0,0 +1,97 @@
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+# 'sequential' has one researcher work through every topic, 'parallel' gives each topic
+# its own research task and runs up to max_parallel_topics of them at once
+research_mode = os.environ.get('RESEARCH_MODE', 'sequential')
+max_parallel_topics = int(os.environ.get('RESEARCH_MAX_PARALLEL_TOPICS', '3'))
+# Topics past this many are researched together in the last task
+max_topic_tasks = int(os.environ.get('RESEARCH_MAX_TOPIC_TASKS', '6'))
+searches_per_topic = int(os.environ.get('RESEARCH_SEARCHES_PER_TOPIC', '4'))
+
+FAILED_TOPIC_NOTE = 'Research on this topic could not be completed.'
+
+
+def split_topics(topics, max_tasks=max_topic_tasks):
+    # topics is the parse task's topic list in request order, see research_cache.topic_list
+    if len(topics) <= max_tasks:
+        return list(topics)
+    return list(topics[:max_tasks - 1]) + ['; '.join(topics[max_tasks - 1:])]
+
+def fan_out(topics, research_topic, max_parallel=max_parallel_topics):
+    # Returns {topic: report or the exception its research raised}
+    if not topics:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_parallel, len(topics)), thread_name_prefix='research') as executor:
+        # Each task runs in a copy of the caller's context so its spans stay in the trace
+        futures = {topic: executor.submit(contextvars.copy_context().run, research_topic, topic) for topic in topics}
+    results = {}
+    for topic, future in futures.items():
+        try:
+            results[topic] = future.result()
+        except Exception as e:
+            logger.warning(f"Research for topic '{topic}' failed: {str(e)}")
+            results[topic] = e
+    return results
+
+def merge_reports(topics, reports):
+    # One section per topic in topic order, whatever order the tasks finished in
+    failed = [topic for topic in topics if isinstance(reports.get(topic), Exception) or reports.get(topic) is None]
+    if len(failed) == len(topics):
+        error = next((reports[topic] for topic in topics if isinstance(reports.get(topic), Exception)), None)
+        raise error or RuntimeError('No research results to merge')
+    sections = []
+    for topic in topics:
+        report = FAILED_TOPIC_NOTE if topic in failed else reports[topic].strip()
+        sections.append(f"## {topic}\n\n{report}")
+    return '\n\n'.join(sections)
+
+
+# Wall time of the sequential pipeline vs the fan-out with stub LLM and search calls:
+# python research_fanout.py
+if __name__ == '__main__':
+    import threading
+
+    llm_seconds, search_seconds = 0.2, 0.05
+    topics = ['mixture of experts', 'rag evaluation', 'speculative decoding', 'state space models', 'vision language models']
+    calls = {'llm': 0, 'search': 0}
+    lock = threading.Lock()
+
+    def llm_call():
+        with lock:
+            calls['llm'] += 1
+        time.sleep(llm_seconds)
+
+    def search(query):
+        with lock:
+            calls['search'] += 1
+        time.sleep(search_seconds)
+
+    def research(topic, searches=searches_per_topic):
+        # Plan the queries, run them, write the section
+        llm_call()
+        for index in range(searches):
+            search(f'{topic} {index}')
+        llm_call()
+        return f'Findings on {topic}.'
+
+    def sequential():
+        # One planning pass, then one researcher over every topic
+        llm_call()
+        return merge_reports(topics, {topic: research(topic) for topic in topics})
+
+    def parallel():
+        return merge_reports(topics, fan_out(split_topics(topics), research))
+
+    for label, pipeline in (('sequential', sequential), ('parallel', parallel)):
+        calls.update(llm=0, search=0)
+        started = time.perf_counter()
+        report = pipeline()
+        print(f"{label:>10}: {time.perf_counter() - started:.2f}s, {calls['llm']} LLM calls, "
+              f"{calls['search']} searches, {len(report)} report chars")
@@ -1,27 +1,263 @@
 from langchain.agents import Tool
 from langchain.utilities import GoogleSerperAPIWrapper
-from google.cloud import secretmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextvars
+from functools import lru_cache
+import logging
 import os
+import re
+import threading
+import time
+from opentelemetry import trace
 
+from rate_limit import TokenBucket
+from secret_store import get_secret
+from ttl_cache import TTLCache
 
-PROJECT_ID = os.environ.get('PROJECT_ID')
 
-# Setup API keys
-def access_secret_version(secret_id, version_id="latest"):
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/{PROJECT_ID}/secrets/{secret_id}/versions/{version_id}"
-    response = client.access_secret_version(request={"name": name})
-    return response.payload.data.decode('UTF-8')
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', '1024'))
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', str(6 * 3600)))
+SEARCH_RATE_PER_SECOND = float(os.environ.get('SEARCH_RATE_PER_SECOND', '5'))
+SEARCH_MAX_CONCURRENCY = int(os.environ.get('SEARCH_MAX_CONCURRENCY', '4'))
+MAX_QUERIES_PER_CALL = 8
+BUDGET_EXHAUSTED = "Search budget exhausted. Write your report from the results you already have."
 
-SERPER_API_KEY = access_secret_version('SERPER_API_KEY')
+logger = logging.getLogger(__name__)
+tracer = trace.get_tracer(__name__)
 
+_QUERY_WHITESPACE = re.compile(r'\s+')
+_QUERY_EDGES = re.compile(r'^[\s"\'`.,;:!?]+|[\s"\'`.,;:!?]+$')
+_QUERY_SEPARATORS = re.compile(r'[\n;|]+')
 
-search = GoogleSerperAPIWrapper(serper_api_key=SERPER_API_KEY)
+def normalize_query(query):
+    return _QUERY_EDGES.sub('', _QUERY_WHITESPACE.sub(' ', query or '')).lower()
+
+class CachedSearch:
+    # Search front end: normalized queries share an LRU+TTL cache, concurrent calls for
+    # the same query wait on the one in flight, and upstream calls are rate limited.
+
+    def __init__(self, search_fn, cache_size=SEARCH_CACHE_SIZE, cache_ttl=SEARCH_CACHE_TTL,
+                 rate_per_second=SEARCH_RATE_PER_SECOND, max_concurrency=SEARCH_MAX_CONCURRENCY):
+        self.search_fn = search_fn
+        self.max_concurrency = max_concurrency
+        self._cache = TTLCache(max_size=cache_size, ttl_seconds=cache_ttl)
+        self._limiter = TokenBucket(rate_per_second)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='search')
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self.upstream_seconds = 0.0
+
+    def run(self, query):
+        key = normalize_query(query)
+        if not key:
+            return "Empty search query"
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+
+        try:
+            self._limiter.acquire()
+            started = time.monotonic()
+            result = self.search_fn(key)
+            with self._lock:
+                self.upstream_calls += 1
+                self.upstream_seconds += time.monotonic() - started
+            self._cache.set(key, result)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def run_many(self, queries):
+        if isinstance(queries, str):
+            queries = _QUERY_SEPARATORS.split(queries)
+        unique = {}
+        for query in queries:
+            unique.setdefault(normalize_query(query), query.strip())
+        queries = [query for key, query in unique.items() if key][:MAX_QUERIES_PER_CALL]
+        # Each worker runs in a copy of the caller's context so its spans stay in the trace
+        futures = [(query, self._executor.submit(contextvars.copy_context().run, self.run, query)) for query in queries]
+        sections = []
+        for query, future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.warning(f"Search for '{query}' failed: {str(e)}")
+                result = f"Search failed: {str(e)}"
+            sections.append(f"## {query}\n{result}")
+        return '\n\n'.join(sections)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'upstream_calls': self.upstream_calls,
+                'coalesced': self.coalesced,
+                'upstream_seconds': round(self.upstream_seconds, 3),
+                'cache': self._cache.stats(),
+            }
+
+
+# The Serper key is only fetched on the first search
+@lru_cache(maxsize=1)
+def get_search():
+    return GoogleSerperAPIWrapper(serper_api_key=get_secret('SERPER_API_KEY'))
+
+def serper_search(query):
+    return get_search().run(query)
+
+cached_search = CachedSearch(serper_search)
+
+def traced_tool(span_name, func):
+    def call(tool_input):
+        with tracer.start_as_current_span(span_name, attributes={'tool.input': str(tool_input)[:256]}):
+            return func(tool_input)
+    return call
 
 # Create and assign the search tool to an agent
 serper_tool = Tool(
   name="Web search",
-  func=search.run,
+  func=traced_tool('tool.web_search', cached_search.run),
   description="Useful for search-based queries",
 )
 
+multi_search_tool = Tool(
+  name="Multi web search",
+  func=traced_tool('tool.multi_web_search', cached_search.run_many),
+  description=f"Runs up to {MAX_QUERIES_PER_CALL} search queries at once. Input is one query per line. Prefer this over several single searches.",
+)
+
+
+class SearchBudget:
+    # Searches one research task may still run, shared by its tools
+    def __init__(self, searches):
+        self.remaining = searches
+        self._lock = threading.Lock()
+
+    def take(self, count):
+        with self._lock:
+            granted = min(count, self.remaining)
+            self.remaining -= granted
+            return granted
+
+def budgeted_tools(searches):
+    # Fresh search tools for one task, searches past the budget are refused
+    budget = SearchBudget(searches)
+
+    def search(query):
+        if not budget.take(1):
+            return BUDGET_EXHAUSTED
+        return cached_search.run(query)
+
+    def search_many(queries):
+        if isinstance(queries, str):
+            queries = _QUERY_SEPARATORS.split(queries)
+        unique = list({normalize_query(query): query for query in queries if normalize_query(query)}.values())
+        granted = budget.take(min(len(unique), MAX_QUERIES_PER_CALL))
+        if not granted:
+            return BUDGET_EXHAUSTED
+        return cached_search.run_many(unique[:granted])
+
+    return [
+        Tool(name=serper_tool.name, func=traced_tool('tool.web_search', search), description=serper_tool.description),
+        Tool(name=multi_search_tool.name, func=traced_tool('tool.multi_web_search', search_many), description=multi_search_tool.description),
+    ]
+
+
+
+# Search wall time per crew run against a local fake Serper endpoint:
+# python -m crews.ai_research_crew.research_tools
+# Replays the queries a researcher typically sends, repeats and near-duplicates included,
+# for three runs on the same topic, uncached one at a time and then through CachedSearch.
+def _fake_serper_server(latency):
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['q']
+            time.sleep(latency)
+            body = json.dumps({'organic': [{'title': f'{query} result {i}', 'snippet': 'x' * 200} for i in range(10)]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def _benchmark(runs=3):
+    import json
+    import urllib.request
+
+    latency = float(os.environ.get('SERPER_BENCH_LATENCY', '0.3'))
+    server = _fake_serper_server(latency)
+    url = f'http://localhost:{server.server_address[1]}/search'
+    requests_sent = []
+
+    def search(query):
+        requests_sent.append(query)
+        request = urllib.request.Request(url, data=json.dumps({'q': query}).encode(), headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            return '\n'.join(item['snippet'] for item in json.loads(response.read())['organic'])
+
+    # Lists are multi-search calls, strings single searches
+    crew_run = [
+        ['retrieval augmented generation survey', 'RAG evaluation benchmarks', 'long context LLM evaluation'],
+        'Retrieval augmented generation survey',
+        'RAG evaluation benchmarks.',
+        ['long context LLM evaluation', 'needle in a haystack results'],
+        '"needle in a haystack results"',
+    ]
+
+    def report(name, per_run):
+        print(f"{name:>9}: " + ', '.join(f"run {i + 1} {seconds:.2f}s" for i, seconds in enumerate(per_run))
+              + f", {len(requests_sent)} upstream requests")
+        requests_sent.clear()
+
+    per_run = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        for call in crew_run:
+            for query in ([call] if isinstance(call, str) else call):
+                search(query)
+        per_run.append(time.perf_counter() - started)
+    report('uncached', per_run)
+
+    searcher = CachedSearch(search)
+    per_run = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        for call in crew_run:
+            if isinstance(call, str):
+                searcher.run(call)
+            else:
+                searcher.run_many(call)
+        per_run.append(time.perf_counter() - started)
+    report('cached', per_run)
+    print(f"{latency * 1000:.0f}ms per upstream search, {SEARCH_RATE_PER_SECOND}/s rate limit, stats {searcher.stats()}")
+    server.shutdown()
+
+if __name__ == '__main__':
+    _benchmark()
@@ -0,0 +1,170 @@
+import logging
+import os
+import re
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+logger = logging.getLogger(__name__)
+
+token_budget = int(os.environ.get('EMAIL_TOKEN_BUDGET', '2000'))
+TRUNCATION_MARKER = '\n\n[...]'
+
+# Where the quoted history of a reply starts. Everything from here on is dropped.
+_QUOTE_HEADERS = [
+    re.compile(r'^On\b.{0,200}?\bwrote:\s*$', re.MULTILINE | re.DOTALL),
+    re.compile(r'^-{2,}\s*Original Message\s*-{2,}\s*$', re.MULTILINE | re.IGNORECASE),
+    re.compile(r'^_{10,}\s*\n(?:From|De|Von):', re.MULTILINE),
+    re.compile(r'^From:.*\n(?:Sent|Date):.*\n(?:To):', re.MULTILINE),
+]
+_QUOTED_LINE = re.compile(r'^\s*>.*$\n?', re.MULTILINE)
+_SIGNATURE = re.compile(r'^(?:-- ?|Sent from my .+|Get Outlook for .+)$', re.MULTILINE)
+# How legal notices and mailing list footers open. Matched at the start of a paragraph
+# only, so a request that merely mentions e.g. privileged access is left alone.
+_LEGAL_FOOTER = re.compile(
+    r'^[*_\s]*(?:confidentiality notice|confidential(?:ity)? disclaimer|disclaimer\s*:|legal notice'
+    r'|privileged (?:and|&) confidential'
+    r'|this (?:e-?mail|message|communication)\b[^.]{0,80}\b(?:is|are|may be|may contain|contains?) (?:strictly )?(?:confidential|privileged)'
+    r'|the information (?:contained )?in this (?:e-?mail|message|communication)\b[^.]{0,80}\b(?:confidential|privileged|intended)'
+    r'|if you (?:are not the intended recipient|have received this (?:e-?mail|message|communication) in error)'
+    r'|(?:to |click here to )?unsubscribe\b|(?:to |click here to )?(?:update|manage) your (?:email )?preferences'
+    r'|please consider the environment before printing)',
+    re.IGNORECASE,
+)
+_URL = re.compile(r'https?://[^\s<>"\')\]]+')
+_TRACKING_PARAMS = re.compile(r'^(?:utm_\w+|fbclid|gclid|dclid|msclkid|mc_cid|mc_eid|_hsenc|_hsmi|mkt_tok|vero_\w+|oly_\w+)$', re.IGNORECASE)
+_BLANK_LINES = re.compile(r'\n\s*\n+')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _load_encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        logger.info(f"tiktoken unavailable ({str(e)}), estimating tokens from characters")
+        return None
+
+_encoding = _load_encoding()
+
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # Roughly four characters per token for English text
+    return (len(text) + 3) // 4
+
+def truncate_tokens(text, max_tokens):
+    if _encoding is not None:
+        return _encoding.decode(_encoding.encode(text, disallowed_special=())[:max_tokens])
+    return text[:max_tokens * 4]
+
+def strip_quoted_history(text):
+    cut = len(text)
+    for pattern in _QUOTE_HEADERS:
+        match = pattern.search(text)
+        # A reply header on the very first line is a forward or a bare quote, keep the text
+        if match and match.start() > 0:
+            cut = min(cut, match.start())
+    return _QUOTED_LINE.sub('', text[:cut])
+
+def strip_signature(text):
+    match = _SIGNATURE.search(text)
+    return text[:match.start()] if match else text
+
+def strip_footers(paragraphs):
+    # Only the trailing run of footer paragraphs goes, and never the first paragraph
+    end = len(paragraphs)
+    while end > 1 and _LEGAL_FOOTER.match(paragraphs[end - 1]):
+        end -= 1
+    return paragraphs[:end]
+
+def strip_tracking(text):
+    def clean(match):
+        url = match.group(0)
+        parts = urlsplit(url)
+        if not parts.query:
+            return url
+        query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+                 if not _TRACKING_PARAMS.match(key)]
+        return urlunsplit(parts._replace(query=urlencode(query)))
+    return _URL.sub(clean, text)
+
+def split_paragraphs(text):
+    return [paragraph.strip() for paragraph in _BLANK_LINES.split(text) if paragraph.strip()]
+
+def dedupe_paragraphs(paragraphs):
+    seen = set()
+    unique = []
+    for paragraph in paragraphs:
+        key = _WHITESPACE.sub(' ', paragraph).lower()
+        if key not in seen:
+            seen.add(key)
+            unique.append(paragraph)
+    return unique
+
+def trim_to_budget(paragraphs, max_tokens):
+    kept = []
+    used = 0
+    separator_tokens = count_tokens('\n\n')
+    for paragraph in paragraphs:
+        tokens = count_tokens(paragraph) + (separator_tokens if kept else 0)
+        if used + tokens > max_tokens:
+            remaining = max_tokens - used - count_tokens(TRUNCATION_MARKER)
+            if not kept and remaining > 0:
+                kept.append(truncate_tokens(paragraph, remaining))
+            return '\n\n'.join(kept) + TRUNCATION_MARKER
+        kept.append(paragraph)
+        used += tokens
+    return '\n\n'.join(kept)
+
+class CompactionResult:
+    def __init__(self, text, tokens_before, tokens_after, seconds):
+        self.text = text
+        self.tokens_before = tokens_before
+        self.tokens_after = tokens_after
+        self.seconds = seconds
+
+    @property
+    def reduction(self):
+        return 1 - self.tokens_after / self.tokens_before if self.tokens_before else 0.0
+
+def compact_email(body, max_tokens=token_budget):
+    started = time.perf_counter()
+    body = (body or '').replace('\r\n', '\n')
+    text = strip_signature(strip_quoted_history(body))
+    paragraphs = strip_footers(split_paragraphs(strip_tracking(text)))
+    compacted = trim_to_budget(dedupe_paragraphs(paragraphs), max_tokens)
+    # Never hand the crew an empty body, fall back to the budgeted original
+    if not compacted.strip():
+        compacted = trim_to_budget(split_paragraphs(body), max_tokens)
+    return CompactionResult(compacted, count_tokens(body), count_tokens(compacted), time.perf_counter() - started)
+
+
+# Offline benchmark on synthetic long threads: python email_compaction.py
+def _thread_fixture(replies, paragraph_words=60):
+    request = ("Could you put together a short research summary on retrieval augmented generation "
+               "and how evaluation of long context models is done today? ") * 2
+    signature = "\n\n-- \nJane Doe\nHead of Research\nExample Corp | +1 555 0100"
+    footer = ("\n\nCONFIDENTIALITY NOTICE: This email and any attachments are intended only for the "
+              "addressee and may contain privileged information.")
+    link = "\n\nSlides: https://example.com/deck?id=42&utm_source=newsletter&utm_medium=email&fbclid=abc123"
+    filler = ' '.join(['discussion'] * paragraph_words)
+    body = ''
+    for i in range(replies):
+        quoted = '\n'.join('> ' + line for line in body.splitlines())
+        body = (f"Reply {i}: {filler}\n\n{request if i == replies - 1 else ''}{link}{signature}{footer}\n\n"
+                f"On Mon, 3 Jun 2024 at 10:{i:02d}, Someone <someone@example.com> wrote:\n{quoted}")
+    return body
+
+if __name__ == '__main__':
+    print(f"tokenizer: {'tiktoken cl100k_base' if _encoding is not None else 'character estimate'}, budget {token_budget}")
+    for replies in (1, 5, 10, 20, 40):
+        fixture = _thread_fixture(replies)
+        runs = 20
+        started = time.perf_counter()
+        for _ in range(runs):
+            result = compact_email(fixture)
+        elapsed_ms = 1000 * (time.perf_counter() - started) / runs
+        print(f"{replies:>3} replies: {result.tokens_before:>7} -> {result.tokens_after:>5} tokens "
+              f"({result.reduction:.1%} saved) in {elapsed_ms:.2f}ms")
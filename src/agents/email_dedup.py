@@ -0,0 +1,150 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from google.api_core.exceptions import Aborted, Conflict
+from google.cloud import datastore
+
+from ttl_cache import TTLCache
+
+
+logger = logging.getLogger(__name__)
+
+KIND = 'ProcessedEmail'
+STATUS_PROCESSING = 'processing'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# How long a claim holds without renewal, the job worker renews it on every heartbeat
+lease_seconds = int(os.environ.get('DEDUP_LEASE_SECONDS', '900'))
+filter_size = int(os.environ.get('DEDUP_FILTER_SIZE', '10000'))
+filter_ttl = int(os.environ.get('DEDUP_FILTER_TTL', '86400'))
+
+
+class EmailDeduplicator:
+    # Claims an email for processing with a single transactional insert-if-absent, so two
+    # redeliveries of the same Pub/Sub message can never both run the crew. Emails already
+    # claimed or finished in this process are answered from memory without a round trip.
+
+    def __init__(self, client=None):
+        self._client = client
+        self._client_lock = threading.Lock()
+        self._seen = TTLCache(max_size=filter_size, ttl_seconds=filter_ttl)
+        self._stats_lock = threading.Lock()
+        self.claims = 0
+        self.duplicates_local = 0
+        self.duplicates_remote = 0
+        self.claim_seconds_total = 0.0
+        self.claim_seconds_max = 0.0
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = datastore.Client()
+        return self._client
+
+    def claim(self, email_id):
+        started = time.perf_counter()
+        try:
+            if self._seen.get(email_id) is not None:
+                self._count('duplicates_local')
+                return False
+            claimed = self._claim_remote(email_id)
+            self._count('claims' if claimed else 'duplicates_remote')
+            if claimed:
+                self._seen.set(email_id, STATUS_PROCESSING)
+            return claimed
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._stats_lock:
+                self.claim_seconds_total += elapsed
+                self.claim_seconds_max = max(self.claim_seconds_max, elapsed)
+
+    def renew(self, email_id):
+        # Pushes a held claim's lease out again while its job is still running. Returns
+        # False when the email is no longer being processed.
+        key = self.client.key(KIND, email_id)
+        now = datetime.now(timezone.utc)
+        try:
+            with self.client.transaction():
+                entity = self.client.get(key)
+                if entity is None or entity.get('status') != STATUS_PROCESSING:
+                    return False
+                entity['lease_expires'] = now + timedelta(seconds=lease_seconds)
+                entity['updated_at'] = now
+                self.client.put(entity)
+            return True
+        except (Conflict, Aborted):
+            logger.info(f"Claim renewal for email {email_id} raced another write")
+            return False
+
+    def complete(self, email_id):
+        self._put_status(email_id, STATUS_DONE)
+        self._seen.set(email_id, STATUS_DONE)
+
+    def release(self, email_id, error=None):
+        # Failed runs give the email back so a redelivery can try again
+        self._put_status(email_id, STATUS_FAILED, error=str(error) if error else None)
+        self._seen.pop(email_id)
+
+    def stats(self):
+        with self._stats_lock:
+            lookups = self.claims + self.duplicates_local + self.duplicates_remote
+            return {
+                'claims': self.claims,
+                'duplicates_local': self.duplicates_local,
+                'duplicates_remote': self.duplicates_remote,
+                'duplicate_crew_runs_avoided': self.duplicates_local + self.duplicates_remote,
+                'claim_latency_avg_ms': round(1000 * self.claim_seconds_total / lookups, 3) if lookups else 0.0,
+                'claim_latency_max_ms': round(1000 * self.claim_seconds_max, 3),
+                'filter': self._seen.stats(),
+            }
+
+    def _claim_remote(self, email_id):
+        key = self.client.key(KIND, email_id)
+        now = datetime.now(timezone.utc)
+        try:
+            with self.client.transaction():
+                entity = self.client.get(key)
+                if entity and self._is_taken(entity, now):
+                    if entity.get('status', STATUS_DONE) == STATUS_DONE:
+                        self._seen.set(email_id, STATUS_DONE)
+                    return False
+                claim = datastore.Entity(key=key, exclude_from_indexes=('error',))
+                claim['status'] = STATUS_PROCESSING
+                claim['lease_expires'] = now + timedelta(seconds=lease_seconds)
+                claim['attempts'] = (entity.get('attempts', 0) if entity else 0) + 1
+                claim['updated_at'] = now
+                self.client.put(claim)
+            return True
+        except (Conflict, Aborted):
+            # A concurrent claim for the same email committed first
+            logger.info(f"Lost claim race for email {email_id}")
+            return False
+
+    def _is_taken(self, entity, now):
+        # Entities written before claims existed only carry processed=True
+        status = entity.get('status', STATUS_DONE if entity.get('processed') else None)
+        if status == STATUS_DONE:
+            return True
+        if status == STATUS_PROCESSING:
+            lease_expires = entity.get('lease_expires')
+            return lease_expires is not None and lease_expires > now
+        return False
+
+    def _put_status(self, email_id, status, error=None):
+        entity = datastore.Entity(key=self.client.key(KIND, email_id), exclude_from_indexes=('error',))
+        entity['status'] = status
+        entity['processed'] = status == STATUS_DONE
+        entity['updated_at'] = datetime.now(timezone.utc)
+        if error:
+            entity['error'] = error[:1500]
+        self.client.put(entity)
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
@@ -0,0 +1,165 @@
+import base64
+import contextvars
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+from email.utils import make_msgid, parseaddr
+
+from googleapiclient.errors import HttpError
+from opentelemetry import trace
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from rate_limit import TokenBucket
+from ttl_cache import TTLCache
+
+
+logger = logging.getLogger(__name__)
+tracer = trace.get_tracer(__name__)
+
+# messages.send costs 100 of the 250 quota units a user gets per second
+send_rate_per_user = float(os.environ.get('SEND_RATE_PER_USER', '2'))
+send_burst_per_user = float(os.environ.get('SEND_BURST_PER_USER', '2'))
+send_workers = int(os.environ.get('SEND_WORKERS', '4'))
+send_max_attempts = int(os.environ.get('SEND_MAX_ATTEMPTS', '5'))
+send_max_backoff = float(os.environ.get('SEND_MAX_BACKOFF_SECONDS', '32'))
+send_service_ttl = int(os.environ.get('SEND_SERVICE_TTL', '3000'))
+send_service_cache_size = int(os.environ.get('SEND_SERVICE_CACHE_SIZE', '100'))
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+
+def is_retryable(error):
+    if isinstance(error, HttpError):
+        if error.resp.status in RETRYABLE_STATUSES:
+            return True
+        # Gmail reports per-user rate limits as 403 with a rate limit reason
+        return error.resp.status == 403 and any(reason in str(error.content) for reason in RATE_LIMIT_REASONS)
+    return isinstance(error, (socket.timeout, ConnectionError, TimeoutError))
+
+def reply_subject(subject):
+    subject = (subject or '').strip()
+    return subject if subject.lower().startswith('re:') else f"Re: {subject}"
+
+def build_reply(sender, to, subject, content, in_reply_to=None, references=None):
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = to
+    message['Subject'] = reply_subject(subject)
+    message['Message-ID'] = make_msgid(domain=parseaddr(sender)[1].rpartition('@')[2] or None)
+    if in_reply_to:
+        message['In-Reply-To'] = in_reply_to
+        message['References'] = f"{references} {in_reply_to}".strip() if references else in_reply_to
+    message.set_content(content)
+    return message
+
+class EmailSender:
+    # Sends replies through cached per-user Gmail services. Each user has a token bucket
+    # sized to the send quota, and retryable errors back off with jitter.
+
+    def __init__(self, build_service, workers=send_workers, rate_per_user=send_rate_per_user,
+                 burst_per_user=send_burst_per_user, max_attempts=send_max_attempts):
+        self.build_service = build_service
+        self.rate_per_user = rate_per_user
+        self.burst_per_user = burst_per_user
+        self._services = TTLCache(max_size=send_service_cache_size, ttl_seconds=send_service_ttl)
+        self._buckets = {}
+        self._user_locks = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sender')
+        self._send_with_retry = retry(
+            retry=retry_if_exception(is_retryable),
+            wait=wait_random_exponential(multiplier=1, max=send_max_backoff),
+            stop=stop_after_attempt(max_attempts),
+            before_sleep=self._before_retry,
+            reraise=True,
+        )(self._send_once)
+        self._sent_at = deque(maxlen=1000)
+        self.queued = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    def _before_retry(self, retry_state):
+        with self._lock:
+            self.retries += 1
+        logger.warning(f"Retrying send (attempt {retry_state.attempt_number}): {retry_state.outcome.exception()}")
+
+    def _user_state(self, user_email):
+        with self._lock:
+            if user_email not in self._buckets:
+                self._buckets[user_email] = TokenBucket(self.rate_per_user, self.burst_per_user)
+                self._user_locks[user_email] = threading.Lock()
+            return self._buckets[user_email], self._user_locks[user_email]
+
+    def _service(self, user_email):
+        service = self._services.get(user_email)
+        if service is None:
+            service = self.build_service(user_email)
+            self._services.set(user_email, service)
+        return service
+
+    def _send_once(self, user_email, body):
+        bucket, user_lock = self._user_state(user_email)
+        bucket.acquire()
+        # Service objects share one httplib2 connection, which is not thread safe
+        with user_lock:
+            return self._service(user_email).users().messages().send(userId='me', body=body).execute()
+
+    def _send(self, user_email, message, thread_id):
+        with self._lock:
+            self.queued -= 1
+            self.in_flight += 1
+        try:
+            with tracer.start_as_current_span('gmail.send', attributes={'user.email': user_email}):
+                body = {'raw': base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')}
+                if thread_id:
+                    body['threadId'] = thread_id
+                try:
+                    sent = self._send_with_retry(user_email, body)
+                except HttpError as e:
+                    if e.resp.status in (401, 403) and not is_retryable(e):
+                        # Credentials may have been revoked or rotated, rebuild on the next send
+                        self._services.pop(user_email)
+                    raise
+            with self._lock:
+                self.sent += 1
+                self._sent_at.append(time.monotonic())
+            logger.info(f"Response email sent. Message Id: {sent['id']}")
+            return sent
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def submit(self, user_email, message, thread_id=None):
+        with self._lock:
+            self.queued += 1
+        return self._executor.submit(contextvars.copy_context().run, self._send, user_email, message, thread_id)
+
+    def send(self, user_email, message, thread_id=None):
+        return self.submit(user_email, message, thread_id).result()
+
+    def stats(self, window=60.0):
+        now = time.monotonic()
+        with self._lock:
+            recent = sum(1 for sent_at in self._sent_at if now - sent_at <= window)
+            return {
+                'sent': self.sent,
+                'failed': self.failed,
+                'retries': self.retries,
+                'queue_depth': self.queued,
+                'in_flight': self.in_flight,
+                'sends_per_second': round(recent / window, 3),
+                'throttled': sum(bucket.waiting for bucket in self._buckets.values()),
+                'services': self._services.stats(),
+            }
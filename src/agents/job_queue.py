@@ -0,0 +1,615 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import Aborted, Conflict
+from google.cloud import datastore
+
+from tracing_helper import LatencyHistogram
+
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_DEAD = 'dead'
+FINAL_STATUSES = (STATUS_DONE, STATUS_DEAD)
+
+worker_count = int(os.environ.get('JOB_WORKERS', '2'))
+lease_seconds = int(os.environ.get('JOB_LEASE_SECONDS', '300'))
+heartbeat_seconds = int(os.environ.get('JOB_HEARTBEAT_SECONDS', '60'))
+max_attempts = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+retry_delay_seconds = int(os.environ.get('JOB_RETRY_DELAY_SECONDS', '30'))
+recovery_interval_seconds = int(os.environ.get('JOB_RECOVERY_INTERVAL_SECONDS', '120'))
+# Backoff cap for workers whose lease call keeps failing (e.g. Datastore unavailable)
+lease_error_max_backoff = int(os.environ.get('JOB_LEASE_ERROR_MAX_BACKOFF_SECONDS', '60'))
+# Attempts at recording a finished job before giving up and logging it
+bookkeeping_attempts = int(os.environ.get('JOB_BOOKKEEPING_ATTEMPTS', '3'))
+# Consecutive jobs taken from a higher priority lane before a lower one gets a turn
+priority_burst = int(os.environ.get('JOB_PRIORITY_BURST', '4'))
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class FifoReadyQueue:
+    # Ready jobs in arrival order. A job with a not_before in the future (a retry that is
+    # backing off) stays queued until that time.
+
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+
+    def put(self, job):
+        heapq.heappush(self._heap, (job.get('not_before', 0), next(self._seq), job))
+
+    def pop_ready(self, now):
+        if self._heap and self._heap[0][0] <= now:
+            return heapq.heappop(self._heap)[2]
+        return None
+
+    def next_ready_at(self):
+        return self._heap[0][0] if self._heap else None
+
+    def depth(self, user=None):
+        if user is None:
+            return len(self._heap)
+        return sum(1 for _, _, job in self._heap if job.get('user') == user)
+
+    def stats(self):
+        return {'queued': len(self._heap)}
+
+    def __len__(self):
+        return len(self._heap)
+
+class FairReadyQueue:
+    # Ready jobs in priority lanes, and within a lane one job per user in turn, so a user
+    # with a hundred queued emails waits behind everyone else's next one instead of in
+    # front of it. Each lane serves `burst` jobs in a row and then gives one turn to the
+    # lanes below it, so every lane keeps moving and PRIORITY_LOW never starves.
+    # Jobs with a not_before in the future wait in a separate heap until they are due.
+
+    def __init__(self, burst=priority_burst):
+        self.burst = burst
+        self._delayed = []
+        self._lanes = {}
+        self._seq = itertools.count()
+        self._streaks = {}
+        self._depth = {}
+        self.wait_latency = LatencyHistogram()
+
+    def put(self, job):
+        heapq.heappush(self._delayed, (job.get('not_before', 0), next(self._seq), job))
+        user = job.get('user')
+        self._depth[user] = self._depth.get(user, 0) + 1
+
+    def pop_ready(self, now):
+        self._promote(now)
+        lane = self._next_lane()
+        if lane is None:
+            return None
+        users = self._lanes[lane]
+        user, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+        if jobs:
+            users.move_to_end(user)
+        else:
+            del users[user]
+        if not users:
+            del self._lanes[lane]
+        self._depth[user] -= 1
+        if not self._depth[user]:
+            del self._depth[user]
+        # Time spent runnable, a retry's backoff is not counted as waiting
+        ready_since = max(job.get('enqueued_at', now), job.get('not_before', 0))
+        self.wait_latency.record(user or 'unknown', max(0.0, now - ready_since))
+        return job
+
+    def next_ready_at(self):
+        if self._lanes:
+            return 0
+        return self._delayed[0][0] if self._delayed else None
+
+    def depth(self, user=None):
+        if user is None:
+            return len(self)
+        return self._depth.get(user, 0)
+
+    def stats(self):
+        return {
+            'queued': len(self),
+            'queued_by_priority': {lane: sum(len(jobs) for jobs in users.values()) for lane, users in sorted(self._lanes.items())},
+            'queued_by_user': dict(self._depth),
+            'wait_by_user': self.wait_latency.snapshot(buckets=False),
+        }
+
+    def __len__(self):
+        return sum(self._depth.values())
+
+    def _promote(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            job = heapq.heappop(self._delayed)[2]
+            users = self._lanes.setdefault(job.get('priority', PRIORITY_NORMAL), OrderedDict())
+            users.setdefault(job.get('user'), deque()).append(job)
+
+    def _next_lane(self):
+        if not self._lanes:
+            return None
+        lanes = sorted(self._lanes)
+        for lane in lanes[:-1]:
+            streak = self._streaks.get(lane, 0)
+            if streak < self.burst:
+                self._streaks[lane] = streak + 1
+                return lane
+            self._streaks[lane] = 0
+        return lanes[-1]
+
+class InMemoryJobQueue:
+    # Local job queue. Jobs are lost when the process exits, use DatastoreJobQueue
+    # when they must survive instance restarts.
+
+    def __init__(self, ready=None):
+        self._ready = ready if ready is not None else FifoReadyQueue()
+        self._jobs = {}
+        self._cond = threading.Condition()
+
+    def enqueue(self, job_id, payload, **fields):
+        # Returns False when the job is already queued, running or done, here or on
+        # another instance
+        with self._cond:
+            if job_id in self._jobs and self._jobs[job_id]['status'] in (STATUS_QUEUED, STATUS_RUNNING):
+                return False
+        job = {
+            'id': job_id,
+            'payload': payload,
+            'status': STATUS_QUEUED,
+            'attempts': 0,
+            'enqueued_at': time.time(),
+            'not_before': 0,
+            **fields,
+        }
+        if not self._insert(job):
+            return False
+        with self._cond:
+            self._jobs[job_id] = job
+            self._ready.put(job)
+            self._cond.notify()
+        return True
+
+    def lease(self, owner, lease_for=lease_seconds, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                job = self._wait_for_ready(deadline)
+            if job is None:
+                return None
+            try:
+                attempts = self._acquire(job, owner, lease_for)
+            except Exception:
+                # Popped but not taken, let recover() find it again rather than stranding it
+                with self._cond:
+                    self._forget(job)
+                raise
+            if attempts is None:
+                # Finished, or held by another instance. Dropping it here means recover()
+                # re-queues it if that instance's lease runs out.
+                with self._cond:
+                    self._forget(job)
+                continue
+            with self._cond:
+                job['status'] = STATUS_RUNNING
+                job['owner'] = owner
+                job['attempts'] = attempts
+                job['started_at'] = time.time()
+                job['lease_expires'] = time.time() + lease_for
+            return job
+
+    def heartbeat(self, job, lease_for=lease_seconds):
+        if job['status'] != STATUS_RUNNING:
+            return False
+        job['lease_expires'] = time.time() + lease_for
+        return self._persist(job, owner=job['owner'])
+
+    def complete(self, job):
+        job['status'] = STATUS_DONE
+        job['finished_at'] = time.time()
+        self._persist(job, owner=job.get('owner'))
+        with self._cond:
+            self._forget(job)
+
+    def fail(self, job, error, attempts_allowed=max_attempts, retry_delay=retry_delay_seconds):
+        owner = job.get('owner')
+        job['error'] = str(error)
+        if job['attempts'] >= attempts_allowed:
+            job['status'] = STATUS_DEAD
+            job['finished_at'] = time.time()
+            self._persist(job, owner=owner)
+            with self._cond:
+                self._forget(job)
+            return STATUS_DEAD
+        job['status'] = STATUS_QUEUED
+        job['owner'] = None
+        # Exponential backoff between attempts
+        job['not_before'] = time.time() + retry_delay * (2 ** (job['attempts'] - 1))
+        if not self._persist(job, owner=owner):
+            with self._cond:
+                self._forget(job)
+            return STATUS_DONE
+        with self._cond:
+            self._ready.put(job)
+            self._cond.notify()
+        return STATUS_QUEUED
+
+    def depth(self, user=None):
+        with self._cond:
+            return self._ready.depth(user)
+
+    def ready_stats(self):
+        with self._cond:
+            return self._ready.stats()
+
+    def recover(self):
+        return 0
+
+    def _wait_for_ready(self, deadline):
+        while True:
+            job = self._ready.pop_ready(time.time())
+            if job is not None and job['status'] == STATUS_QUEUED:
+                return job
+            if job is not None:
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            next_ready_at = self._ready.next_ready_at()
+            if next_ready_at is not None:
+                remaining = min(remaining, max(0.01, next_ready_at - time.time()))
+            self._cond.wait(remaining)
+
+    def _acquire(self, job, owner, lease_for):
+        # Returns the attempt number this lease starts, or None if the job cannot be taken
+        return job['attempts'] + 1
+
+    def _insert(self, job):
+        # Stores a new job unless one with its ID is queued, running or done
+        return True
+
+    def _persist(self, job, owner=None):
+        # With an owner the write only goes through while that owner still holds the job,
+        # and never over DONE or DEAD. Returns False when the write was skipped.
+        return True
+
+    def _forget(self, job):
+        self._jobs.pop(job['id'], None)
+
+class DatastoreJobQueue(InMemoryJobQueue):
+    # Mirrors every job to Datastore. Leases are taken in a transaction so a job recovered
+    # by two instances still only runs once, and recover() re-queues jobs whose owner
+    # stopped heart-beating.
+
+    KIND = 'CrewJob'
+
+    def __init__(self, ready=None, client=None):
+        super().__init__(ready)
+        self._client = client
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = datastore.Client()
+        return self._client
+
+    def recover(self):
+        now = time.time()
+        query = self.client.query(kind=self.KIND)
+        query.add_filter('status', 'IN', [STATUS_QUEUED, STATUS_RUNNING])
+        entities = list(query.fetch())
+        recovered = 0
+        with self._cond:
+            for entity in entities:
+                job_id = entity.key.name
+                if job_id in self._jobs:
+                    continue
+                if entity['status'] == STATUS_RUNNING and entity.get('lease_expires', 0) > now:
+                    continue
+                job = dict(entity)
+                job['id'] = job_id
+                job['status'] = STATUS_QUEUED
+                self._jobs[job_id] = job
+                self._ready.put(job)
+                recovered += 1
+            if recovered:
+                self._cond.notify_all()
+        if recovered:
+            logger.info(f"Recovered {recovered} orphaned jobs")
+        return recovered
+
+    def _acquire(self, job, owner, lease_for):
+        key = self.client.key(self.KIND, job['id'])
+        now = time.time()
+        try:
+            with self.client.transaction():
+                entity = self.client.get(key)
+                if entity is None:
+                    return None
+                if entity['status'] in (STATUS_DONE, STATUS_DEAD):
+                    with self._cond:
+                        self._forget(job)
+                    return None
+                if entity['status'] == STATUS_RUNNING and entity.get('owner') != owner and entity.get('lease_expires', 0) > now:
+                    return None
+                entity['status'] = STATUS_RUNNING
+                entity['owner'] = owner
+                entity['lease_expires'] = now + lease_for
+                entity['attempts'] = max(entity.get('attempts', 0), job['attempts']) + 1
+                self.client.put(entity)
+            return entity['attempts']
+        except (Conflict, Aborted):
+            return None
+
+    def _insert(self, job):
+        job_key = self.client.key(self.KIND, job['id'])
+        try:
+            with self.client.transaction():
+                stored = self.client.get(job_key)
+                if stored is not None and stored['status'] in (STATUS_QUEUED, STATUS_RUNNING, STATUS_DONE):
+                    logger.info(f"Job {job['id']} is already {stored['status']}, not enqueueing it again")
+                    return False
+                self.client.put(self._entity(job_key, job))
+            return True
+        except (Conflict, Aborted):
+            # Another instance enqueued the same job at the same time
+            logger.info(f"Lost enqueue race for job {job['id']}")
+            return False
+
+    def _persist(self, job, owner=None):
+        job_key = self.client.key(self.KIND, job['id'])
+        entity = self._entity(job_key, job)
+        if owner is None:
+            self.client.put(entity)
+            return True
+        with self.client.transaction():
+            stored = self.client.get(job_key)
+            if stored is not None and stored['status'] in FINAL_STATUSES and stored['status'] != job['status']:
+                logger.warning(f"Not overwriting {stored['status']} job {job['id']} with {job['status']}")
+                return False
+            if stored is not None and stored['status'] == STATUS_RUNNING and stored.get('owner') != owner:
+                logger.warning(f"Job {job['id']} is now leased by {stored.get('owner')}, not writing {job['status']}")
+                return False
+            self.client.put(entity)
+        return True
+
+    def _entity(self, job_key, job):
+        entity = datastore.Entity(key=job_key, exclude_from_indexes=('payload', 'error', 'trace_context'))
+        entity.update({key: value for key, value in job.items() if key != 'id'})
+        entity['updated_at'] = datetime.now(timezone.utc)
+        return entity
+
+class JobWorkerPool:
+    def __init__(self, queue, handler, workers=worker_count, on_complete=None, on_dead_letter=None, on_heartbeat=None):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.on_complete = on_complete
+        self.on_dead_letter = on_dead_letter
+        # Called when a job starts and on every heartbeat, to keep leases held elsewhere alive
+        self.on_heartbeat = on_heartbeat
+        self._threads = []
+        self._stop = threading.Event()
+        self._stats_lock = threading.Lock()
+        self.started_at = None
+        self.completed = 0
+        self.bookkeeping_failures = 0
+        self.retried = 0
+        self.dead = 0
+        self.busy = 0
+        self.run_latency = LatencyHistogram()
+
+    def start(self):
+        if self._threads:
+            return
+        self.started_at = time.monotonic()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(f'worker-{index}-{uuid.uuid4().hex[:8]}',),
+                                      name=f'job-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        recovery = threading.Thread(target=self._recover_loop, name='job-recovery', daemon=True)
+        recovery.start()
+        self._threads.append(recovery)
+        logger.info(f"Started {self.workers} job workers")
+
+    def stop(self, timeout=30):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def stats(self):
+        with self._stats_lock:
+            minutes = (time.monotonic() - self.started_at) / 60 if self.started_at else 0
+            return {
+                'workers': self.workers,
+                'busy': self.busy,
+                'queue_depth': self.queue.depth(),
+                'completed': self.completed,
+                'bookkeeping_failures': self.bookkeeping_failures,
+                'retried': self.retried,
+                'dead_lettered': self.dead,
+                'jobs_per_minute': round(self.completed / minutes, 3) if minutes else 0.0,
+                'ready': self.queue.ready_stats(),
+                'run_by_user': self.run_latency.snapshot(buckets=False),
+            }
+
+    def _run(self, owner):
+        lease_failures = 0
+        while not self._stop.is_set():
+            try:
+                job = self.queue.lease(owner, timeout=1.0)
+                lease_failures = 0
+            except Exception as e:
+                # A worker thread that dies here is never replaced, so back off and keep going
+                lease_failures += 1
+                delay = min(lease_error_max_backoff, 2 ** lease_failures)
+                logger.warning(f"Leasing a job failed, retrying in {delay}s: {str(e)}")
+                self._stop.wait(delay)
+                continue
+            if job is None:
+                continue
+            self._count('busy', 1)
+            self._renew(job)
+            heartbeat_stop = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat, args=(job, heartbeat_stop), daemon=True)
+            heartbeat.start()
+            started = time.monotonic()
+            error = None
+            try:
+                self.handler(job)
+            except Exception as e:
+                error = e
+                logger.exception(f"Job {job['id']} failed on attempt {job['attempts']}: {str(e)}")
+            finally:
+                # The heartbeat must not write RUNNING after the final status below
+                heartbeat_stop.set()
+                heartbeat.join()
+                self.run_latency.record(job.get('user') or 'unknown', time.monotonic() - started)
+            try:
+                if error is None:
+                    self._complete(job)
+                else:
+                    self._fail(job, error)
+            finally:
+                self._count('busy', -1)
+
+    def _complete(self, job):
+        # The handler's side effects (the reply) already happened, so a failure to record
+        # that is retried here and never turned into a job retry. The hook still runs when
+        # the DONE write failed, it is what keeps a redelivery from replying again.
+        if self._bookkeeping(job, self.queue.complete, 'marking it done'):
+            self._count('completed', 1)
+        if self.on_complete:
+            self._bookkeeping(job, self.on_complete, 'its completion hook')
+
+    def _bookkeeping(self, job, step, description):
+        for attempt in range(1, bookkeeping_attempts + 1):
+            try:
+                step(job)
+                return True
+            except Exception as e:
+                if attempt == bookkeeping_attempts:
+                    logger.error(f"Job {job['id']} finished but {description} failed: {str(e)}")
+                    self._count('bookkeeping_failures', 1)
+                    return False
+                self._stop.wait(0.5 * 2 ** (attempt - 1))
+
+    def _fail(self, job, error):
+        try:
+            status = self.queue.fail(job, error)
+        except Exception as e:
+            # Still RUNNING in the store, recovery re-queues it once the lease expires
+            logger.error(f"Could not record failure of job {job['id']}: {str(e)}")
+            return
+        if status == STATUS_DEAD:
+            self._count('dead', 1)
+            logger.error(f"Job {job['id']} moved to dead letter after {job['attempts']} attempts")
+            if self.on_dead_letter:
+                try:
+                    self.on_dead_letter(job, error)
+                except Exception as e:
+                    logger.error(f"Dead letter handling for job {job['id']} failed: {str(e)}")
+        elif status == STATUS_QUEUED:
+            self._count('retried', 1)
+
+    def _heartbeat(self, job, stop):
+        while not stop.wait(heartbeat_seconds):
+            try:
+                self.queue.heartbeat(job)
+            except Exception as e:
+                logger.warning(f"Heartbeat for job {job['id']} failed: {str(e)}")
+            self._renew(job)
+
+    def _renew(self, job):
+        if not self.on_heartbeat:
+            return
+        try:
+            self.on_heartbeat(job)
+        except Exception as e:
+            logger.warning(f"Heartbeat hook for job {job['id']} failed: {str(e)}")
+
+    def _recover_loop(self):
+        while True:
+            try:
+                self.queue.recover()
+            except Exception as e:
+                logger.warning(f"Job recovery sweep failed: {str(e)}")
+            if self._stop.wait(recovery_interval_seconds):
+                return
+
+    def _count(self, name, delta):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+def get_job_queue(ready=None):
+    backend = os.environ.get('JOB_QUEUE_BACKEND', 'datastore')
+    if backend == 'memory':
+        return InMemoryJobQueue(ready)
+    if backend == 'datastore':
+        return DatastoreJobQueue(ready)
+    raise ValueError(f"Unknown JOB_QUEUE_BACKEND: {backend}")
+
+
+# Endpoint and worker throughput, then queue wait for light users behind one heavy user,
+# FIFO vs fair: python job_queue.py
+if __name__ == '__main__':
+    def throughput(jobs=200, workers=4, job_seconds=0.05):
+        # The endpoint only enqueues and acks, a crew run (job_seconds here) is the workers' job
+        queue = InMemoryJobQueue(FairReadyQueue())
+        pool = JobWorkerPool(queue, lambda job: time.sleep(job_seconds), workers=workers)
+        started = time.perf_counter()
+        for index in range(jobs):
+            queue.enqueue(f'job-{index}', {'body': 'x' * 2000}, user=f'user-{index % 10}@example.com')
+        enqueue_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        pool.start()
+        while queue.depth() or pool.busy:
+            time.sleep(0.005)
+        drain_seconds = time.perf_counter() - started
+        pool.stop()
+        return jobs / enqueue_seconds, 60 * pool.stats()['completed'] / drain_seconds
+
+    job_seconds = 0.05
+    print(f"crew run in the request: {1 / job_seconds:.0f} requests/s at the endpoint")
+    for workers in (2, 4, 8):
+        requests_per_second, jobs_per_minute = throughput(workers=workers, job_seconds=job_seconds)
+        print(f"queued, {workers} workers: {requests_per_second:.0f} requests/s at the endpoint, {jobs_per_minute:.0f} jobs/min through the workers")
+
+    def simulate(ready, heavy_jobs=60, light_users=5, workers=4, job_seconds=0.01):
+        queue = InMemoryJobQueue(ready)
+        for index in range(heavy_jobs):
+            queue.enqueue(f'heavy-{index}', {}, user='heavy@example.com')
+        for user in range(light_users):
+            priority = PRIORITY_HIGH if user == 0 else PRIORITY_NORMAL
+            queue.enqueue(f'light-{user}', {}, user=f'light-{user}@example.com', priority=priority)
+        waits = {}
+        pool = JobWorkerPool(queue, lambda job: (waits.setdefault(job['user'], time.time() - job['enqueued_at']), time.sleep(job_seconds)), workers=workers)
+        pool.start()
+        while queue.depth() or pool.busy:
+            time.sleep(0.01)
+        pool.stop()
+        light = sorted(wait for user, wait in waits.items() if user.startswith('light'))
+        return 1000 * light[len(light) // 2], 1000 * light[-1], 1000 * waits['heavy@example.com']
+
+    for label, ready in (('fifo', FifoReadyQueue()), ('fair', FairReadyQueue())):
+        median, worst, heavy = simulate(ready)
+        print(f"{label}: light users wait p50 {median:.0f}ms, max {worst:.0f}ms; heavy user's first job waits {heavy:.0f}ms")
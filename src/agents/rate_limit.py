@@ -0,0 +1,96 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+class TokenBucket:
+    # Blocking token bucket: `rate` tokens per second, holding at most `burst`.
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waiting = 0
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            self.waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    self._refill()
+                    if self._tokens >= tokens:
+                        self._tokens -= tokens
+                        return True
+                    wait = (tokens - self._tokens) / self.rate
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+class ConcurrencyLimiter:
+    # Caps how many calls run at once per key (an LLM provider, say). Keys without a
+    # limit run unbounded.
+
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self._semaphores = {key: threading.BoundedSemaphore(limit) for key, limit in self.limits.items() if limit > 0}
+        self._lock = threading.Lock()
+        self._stats = {key: {'in_flight': 0, 'waiting': 0, 'calls': 0, 'wait_seconds': 0.0} for key in self.limits}
+
+    @contextmanager
+    def slot(self, key):
+        semaphore = self._semaphores.get(key)
+        stats = self._stats.setdefault(key, {'in_flight': 0, 'waiting': 0, 'calls': 0, 'wait_seconds': 0.0})
+        started = time.monotonic()
+        if semaphore is not None:
+            with self._lock:
+                stats['waiting'] += 1
+            semaphore.acquire()
+        with self._lock:
+            if semaphore is not None:
+                stats['waiting'] -= 1
+            stats['in_flight'] += 1
+            stats['calls'] += 1
+            stats['wait_seconds'] += time.monotonic() - started
+        try:
+            yield
+        finally:
+            with self._lock:
+                stats['in_flight'] -= 1
+            if semaphore is not None:
+                semaphore.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                key: {
+                    'limit': self.limits.get(key),
+                    'in_flight': stats['in_flight'],
+                    'waiting': stats['waiting'],
+                    'calls': stats['calls'],
+                    'wait_ms_avg': round(1000 * stats['wait_seconds'] / stats['calls'], 1) if stats['calls'] else 0.0,
+                }
+                for key, stats in self._stats.items()
+            }
@@ -0,0 +1,254 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+
+from opentelemetry import trace
+
+
+logger = logging.getLogger(__name__)
+tracer = trace.get_tracer(__name__)
+
+result_sink_backend = os.environ.get('RESULT_SINK_BACKEND', 'firestore')
+result_collection = os.environ.get('RESULT_SINK_COLLECTION', 'processed_emails')
+result_bucket = os.environ.get('RESULT_SINK_BUCKET')
+buffer_size = int(os.environ.get('RESULT_SINK_BUFFER_SIZE', '500'))
+# Firestore batches take at most 500 writes
+batch_size = min(500, int(os.environ.get('RESULT_SINK_BATCH_SIZE', '100')))
+flush_interval = float(os.environ.get('RESULT_SINK_FLUSH_SECONDS', '2'))
+compress_min_bytes = int(os.environ.get('RESULT_SINK_COMPRESS_MIN_BYTES', '1024'))
+# Firestore documents are capped at 1 MiB, bigger reports go to Cloud Storage
+max_inline_bytes = int(os.environ.get('RESULT_SINK_MAX_INLINE_BYTES', str(800 * 1024)))
+write_attempts = int(os.environ.get('RESULT_SINK_WRITE_ATTEMPTS', '3'))
+
+
+class FirestoreResultBackend:
+    def __init__(self, client_factory, collection=result_collection, bucket=result_bucket):
+        self.client_factory = client_factory
+        self.collection = collection
+        self.bucket = bucket
+        self._bucket = None
+
+    def write_batch(self, records):
+        client = self.client_factory()
+        batch = client.batch()
+        for doc_id, record in records:
+            # Keyed on the email id so a retried batch overwrites instead of duplicating
+            batch.set(client.collection(self.collection).document(doc_id), record)
+        batch.commit()
+
+    def offload(self, name, data):
+        if not self.bucket:
+            return None
+        if self._bucket is None:
+            from google.cloud import storage
+            self._bucket = storage.Client().bucket(self.bucket)
+        self._bucket.blob(name).upload_from_string(data, content_type='application/zlib')
+        return f'gs://{self.bucket}/{name}'
+
+class InMemoryResultBackend:
+    # Keeps records in a dict and counts round trips, write_latency simulates the backend
+
+    def __init__(self, write_latency=0.0, offload_enabled=True):
+        self.write_latency = write_latency
+        self.offload_enabled = offload_enabled
+        self.records = {}
+        self.objects = {}
+        self.round_trips = 0
+
+    def write_batch(self, records):
+        time.sleep(self.write_latency)
+        self.round_trips += 1
+        self.records.update(records)
+
+    def offload(self, name, data):
+        if not self.offload_enabled:
+            return None
+        time.sleep(self.write_latency)
+        self.round_trips += 1
+        self.objects[name] = data
+        return f'memory://{name}'
+
+def encode_report(report):
+    data = (report or '').encode('utf-8')
+    if len(data) < compress_min_bytes:
+        return {'response': report}, 0
+    compressed = zlib.compress(data, 6)
+    return {'response_zlib': compressed, 'response_encoding': 'zlib', 'response_bytes': len(data)}, len(data) - len(compressed)
+
+def decode_report(record):
+    if record.get('response_encoding') == 'zlib' and 'response_zlib' in record:
+        return zlib.decompress(record['response_zlib']).decode('utf-8')
+    return record.get('response')
+
+class ResultSink:
+    # Write-behind buffer for audit records: callers enqueue and return, a background
+    # thread compresses the reports and writes them in batches.
+
+    def __init__(self, backend, max_buffer=buffer_size, batch_size=batch_size, flush_interval=flush_interval):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(max_buffer)
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.inline_writes = 0
+        self.offloaded = 0
+        self.bytes_saved = 0
+        self.submit_seconds = 0.0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='result-sink', daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def submit(self, doc_id, record):
+        started = time.perf_counter()
+        try:
+            self._queue.put_nowait((doc_id, record))
+        except queue.Full:
+            # Never drop audit records: with the buffer full the caller writes its own record
+            logger.warning(f"Result buffer full, writing {doc_id} inline")
+            with self._lock:
+                self.inline_writes += 1
+            self._write([(doc_id, record)])
+        with self._lock:
+            self.submitted += 1
+            self.submit_seconds += time.perf_counter() - started
+
+    def _prepare(self, doc_id, record):
+        record = dict(record)
+        encoded, saved = encode_report(record.pop('response', ''))
+        if 'response_zlib' in encoded and len(encoded['response_zlib']) > max_inline_bytes:
+            try:
+                uri = self.backend.offload(f'reports/{doc_id}.txt.zlib', encoded['response_zlib'])
+            except Exception as e:
+                logger.error(f"Failed to offload report for {doc_id}: {str(e)}")
+                uri = None
+            if uri:
+                encoded = {'response_uri': uri, 'response_encoding': 'zlib', 'response_bytes': encoded['response_bytes']}
+                with self._lock:
+                    self.offloaded += 1
+            else:
+                logger.warning(f"Report for {doc_id} is too large to store inline and could not be offloaded, truncating")
+                encoded, saved = encode_report(zlib.decompress(encoded['response_zlib'])[:max_inline_bytes].decode('utf-8', 'ignore'))
+        with self._lock:
+            self.bytes_saved += saved
+        record.update(encoded)
+        return doc_id, record
+
+    def _write(self, items):
+        prepared = [self._prepare(doc_id, record) for doc_id, record in items]
+        for attempt in range(1, write_attempts + 1):
+            try:
+                with tracer.start_as_current_span('result_sink.write_batch', attributes={'batch.size': len(prepared)}):
+                    self.backend.write_batch(prepared)
+                with self._lock:
+                    self.written += len(prepared)
+                    self.batches += 1
+                return
+            except Exception as e:
+                if attempt == write_attempts:
+                    with self._lock:
+                        self.failed += len(prepared)
+                    logger.error(f"Failed to write {len(prepared)} results {[doc_id for doc_id, _ in prepared]}: {str(e)}")
+                    return
+                time.sleep(0.5 * 2 ** (attempt - 1))
+
+    def _drain(self, first=None):
+        items = [] if first is None else [first]
+        while len(items) < self.batch_size:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            # Give concurrent jobs a moment to add to the same batch
+            if self._queue.qsize() + 1 < self.batch_size:
+                self._stop.wait(min(0.1, self.flush_interval))
+            items = self._drain(first)
+            self._write(items)
+            for _ in items:
+                self._queue.task_done()
+
+    def flush(self, timeout=30.0):
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            if self._thread is None or not self._thread.is_alive():
+                items = self._drain()
+                if not items:
+                    break
+                self._write(items)
+                for _ in items:
+                    self._queue.task_done()
+            else:
+                time.sleep(0.05)
+
+    def close(self):
+        self.flush()
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'submitted': self.submitted,
+                'written': self.written,
+                'buffered': self._queue.qsize(),
+                'batches': self.batches,
+                'writes_per_batch': round(self.written / self.batches, 2) if self.batches else 0.0,
+                'failed': self.failed,
+                'inline_writes': self.inline_writes,
+                'offloaded': self.offloaded,
+                'bytes_saved': self.bytes_saved,
+                'submit_us_avg': round(1e6 * self.submit_seconds / self.submitted, 1) if self.submitted else 0.0,
+            }
+
+def get_result_sink(client_factory=None):
+    if result_sink_backend == 'firestore':
+        return ResultSink(FirestoreResultBackend(client_factory))
+    if result_sink_backend == 'memory':
+        return ResultSink(InMemoryResultBackend())
+    raise ValueError(f"Unknown RESULT_SINK_BACKEND: {result_sink_backend}")
+
+
+# Offline comparison of one synchronous write per email with the sink: python result_sink.py
+if __name__ == '__main__':
+    from concurrent.futures import ThreadPoolExecutor
+
+    emails, workers, latency = 200, 8, 0.02
+    report = "## Findings\n" + "Retrieval augmented generation combines search with generation. " * 300
+    records = [(f'email-{i}', {'email_id': f'email-{i}', 'response': report}) for i in range(emails)]
+
+    direct = InMemoryResultBackend(write_latency=latency)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(lambda item: direct.write_batch([item]), records))
+    direct_seconds = time.perf_counter() - started
+
+    buffered = InMemoryResultBackend(write_latency=latency)
+    sink = ResultSink(buffered)
+    sink.start()
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(lambda item: sink.submit(*item), records))
+    sink.flush()
+    stats = sink.stats()
+
+    print(f"direct:   {direct.round_trips} round trips, {1000 * direct_seconds / emails * workers:.2f}ms per request")
+    print(f"buffered: {buffered.round_trips} round trips, {stats['submit_us_avg'] / 1000:.3f}ms per request, "
+          f"{stats['bytes_saved']} bytes saved by compression")
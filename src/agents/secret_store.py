@@ -0,0 +1,50 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import secretmanager
+
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ID = os.environ.get('PROJECT_ID')
+
+_client = None
+_client_lock = threading.Lock()
+_secrets = {}
+_secret_locks = {}
+_locks_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = secretmanager.SecretManagerServiceClient()
+    return _client
+
+def access_secret_version(secret_id, version_id="latest"):
+    name = f"projects/{PROJECT_ID}/secrets/{secret_id}/versions/{version_id}"
+    response = get_client().access_secret_version(request={"name": name})
+    return response.payload.data.decode('UTF-8')
+
+def get_secret(secret_id):
+    # Fetched once per process, concurrent callers for the same secret share the fetch
+    if secret_id in _secrets:
+        return _secrets[secret_id]
+    with _locks_lock:
+        lock = _secret_locks.setdefault(secret_id, threading.Lock())
+    with lock:
+        if secret_id not in _secrets:
+            _secrets[secret_id] = access_secret_version(secret_id)
+            logger.info(f"Secret {secret_id} loaded")
+    return _secrets[secret_id]
+
+def prefetch_secrets(secret_ids):
+    secret_ids = [secret_id for secret_id in secret_ids if secret_id not in _secrets]
+    if not secret_ids:
+        return
+    with ThreadPoolExecutor(max_workers=len(secret_ids)) as executor:
+        list(executor.map(get_secret, secret_ids))
@@ -0,0 +1,90 @@
+import json
+import os
+import re
+import subprocess
+import sys
+
+
+# Cold start cost of the agent service broken down by module: python startup_benchmark.py
+# Every module is imported on its own in a fresh interpreter with -X importtime, so each
+# line is what that module costs a cold instance, including the packages it pulls in.
+MODULES = [
+    'cloud_logging_helper',
+    'tracing_helper',
+    'secret_store',
+    'email_compaction',
+    'triage',
+    'job_queue',
+    'email_dedup',
+    'result_sink',
+    'email_sender',
+    'crews.ai_research_crew.research_cache',
+    'crews.ai_research_crew.research_tools',
+    'crews.ai_research_crew.crew_factory',
+    'crews.ai_research_crew.research_crew',
+    'app',
+]
+HEAVIEST = 3
+
+_IMPORT_TIME = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \| +(\S+)$')
+_MARKER = '--- importing'
+_CHILD = (
+    "import importlib, json, resource, sys, time\n"
+    f"sys.stderr.write('{_MARKER}\\n'); sys.stderr.flush()\n"
+    "started = time.perf_counter()\n"
+    "module = importlib.import_module('{module}')\n"
+    "seconds = time.perf_counter() - started\n"
+    "print(json.dumps([seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, getattr(module, 'startup_timings', {{}})]))\n"
+)
+
+AGENTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# The shared helpers live in src/ and are copied next to the service at build time
+SRC_DIR = os.path.dirname(AGENTS_DIR)
+
+
+def measure(module):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([AGENTS_DIR, SRC_DIR]))
+    child = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', _CHILD.format(module=module)],
+        cwd=AGENTS_DIR, env=env, capture_output=True, text=True,
+    )
+    # Cumulative microseconds per top level package, the outermost import of a package
+    # includes all of its submodules
+    packages = {}
+    errors = []
+    lines = child.stderr.splitlines()
+    # Imports before the marker are interpreter startup, not this module
+    for line in lines[lines.index(_MARKER) + 1 if _MARKER in lines else 0:]:
+        match = _IMPORT_TIME.match(line)
+        if not match:
+            errors.append(line)
+            continue
+        package = match.group(2).split('.')[0]
+        if package != module.split('.')[0]:
+            packages[package] = max(packages.get(package, 0), int(match.group(1)))
+    if child.returncode != 0:
+        errors = [line for line in errors if line.strip()]
+        return None, None, packages, {}, errors[-1][:120] if errors else f'exit code {child.returncode}'
+    # Modules that time their own lazy initialisation (app.startup_timings) report it too
+    seconds, max_rss_kb, init_timings = json.loads(child.stdout.splitlines()[-1])
+    return seconds, max_rss_kb, packages, init_timings, None
+
+def baseline_rss_kb():
+    child = subprocess.run(
+        [sys.executable, '-c', "import resource; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"],
+        capture_output=True, text=True, check=True,
+    )
+    return int(child.stdout)
+
+if __name__ == '__main__':
+    bare = baseline_rss_kb()
+    print(f"bare interpreter: {bare / 1024:.1f} MB RSS")
+    for module in MODULES:
+        seconds, max_rss_kb, packages, init_timings, error = measure(module)
+        heaviest = ', '.join(f"{name} {us / 1e6:.2f}s" for name, us in sorted(packages.items(), key=lambda item: -item[1])[:HEAVIEST])
+        if error:
+            print(f"{module:>40}: failed ({error})")
+        else:
+            print(f"{module:>40}: {seconds:6.2f}s, +{(max_rss_kb - bare) / 1024:6.1f} MB RSS; heaviest: {heaviest}")
+            if init_timings:
+                print(f"{'':>40}  init: " + ', '.join(f"{name} {seconds}s" for name, seconds in init_timings.items()))
@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import re
+import sys
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# 'enforce' skips the crew for bulk and automated mail, 'shadow' only logs the decision.
+# Mail is only ever skipped when a bulk/automated rule fired and the score is below the
+# threshold, an ordinary email with no signals either way always runs.
+triage_mode = os.environ.get('TRIAGE_MODE', 'enforce')
+triage_threshold = float(os.environ.get('TRIAGE_THRESHOLD', '0'))
+# JSON object of rule name to weight, overrides DEFAULT_WEIGHTS. A weight of 0 disables a rule.
+triage_rule_weights = json.loads(os.environ.get('TRIAGE_RULE_WEIGHTS', '{}'))
+# Rough number of LLM calls one crew run makes (parse, planning, research iterations, email)
+LLM_CALLS_PER_CREW = int(os.environ.get('TRIAGE_LLM_CALLS_PER_CREW', '8'))
+
+BULK_PRECEDENCE = {'bulk', 'list', 'junk', 'auto_reply'}
+BULK_LABELS = {'CATEGORY_PROMOTIONS', 'CATEGORY_SOCIAL', 'CATEGORY_UPDATES', 'CATEGORY_FORUMS', 'SPAM'}
+BULK_SENDER_HEADERS = ['X-Campaign', 'X-Mailgun-Tag', 'X-SES-Outgoing', 'Feedback-ID']
+
+_NO_REPLY_SENDER = re.compile(r'\b(?:no-?reply|do-?not-?reply|notifications?|mailer-daemon|postmaster|bounces?)[^@\s]*@', re.IGNORECASE)
+_AUTO_REPLY_SUBJECT = re.compile(
+    r'^(?:auto(?:matic)?[- ]?reply|out of (?:the )?office|undeliverable|delivery status notification'
+    r'|mail delivery (?:failed|failure)|away from)',
+    re.IGNORECASE,
+)
+_TRANSACTIONAL = re.compile(
+    r'\b(?:receipt|invoice|your order|order (?:confirmation|#?\d+)|payment (?:received|confirmation)|shipped'
+    r'|verification code|password reset|sign[- ]in|newsletter|digest|webinar|% off|sale ends)\b',
+    re.IGNORECASE,
+)
+_RESEARCH_TERMS = re.compile(
+    r'\b(?:research|look into|find out|summar(?:y|ise|ize)|overview|compare|comparison|analy[sz]e|analysis'
+    r'|investigate|report on|explain|latest (?:on|in|news)|state of the art|what (?:is|are)|how (?:does|do|to))\b',
+    re.IGNORECASE,
+)
+_REQUEST_PHRASING = re.compile(r"\b(?:can you|could you|would you|please|i'd like|i would like|i need|help me)\b", re.IGNORECASE)
+_URL = re.compile(r'https?://')
+
+
+def _header(email_data, name):
+    name = name.lower()
+    return next((value for key, value in (email_data.get('headers') or {}).items() if key.lower() == name), None)
+
+def _opening(email_data, chars=1500):
+    return f"{email_data.get('subject', '')}\n{(email_data.get('body') or '')[:chars]}"
+
+# Each rule returns True when it fires, its weight is added to the score
+RULES = {
+    'list_unsubscribe': lambda e: _header(e, 'List-Unsubscribe') is not None,
+    'mailing_list': lambda e: _header(e, 'List-Id') is not None or _header(e, 'List-Post') is not None,
+    'auto_submitted': lambda e: (_header(e, 'Auto-Submitted') or 'no').strip().lower() != 'no',
+    'bulk_precedence': lambda e: (_header(e, 'Precedence') or '').strip().lower() in BULK_PRECEDENCE,
+    'auto_reply_header': lambda e: any(_header(e, name) is not None for name in ('X-Autoreply', 'X-Autorespond')),
+    'bulk_sender_header': lambda e: any(_header(e, name) is not None for name in BULK_SENDER_HEADERS),
+    'no_reply_sender': lambda e: bool(_NO_REPLY_SENDER.search(e.get('from', ''))),
+    'bulk_label': lambda e: bool(BULK_LABELS.intersection(e.get('labels') or [])),
+    'auto_reply_subject': lambda e: bool(_AUTO_REPLY_SUBJECT.search(e.get('subject', ''))),
+    'transactional_text': lambda e: bool(_TRANSACTIONAL.search(_opening(e, 500))),
+    'many_links': lambda e: len(_URL.findall(e.get('body') or '')) > 10,
+    'research_terms': lambda e: bool(_RESEARCH_TERMS.search(_opening(e))),
+    'request_phrasing': lambda e: bool(_REQUEST_PHRASING.search(_opening(e))),
+    'question': lambda e: '?' in _opening(e),
+}
+DEFAULT_WEIGHTS = {
+    'list_unsubscribe': -4,
+    'mailing_list': -3,
+    'auto_submitted': -6,
+    'bulk_precedence': -4,
+    'auto_reply_header': -6,
+    'bulk_sender_header': -2,
+    'no_reply_sender': -4,
+    'bulk_label': -3,
+    'auto_reply_subject': -5,
+    'transactional_text': -2,
+    'many_links': -2,
+    'research_terms': 3,
+    'request_phrasing': 2,
+    'question': 1,
+}
+
+
+class TriageResult:
+    def __init__(self, score, threshold, matched, bulk_signals):
+        self.score = score
+        self.threshold = threshold
+        self.matched = matched
+        self.bulk_signals = bulk_signals
+
+    @property
+    def is_research(self):
+        return not self.bulk_signals or self.score >= self.threshold
+
+    def __str__(self):
+        return f"score={self.score} threshold={self.threshold} matched={self.matched}"
+
+class Triage:
+    # Scores an email with header and text rules, no network or LLM calls involved.
+
+    def __init__(self, weights=None, threshold=triage_threshold, mode=triage_mode):
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights if weights is not None else triage_rule_weights))
+        unknown = set(self.weights) - set(RULES)
+        if unknown:
+            raise ValueError(f"Unknown triage rules: {sorted(unknown)}")
+        self.threshold = threshold
+        self.mode = mode
+        self._lock = threading.Lock()
+        self.evaluated = 0
+        self.skipped = 0
+
+    def classify(self, email_data):
+        matched = [name for name, weight in self.weights.items() if weight and RULES[name](email_data)]
+        bulk_signals = [name for name in matched if self.weights[name] < 0]
+        return TriageResult(sum(self.weights[name] for name in matched), self.threshold, matched, bulk_signals)
+
+    def should_run_crew(self, email_data):
+        if self.mode == 'off':
+            return True
+        result = self.classify(email_data)
+        with self._lock:
+            self.evaluated += 1
+            if not result.is_research:
+                self.skipped += 1
+        if result.is_research:
+            logger.info(f"Triage accepted email {email_data.get('id')}: {result}")
+            return True
+        if self.mode == 'enforce':
+            logger.warning(f"Triage skipped email {email_data.get('id')} from {email_data.get('from')}, no reply will be sent: {result}")
+            return False
+        logger.info(f"Triage would skip email {email_data.get('id')} ({self.mode}): {result}")
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'threshold': self.threshold,
+                'evaluated': self.evaluated,
+                'skipped': self.skipped,
+                'llm_calls_avoided': self.skipped * LLM_CALLS_PER_CREW if self.mode == 'enforce' else 0,
+            }
+
+
+def evaluate(triage, labelled):
+    # labelled: iterable of email dicts carrying an 'is_research' ground truth flag
+    true_positive = false_positive = false_negative = true_negative = 0
+    mistakes = []
+    for email_data in labelled:
+        predicted = triage.classify(email_data).is_research
+        actual = bool(email_data['is_research'])
+        if predicted and actual:
+            true_positive += 1
+        elif predicted:
+            false_positive += 1
+        elif actual:
+            false_negative += 1
+        else:
+            true_negative += 1
+        if predicted != actual:
+            mistakes.append((email_data.get('id', email_data.get('subject')), actual, str(triage.classify(email_data))))
+    total = true_positive + false_positive + false_negative + true_negative
+    skipped = true_negative + false_negative
+    return {
+        'emails': total,
+        'precision': round(true_positive / (true_positive + false_positive), 3) if true_positive + false_positive else 0.0,
+        'recall': round(true_positive / (true_positive + false_negative), 3) if true_positive + false_negative else 0.0,
+        'crew_runs_avoided': skipped,
+        'research_requests_dropped': false_negative,
+        'llm_calls_avoided': skipped * LLM_CALLS_PER_CREW,
+        'mistakes': mistakes,
+    }
+
+SAMPLE_EMAILS = [
+    {'subject': 'Research request: RAG evaluation', 'from': 'Jane <jane@example.com>',
+     'body': 'Could you look into how people evaluate retrieval augmented generation these days?', 'is_research': True},
+    {'subject': 'Re: agents', 'from': 'Sam <sam@example.com>',
+     'body': 'Thanks! Can you also compare CrewAI and LangGraph for multi-agent workflows?', 'is_research': True},
+    {'subject': 'quick one', 'from': 'Lee <lee@example.com>',
+     'body': 'What is the state of the art for small open weight LLMs on code tasks?', 'is_research': True},
+    {'subject': 'Kubernetes operators', 'from': 'Kim <kim@example.com>',
+     'body': 'Send me everything worth knowing about Kubernetes operators.', 'is_research': True},
+    {'subject': 'Weekly AI digest', 'from': 'AI Weekly <newsletter@aiweekly.example>',
+     'headers': {'List-Unsubscribe': '<mailto:unsub@aiweekly.example>', 'Precedence': 'bulk'},
+     'labels': ['CATEGORY_PROMOTIONS'], 'body': 'The latest research on LLMs this week...', 'is_research': False},
+    {'subject': 'Automatic reply: research', 'from': 'Pat <pat@example.com>',
+     'headers': {'Auto-Submitted': 'auto-replied'}, 'body': 'I am out of the office until Monday.', 'is_research': False},
+    {'subject': 'Your receipt from Example Store', 'from': 'Example Store <no-reply@store.example>',
+     'labels': ['CATEGORY_UPDATES'], 'body': 'Thanks for your order #1234. Your receipt is attached.', 'is_research': False},
+    {'subject': 'Password reset', 'from': 'Accounts <notifications@service.example>',
+     'body': 'Please use the link below to reset your password.', 'is_research': False},
+]
+
+if __name__ == '__main__':
+    # Offline evaluation: python triage.py [labelled.jsonl], one email dict with 'is_research' per line
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            labelled = [json.loads(line) for line in f if line.strip()]
+    else:
+        labelled = SAMPLE_EMAILS
+    report = evaluate(Triage(), labelled)
+    for mistake in report.pop('mistakes'):
+        print(f"misclassified {mistake[0]!r} (is_research={mistake[1]}): {mistake[2]}")
+    print(json.dumps(report, indent=2))
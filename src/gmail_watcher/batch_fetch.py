@@ -0,0 +1,85 @@
+import logging
+import random
+import time
+from collections import namedtuple
+
+from googleapiclient.errors import HttpError
+
+
+logger = logging.getLogger(__name__)
+
+# Gmail rejects batches with more than 100 calls and recommends staying at or below 50
+MAX_BATCH_SIZE = 100
+DEFAULT_BATCH_SIZE = 50
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+BatchResult = namedtuple('BatchResult', ['results', 'failures', 'round_trips'])
+
+
+def is_retryable(error):
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUSES
+    # Transport level errors (timeouts, resets) are worth another attempt
+    return True
+
+def execute_batch(service, request_factories, batch_size=DEFAULT_BATCH_SIZE, max_attempts=3, backoff_seconds=1.0):
+    # request_factories maps a string key to a callable returning a fresh HttpRequest, so
+    # failed items can be rebuilt and resent without touching the ones that succeeded.
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    results = {}
+    errors = {}
+    pending = list(request_factories)
+    round_trips = 0
+
+    for attempt in range(1, max_attempts + 1):
+        retry_keys = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+                errors.pop(request_id, None)
+                return
+            errors[request_id] = exception
+            if is_retryable(exception):
+                retry_keys.append(request_id)
+
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            batch = service.new_batch_http_request(callback=callback)
+            for key in chunk:
+                batch.add(request_factories[key](), request_id=key)
+            round_trips += 1
+            try:
+                batch.execute()
+            except Exception as e:
+                logger.warning(f"Batch request of {len(chunk)} calls failed: {str(e)}")
+                # Every call without a result goes again and reports this latest failure if it
+                # never succeeds, unless it already got a non-retryable answer such as a 404
+                for key in chunk:
+                    if key not in results and (key not in errors or is_retryable(errors[key])):
+                        errors[key] = e
+                        if key not in retry_keys:
+                            retry_keys.append(key)
+
+        pending = retry_keys
+        if not pending:
+            break
+        if attempt < max_attempts:
+            delay = backoff_seconds * (2 ** (attempt - 1)) + random.uniform(0, backoff_seconds)
+            logger.info(f"Retrying {len(pending)} failed batch calls in {delay:.2f}s (attempt {attempt + 1}/{max_attempts})")
+            time.sleep(delay)
+
+    failures = {key: error for key, error in errors.items() if key not in results}
+    return BatchResult(results, failures, round_trips)
+
+def fetch_messages(service, message_ids, batch_size=DEFAULT_BATCH_SIZE, max_attempts=3, **get_kwargs):
+    get_kwargs.setdefault('format', 'full')
+    messages = service.users().messages()
+    request_factories = {
+        message_id: (lambda message_id=message_id: messages.get(userId='me', id=message_id, **get_kwargs))
+        for message_id in dict.fromkeys(message_ids)
+    }
+    result = execute_batch(service, request_factories, batch_size=batch_size, max_attempts=max_attempts)
+    logger.info(f"Fetched {len(result.results)} of {len(request_factories)} messages in {result.round_trips} batch round trips")
+    return result
+
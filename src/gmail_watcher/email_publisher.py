@@ -0,0 +1,171 @@
+import logging
+import os
+import threading
+import time
+
+from google.cloud import pubsub_v1
+from opentelemetry import trace
+
+
+logger = logging.getLogger(__name__)
+tracer = trace.get_tracer(__name__)
+
+batch_max_messages = int(os.environ.get('PUBLISH_BATCH_MAX_MESSAGES', '100'))
+batch_max_bytes = int(os.environ.get('PUBLISH_BATCH_MAX_BYTES', str(1024 * 1024)))
+batch_max_latency = float(os.environ.get('PUBLISH_BATCH_MAX_LATENCY', '0.05'))
+flow_control_max_messages = int(os.environ.get('PUBLISH_FLOW_CONTROL_MAX_MESSAGES', '1000'))
+flow_control_max_bytes = int(os.environ.get('PUBLISH_FLOW_CONTROL_MAX_BYTES', str(10 * 1024 * 1024)))
+publish_timeout = float(os.environ.get('PUBLISH_TIMEOUT', '60'))
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+class PublishError(Exception):
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__(f"Failed to publish {len(failures)} messages: {failures}")
+
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                batch_settings = pubsub_v1.types.BatchSettings(
+                    max_messages=batch_max_messages,
+                    max_bytes=batch_max_bytes,
+                    max_latency=batch_max_latency,
+                )
+                flow_control = pubsub_v1.types.PublishFlowControl(
+                    message_limit=flow_control_max_messages,
+                    byte_limit=flow_control_max_bytes,
+                    limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+                )
+                _publisher = pubsub_v1.PublisherClient(
+                    batch_settings=batch_settings,
+                    publisher_options=pubsub_v1.types.PublisherOptions(flow_control=flow_control),
+                )
+                logger.info("Pub/Sub publisher created")
+    return _publisher
+
+class PendingPublishes:
+    # Collects publish futures so a sync run can await them together instead of
+    # blocking on every message.
+
+    def __init__(self):
+        self._futures = []
+
+    def __len__(self):
+        return len(self._futures)
+
+    def add(self, key, future):
+        self._futures.append((key, future, time.monotonic()))
+
+    def wait(self, timeout=publish_timeout):
+        if not self._futures:
+            return {}
+        started = time.monotonic()
+        published = {}
+        failures = {}
+        with tracer.start_as_current_span('pubsub.publish_wait', attributes={'pubsub.messages': len(self._futures)}):
+            for key, future, _ in self._futures:
+                try:
+                    published[key] = future.result(timeout=timeout)
+                except Exception as e:
+                    logger.error(f"Failed to publish message {key}: {str(e)}")
+                    failures[key] = e
+        oldest = min(queued_at for _, _, queued_at in self._futures)
+        logger.info(
+            f"Published {len(published)} of {len(self._futures)} messages "
+            f"in {time.monotonic() - oldest:.3f}s (waited {time.monotonic() - started:.3f}s)"
+        )
+        self._futures = []
+        if failures:
+            raise PublishError(failures)
+        return published
+
+
+
+# Publish benchmark: python email_publisher.py
+# Runs against the Pub/Sub emulator when PUBSUB_EMULATOR_HOST is set, otherwise against an
+# in-process Publish endpoint that adds PUBLISH_BENCH_LATENCY seconds to every RPC. Both
+# paths go through the real client, so its batching and flow control are what is measured.
+def _fake_publish_server(latency):
+    from concurrent import futures
+    import grpc
+    from google.pubsub_v1.types import PublishRequest, PublishResponse
+
+    batch_sizes = []
+    ids = iter(range(1, 1 << 62))
+
+    def publish(request, context):
+        time.sleep(latency)
+        batch_sizes.append(len(request.messages))
+        return PublishResponse(message_ids=[str(next(ids)) for _ in request.messages])
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=32))
+    server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler('google.pubsub.v1.Publisher', {
+        'Publish': grpc.unary_unary_rpc_method_handler(
+            publish, request_deserializer=PublishRequest.deserialize, response_serializer=PublishResponse.serialize,
+        ),
+    }),))
+    port = server.add_insecure_port('localhost:0')
+    server.start()
+    return server, f'localhost:{port}', batch_sizes
+
+def _benchmark(messages=500):
+    import json
+    import uuid
+
+    latency = float(os.environ.get('PUBLISH_BENCH_LATENCY', '0.01'))
+    server = None
+    batch_sizes = None
+    if not os.environ.get('PUBSUB_EMULATOR_HOST'):
+        server, os.environ['PUBSUB_EMULATOR_HOST'], batch_sizes = _fake_publish_server(latency)
+        print(f"fake Publish endpoint at {os.environ['PUBSUB_EMULATOR_HOST']}, {1000 * latency:.0f}ms per RPC")
+    else:
+        print(f"Pub/Sub emulator at {os.environ['PUBSUB_EMULATOR_HOST']}")
+    topic = pubsub_v1.PublisherClient.topic_path('bench', f'parsed-emails-{uuid.uuid4().hex[:8]}')
+    if server is None:
+        pubsub_v1.PublisherClient().create_topic(name=topic)
+    payload = json.dumps({'subject': 'Research request', 'from': 'someone@example.com',
+                          'body': 'Please look into retrieval augmented generation. ' * 40}).encode('utf-8')
+
+    def report(name, elapsed, latencies):
+        latencies = sorted(latencies)
+        line = (f"{name:>7}: {messages / elapsed:8.0f} msg/s, publish latency "
+                f"p50 {1000 * latencies[len(latencies) // 2]:.1f}ms p95 {1000 * latencies[int(len(latencies) * 0.95)]:.1f}ms")
+        if batch_sizes is not None:
+            line += f", {len(batch_sizes)} RPCs of {sum(batch_sizes) / max(1, len(batch_sizes)):.1f} messages"
+            batch_sizes.clear()
+        print(line)
+
+    # Before: a new client per message and a blocking result() on each publish
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(messages):
+        sent = time.perf_counter()
+        pubsub_v1.PublisherClient().publish(topic, payload).result()
+        latencies.append(time.perf_counter() - sent)
+    report('before', time.perf_counter() - started, latencies)
+
+    # After: the shared batching publisher, futures awaited once at the end of the run
+    publisher = get_publisher()
+    latencies = []
+    pending = PendingPublishes()
+    started = time.perf_counter()
+    for i in range(messages):
+        sent = time.perf_counter()
+        future = publisher.publish(topic, payload)
+        future.add_done_callback(lambda _, sent=sent: latencies.append(time.perf_counter() - sent))
+        pending.add(i, future)
+    pending.wait()
+    report('after', time.perf_counter() - started, latencies)
+
+    publisher.stop()
+    if server is not None:
+        server.stop(None)
+
+if __name__ == '__main__':
+    _benchmark()
@@ -0,0 +1,88 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
+
+
+logger = logging.getLogger(__name__)
+
+
+class GmailServiceCache:
+    # Process-wide cache of delegated credentials and Gmail services keyed by user email.
+    # build_service(user_email) returns a (credentials, service) tuple. Entries expire after
+    # ttl_seconds and the least recently used one is evicted once max_size is reached.
+
+    def __init__(self, build_service, max_size=100, ttl_seconds=3000):
+        self.build_service = build_service
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_email):
+        entry = self._lookup(user_email)
+        if entry is None:
+            credentials, service = self.build_service(user_email)
+            entry = {'credentials': credentials, 'service': service, 'created': time.monotonic()}
+            self._store(user_email, entry)
+        self._refresh_if_needed(user_email, entry['credentials'])
+        return entry['service']
+
+    def invalidate(self, user_email):
+        with self._lock:
+            if self._entries.pop(user_email, None) is not None:
+                self.invalidations += 1
+                logger.info(f"Invalidated cached Gmail service for user: {user_email}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+    def _lookup(self, user_email):
+        with self._lock:
+            entry = self._entries.get(user_email)
+            if entry is not None and time.monotonic() - entry['created'] < self.ttl_seconds:
+                self._entries.move_to_end(user_email)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                del self._entries[user_email]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def _store(self, user_email, entry):
+        with self._lock:
+            self._entries[user_email] = entry
+            self._entries.move_to_end(user_email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _refresh_if_needed(self, user_email, credentials):
+        if credentials.valid:
+            return
+        try:
+            credentials.refresh(Request())
+        except RefreshError:
+            self.invalidate(user_email)
+            raise
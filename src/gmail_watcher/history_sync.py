@@ -0,0 +1,61 @@
+import logging
+from collections import namedtuple
+
+
+logger = logging.getLogger(__name__)
+
+# cursor is the history ID that is safe to checkpoint once every message of the page has
+# been handled: the last record on intermediate pages, the mailbox historyId on the last one.
+HistoryPage = namedtuple('HistoryPage', ['message_ids', 'cursor', 'is_last'])
+
+
+def iter_history_pages(service, start_history_id, page_size=500):
+    page_token = None
+    while True:
+        request = {
+            'userId': 'me',
+            'startHistoryId': start_history_id,
+            'historyTypes': ['messageAdded'],
+            'maxResults': page_size,
+        }
+        if page_token:
+            request['pageToken'] = page_token
+        changes = service.users().history().list(**request).execute()
+        logger.debug("Response from history().list(): %s", changes)
+        history_list = changes.get('history', [])
+        page_token = changes.get('nextPageToken')
+        logger.info(f"Found {len(history_list)} changes (more pages: {bool(page_token)})")
+
+        message_ids = []
+        for change in history_list:
+            logger.debug("Processing change: %s", change)
+            for message in change.get('messagesAdded', []):
+                message_ids.append(message['message']['id'])
+
+        if page_token:
+            cursor = history_list[-1]['id'] if history_list else None
+        else:
+            cursor = changes.get('historyId')
+        yield HistoryPage(list(dict.fromkeys(message_ids)), cursor, page_token is None)
+
+        if not page_token:
+            return
+
+def iter_message_id_pages(service, query=None, label_ids=('INBOX',), page_size=500):
+    page_token = None
+    while True:
+        request = {
+            'userId': 'me',
+            'labelIds': list(label_ids),
+            'maxResults': page_size,
+            'fields': 'messages/id,nextPageToken',
+        }
+        if query:
+            request['q'] = query
+        if page_token:
+            request['pageToken'] = page_token
+        response = service.users().messages().list(**request).execute()
+        yield [message['id'] for message in response.get('messages', [])]
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return
@@ -1,19 +1,26 @@
 import base64
-import re
-import html
 import json
-from google.cloud import pubsub_v1
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
 from google.cloud import secretmanager
 import os
 import logging
 import sys
+from collections import deque
+from functools import lru_cache
 from google.auth.exceptions import RefreshError
 from googleapiclient.errors import HttpError
 from tenacity import retry, stop_after_attempt, wait_exponential
-from google.cloud import datastore
-from watcher_cloud_logging_helper import setup_logging
+from cloud_logging_helper import flush_logging, setup_logging
+from tracing_helper import flush_traces, inject_context, setup_tracing, stage_latency
+from gmail_service_cache import GmailServiceCache
+from batch_fetch import fetch_messages
+from history_sync import iter_history_pages, iter_message_id_pages
+from email_publisher import PendingPublishes, get_publisher
+from mime_extract import extract_text, get_header
+from partial_fetch import fetch_partial_messages
+from single_flight import run_single_flight
+from state_store import get_state_store
 
 
 SCOPES = ['https://mail.google.com/']
@@ -22,27 +29,31 @@ secrets_project_id = os.environ.get('SECRETS_PROJECT_ID')
 secret_id = os.environ.get('SECRET_ID')
 pull_topic_name = os.environ.get('PULL_TOPIC_NAME')
 push_topic_name = os.environ.get('PUSH_TOPIC_NAME').split('/')[-1]  # Extract only the topic name
+service_cache_size = int(os.environ.get('GMAIL_SERVICE_CACHE_SIZE', '100'))
+service_cache_ttl = int(os.environ.get('GMAIL_SERVICE_CACHE_TTL', '3000'))
+fetch_batch_size = int(os.environ.get('FETCH_BATCH_SIZE', '50'))
+seen_ids_limit = int(os.environ.get('SEEN_IDS_LIMIT', '1000'))
+resync_max_messages = int(os.environ.get('RESYNC_MAX_MESSAGES', '500'))
+resync_slack_seconds = int(os.environ.get('RESYNC_SLACK_SECONDS', '3600'))
+max_body_chars = int(os.environ.get('MAX_BODY_CHARS', '100000'))
+# 'partial' downloads headers and MIME structure first, then only the text parts that fit
+# in FETCH_BODY_BYTE_BUDGET. 'full' downloads every message with format='full'.
+fetch_mode = os.environ.get('FETCH_MODE', 'partial')
+fetch_body_byte_budget = int(os.environ.get('FETCH_BODY_BYTE_BUDGET', str(256 * 1024)))
+# Headers forwarded to the agent service so it can triage bulk and automated mail cheaply
+TRIAGE_HEADERS = [
+    'List-Unsubscribe', 'List-Id', 'List-Post', 'Auto-Submitted', 'Precedence',
+    'X-Autoreply', 'X-Autorespond', 'X-Campaign', 'X-Mailgun-Tag', 'X-SES-Outgoing', 'Feedback-ID',
+]
 
 # Set this environment variable to suppress the Abseil warning
 os.environ['ABSL_LOGGING_MODULE_INTERCEPT_LEVEL'] = 'fatal'
 
 logger = setup_logging()
+tracer = setup_tracing('gmail-watcher')
 
+state_store = get_state_store()
 
-def get_last_history_id(user_email):
-    client = datastore.Client()
-    key = client.key('LastProcessedHistoryId', user_email)
-    entity = client.get(key)
-    if entity:
-        return entity['history_id']
-    return None
-
-def update_last_history_id(user_email, history_id):
-    client = datastore.Client()
-    key = client.key('LastProcessedHistoryId', user_email)
-    entity = datastore.Entity(key=key)
-    entity['history_id'] = history_id
-    client.put(entity)
 
 def access_secret_version(version_id="latest"):
     logging.info(f"Accessing secret version: {secret_id}")
@@ -52,23 +63,37 @@ def access_secret_version(version_id="latest"):
     logger.info("Secret accessed successfully")
     return response.payload.data.decode('UTF-8')
 
+@lru_cache(maxsize=1)
+def get_service_account_info():
+    return json.loads(access_secret_version())
+
+def build_gmail_service(user_email):
+    logger.info(f"Building Gmail service for user: {user_email}")
+    creds = service_account.Credentials.from_service_account_info(
+        get_service_account_info(),
+        scopes=SCOPES
+    )
+    delegated_creds = creds.with_subject(user_email)
+    service = build('gmail', 'v1', credentials=delegated_creds)
+    logger.info("Gmail service created successfully")
+    return delegated_creds, service
+
+service_cache = GmailServiceCache(build_gmail_service, max_size=service_cache_size, ttl_seconds=service_cache_ttl)
+
+def invalidate_gmail_service(user_email):
+    service_cache.invalidate(user_email)
+    # The service account key may have been rotated, re-read it on the next build
+    get_service_account_info.cache_clear()
+
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
 def get_gmail_service(user_email):
     logger.info(f"Getting Gmail service for user: {user_email}")
     try:
-        service_account_info = json.loads(access_secret_version())
-        
-        creds = service_account.Credentials.from_service_account_info(
-            service_account_info,
-            scopes=SCOPES
-        )
-        delegated_creds = creds.with_subject(user_email)
-        service = build('gmail', 'v1', credentials=delegated_creds)
-        logger.info("Gmail service created successfully")
-        return service
+        return service_cache.get(user_email)
     except RefreshError as e:
         logger.error(f"RefreshError: {str(e)}")
         logger.error("This error suggests issues with token refresh. Check service account permissions and domain-wide delegation.")
+        get_service_account_info.cache_clear()
         raise
     except Exception as e:
         logger.error(f"Failed to create Gmail service: {str(e)}")
@@ -97,7 +122,7 @@ def check_and_renew_watch(service, user_email):
     logger.info(f"Checking Gmail watch status for user: {user_email}")
     try:
         response = service.users().getProfile(userId='me').execute()
-        logger.info(f"Get Profile response: {response}")
+        logger.debug("Get Profile response: %s", response)
         if 'historyId' in response:
             logger.info("Gmail watch is active")
             return True
@@ -117,66 +142,102 @@ def process_email(message_id, user_email):
     logger.info(f"Processing email with ID: {message_id} for user: {user_email}")
     service = get_gmail_service(user_email)
     msg = service.users().messages().get(userId='me', id=message_id, format='full').execute()
+    pending = PendingPublishes()
+    publish_email(msg, user_email, pending)
+    pending.wait()
+
+def publish_email(msg, user_email, pending):
     email_content = extract_email_content(msg)
+    headers = {name: get_header(msg['payload'], name) for name in TRIAGE_HEADERS}
     email_data = {
         'id': msg['id'],
         'user_email': user_email,
         'subject': next((header['value'] for header in msg['payload']['headers'] if header['name'].lower() == 'subject'), 'No Subject'),
         'from': next((header['value'] for header in msg['payload']['headers'] if header['name'].lower() == 'from'), 'Unknown Sender'),
-        'body': email_content
+        'body': email_content,
+        'labels': msg.get('labelIds', []),
+        # Threading details so the reply lands in the same conversation
+        'thread_id': msg.get('threadId'),
+        'message_id': get_header(msg['payload'], 'Message-ID'),
+        'references': get_header(msg['payload'], 'References'),
+        'headers': {name: value for name, value in headers.items() if value is not None},
     }
-    publish_message(email_data)
-    logger.info(f"Email {message_id} processed and published")
+    pending.add(msg['id'], publish_message(email_data))
+    logger.info(f"Email {msg['id']} processed and queued for publishing")
+
+def process_emails(service, message_ids, user_email, pending):
+    if not message_ids:
+        return
+    logger.info(f"Batch fetching {len(message_ids)} emails for user: {user_email}")
+    with tracer.start_as_current_span('gmail.fetch', attributes={'gmail.messages': len(message_ids), 'gmail.fetch_mode': fetch_mode}):
+        if fetch_mode == 'partial':
+            result = fetch_partial_messages(service, message_ids, fetch_body_byte_budget, batch_size=fetch_batch_size)
+        else:
+            result = fetch_messages(service, message_ids, batch_size=fetch_batch_size)
+    unrecoverable = {}
+    for message_id, error in result.failures.items():
+        if isinstance(error, HttpError) and error.resp.status == 404:
+            # Deleted between the history record and the fetch, nothing to publish
+            logger.info(f"Email {message_id} no longer exists, skipping")
+        else:
+            unrecoverable[message_id] = error
+    for message_id in message_ids:
+        if message_id in result.results:
+            with tracer.start_as_current_span('email.publish', attributes={'email.id': message_id}):
+                publish_email(result.results[message_id], user_email, pending)
+    if unrecoverable:
+        raise RuntimeError(f"Failed to fetch {len(unrecoverable)} emails: {unrecoverable}")
 
 def extract_email_content(msg):
     logger.info("Extracting email content")
-    
-    def decode_part(part):
-        if part.get('body') and part['body'].get('data'):
-            return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-        return ''
-
-    def get_text_parts(payload, content_type='text/plain'):
-        if 'parts' in payload:
-            return [part for part in payload['parts'] if part['mimeType'] == content_type]
-        elif payload['mimeType'] == content_type:
-            return [payload]
-        return []
-
-    text_parts = get_text_parts(msg['payload'])
-    if not text_parts:
-        # Fallback to HTML if no plain text
-        text_parts = get_text_parts(msg['payload'], 'text/html')
-
-    content = ' '.join(decode_part(part) for part in text_parts)
-    
-    # If content was HTML, convert to plain text
-    if text_parts and text_parts[0]['mimeType'] == 'text/html':
-        content = html.unescape(content)
-        content = re.sub('<[^<]+?>', '', content)  # Remove HTML tags
-    
-    # Clean up the content
-    content = re.sub(r'\r\n|\r|\n', ' ', content)  # Replace newlines with spaces
-    content = re.sub(r'\s+', ' ', content)  # Replace multiple spaces with single space
-    content = content.strip()  # Remove leading/trailing whitespace
-    
+    with tracer.start_as_current_span('email.extract'):
+        content = extract_text(msg['payload'], max_body_chars)
     logger.info("Email content extracted and cleaned successfully")
     return content
 
 def publish_message(message):
     logger.info("Publishing message to Pub/Sub")
-    publisher = pubsub_v1.PublisherClient()
+    publisher = get_publisher()
     topic_path = publisher.topic_path(project_id, push_topic_name)
-    future = publisher.publish(topic_path, json.dumps(message).encode('utf-8'))
-    logger.info(f'Published message ID: {future.result()}')
+    # The trace context rides along as message attributes so the agent service continues the trace
+    return publisher.publish(topic_path, json.dumps(message).encode('utf-8'), **inject_context())
+
+def full_resync(service, user_email, state, current_history_id, seen_ids, pending):
+    # The stored historyId is too old for history().list, so diff the recent INBOX against
+    # the IDs already published instead of replaying the whole mailbox.
+    query = None
+    if state and state.get('updated_at'):
+        query = f"after:{int(state['updated_at']) - resync_slack_seconds}"
+    logger.info(f"Running full resync for user: {user_email} with query: {query}")
+
+    seen = set(seen_ids)
+    missing = []
+    for message_ids in iter_message_id_pages(service, query=query):
+        missing.extend(message_id for message_id in message_ids if message_id not in seen)
+        if len(missing) >= resync_max_messages:
+            missing = missing[:resync_max_messages]
+            logger.warning(f"Full resync capped at {resync_max_messages} messages")
+            break
+
+    # messages().list returns newest first, publish oldest first like the history path
+    missing.reverse()
+    for start in range(0, len(missing), fetch_batch_size):
+        chunk = missing[start:start + fetch_batch_size]
+        process_emails(service, chunk, user_email, pending)
+        seen_ids.extend(chunk)
+    pending.wait()
+    state_store.advance(user_email, current_history_id, seen_ids)
+    logger.info(f"Full resync published {len(missing)} emails")
 
 def fetch_changes(history_id, user_email):
     logger.info(f"Fetching changes since history ID: {history_id} for user: {user_email}")
     service = get_gmail_service(user_email)
     try:
-        last_processed_history_id = get_last_history_id(user_email)
-        if last_processed_history_id:
-            history_id = last_processed_history_id
+        state = state_store.get(user_email)
+        if state:
+            history_id = state['history_id']
+        pending = PendingPublishes()
+        seen_ids = deque(state.get('seen_message_ids', []) if state else [], maxlen=seen_ids_limit)
 
         profile = service.users().getProfile(userId='me').execute()
         current_history_id = profile['historyId']
@@ -184,31 +245,49 @@ def fetch_changes(history_id, user_email):
         
         if int(current_history_id) > int(history_id):
             logger.info("Current history ID is greater than the last processed history ID. Fetching changes...")
-            
-            while True:
-                changes = service.users().history().list(userId='me', startHistoryId=history_id).execute()
-                logger.info(f"Response from history().list(): {changes}")
-                
-                history_list = changes.get('history', [])
-                logger.info(f"Found {len(history_list)} changes")
-                
-                for change in history_list:
-                    logger.info(f"Processing change: {change}")
-                    for message in change.get('messagesAdded', []):
-                        process_email(message['message']['id'], user_email)
-                
-                if 'nextPageToken' not in changes:
-                    break
-                history_id = changes['historyId']
-            
-            update_last_history_id(user_email, current_history_id)
+            try:
+                for page in iter_history_pages(service, history_id):
+                    process_emails(service, page.message_ids, user_email, pending)
+                    seen_ids.extend(page.message_ids)
+                    # Checkpoint every page so a crash resumes after the last committed one.
+                    # The cursor only moves once the page's publishes are confirmed.
+                    if page.cursor:
+                        pending.wait()
+                        if not state_store.advance(user_email, page.cursor, seen_ids):
+                            logger.info(f"Another sync is ahead of history ID {page.cursor} for user: {user_email}, stopping")
+                            break
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                logger.warning(f"History ID {history_id} has expired for user: {user_email}")
+                full_resync(service, user_email, state, current_history_id, seen_ids, pending)
+            pending.wait()
             logger.info("All changes processed successfully")
         else:
             logger.info("No new changes to process.")
+    except RefreshError as e:
+        logger.error(f"RefreshError while fetching changes: {str(e)}")
+        invalidate_gmail_service(user_email)
+        raise
     except Exception as e:
         logger.error(f"Failed to fetch or process changes: {str(e)}")
         raise
 
+def handle_notification(data):
+    # Shared by the Cloud Function entry point and the streaming-pull worker
+    user_email = data.get('emailAddress')
+    history_id = data.get('historyId')
+    
+    if not user_email or not history_id:
+        logger.error("User email or history ID not found in the Pub/Sub message")
+        return False
+
+    logger.info(f"Received history ID: {history_id} for user: {user_email}")
+    with tracer.start_as_current_span('watcher.notification', attributes={'user.email': user_email, 'gmail.history_id': str(history_id)}):
+        # Bursts of notifications for one mailbox collapse into a single sync
+        run_single_flight(state_store, user_email, history_id, lambda history_id: fetch_changes(history_id, user_email))
+    return True
+
 def pubsub_push(event, context):
     print("Function started", file=sys.stderr)
     logger.info("Function started")
@@ -217,16 +296,15 @@ def pubsub_push(event, context):
         data = json.loads(pubsub_message)
         logger.info(f"Received Pub/Sub message data: {data}")
         
-        user_email = data.get('emailAddress')
-        history_id = data.get('historyId')
-        
-        if not user_email or not history_id:
-            logger.error("User email or history ID not found in the Pub/Sub message")
-            return    
-
-        logger.info(f"Received history ID: {history_id} for user: {user_email}")
-        fetch_changes(history_id, user_email)
+        if not handle_notification(data):
+            return
+        logger.info(f"Gmail service cache stats: {service_cache.stats()}")
+        logger.info(f"Stage latency: {stage_latency.snapshot()}")
         logger.info("Pub/Sub push processing completed")
     except Exception as e:
         logger.error(f"Error in pubsub_push: {str(e)}")
-        raise
\ No newline at end of file
+        raise
+    finally:
+        # The instance may be frozen right after returning, export spans and logs first
+        flush_traces()
+        flush_logging()
\ No newline at end of file
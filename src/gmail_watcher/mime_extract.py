@@ -0,0 +1,196 @@
+import base64
+import binascii
+import re
+from html.parser import HTMLParser
+
+
+DEFAULT_MAX_CHARS = 100000
+FEED_CHUNK_CHARS = 64 * 1024
+
+_CHARSET = re.compile(r'charset="?([\w.:-]+)"?', re.IGNORECASE)
+_INLINE_WHITESPACE = re.compile(r'[^\S\n]+')
+_LINE_EDGES = re.compile(r' ?\n ?')
+_BLANK_LINES = re.compile(r'\n{3,}')
+
+# Tags whose text is never part of the readable body
+_SKIPPED_TAGS = {'script', 'style', 'head', 'title', 'noscript', 'template'}
+_BLOCK_TAGS = {
+    'p', 'div', 'br', 'tr', 'li', 'ul', 'ol', 'table', 'section', 'article', 'header', 'footer',
+    'blockquote', 'pre', 'hr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+}
+
+
+class HTMLTextExtractor(HTMLParser):
+    # Streaming HTML to text conversion: text is collected as the parser walks the
+    # document, so there is no tag-stripping regex to backtrack over large bodies.
+
+    def __init__(self, max_chars):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.chunks = []
+        self.length = 0
+        self._skip_depth = 0
+
+    @property
+    def full(self):
+        return self.length >= self.max_chars
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in _BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in _SKIPPED_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in _BLOCK_TAGS:
+            self._append('\n')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._append(data)
+
+    def _append(self, text):
+        if not self.full:
+            self.chunks.append(text)
+            self.length += len(text)
+
+def html_to_text(markup, max_chars=DEFAULT_MAX_CHARS):
+    parser = HTMLTextExtractor(max_chars)
+    for start in range(0, len(markup), FEED_CHUNK_CHARS):
+        parser.feed(markup[start:start + FEED_CHUNK_CHARS])
+        if parser.full:
+            break
+    else:
+        parser.close()
+    return ''.join(parser.chunks)
+
+def get_header(part, name):
+    name = name.lower()
+    return next((header['value'] for header in part.get('headers', []) if header['name'].lower() == name), None)
+
+def is_attachment(part):
+    if part.get('filename'):
+        return True
+    disposition = get_header(part, 'Content-Disposition')
+    return bool(disposition and disposition.lower().startswith('attachment'))
+
+def select_text_parts(payload):
+    # Walks the MIME tree and returns the leaf parts that make up the readable body:
+    # every branch of multipart/mixed and related, but only the best alternative of a
+    # multipart/alternative (text/plain over text/html).
+    mime_type = payload.get('mimeType', '').lower()
+    if mime_type.startswith('multipart/'):
+        children = [part for part in payload.get('parts', []) if not is_attachment(part)]
+        if mime_type == 'multipart/alternative':
+            alternatives = [select_text_parts(part) for part in children]
+            alternatives = [parts for parts in alternatives if parts]
+            for parts in alternatives:
+                if all(part['mimeType'].lower() == 'text/plain' for part in parts):
+                    return parts
+            return alternatives[-1] if alternatives else []
+        selected = []
+        for part in children:
+            selected.extend(select_text_parts(part))
+        return selected
+    if mime_type in ('text/plain', 'text/html') and not is_attachment(payload):
+        return [payload]
+    return []
+
+def decode_part(part, data=None):
+    data = data if data is not None else part.get('body', {}).get('data')
+    if not data:
+        return ''
+    try:
+        raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    except (binascii.Error, ValueError):
+        return ''
+    content_type = get_header(part, 'Content-Type') or ''
+    match = _CHARSET.search(content_type)
+    charset = match.group(1) if match else 'utf-8'
+    try:
+        return raw.decode(charset, errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+def normalize_text(text):
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    text = _INLINE_WHITESPACE.sub(' ', text)
+    text = _LINE_EDGES.sub('\n', text)
+    return _BLANK_LINES.sub('\n\n', text).strip()
+
+def part_to_text(part, max_chars=DEFAULT_MAX_CHARS, data=None):
+    text = decode_part(part, data)
+    if part['mimeType'].lower() == 'text/html':
+        return html_to_text(text, max_chars)
+    return text[:max_chars]
+
+def extract_text(payload, max_chars=DEFAULT_MAX_CHARS):
+    chunks = []
+    remaining = max_chars
+    for part in select_text_parts(payload):
+        if remaining <= 0:
+            break
+        text = part_to_text(part, remaining)
+        chunks.append(text)
+        remaining -= len(text)
+    return normalize_text('\n'.join(chunks))[:max_chars]
+
+
+
+# Corpus benchmark against the old one-level, regex based extraction: python mime_extract.py
+def _regex_extract(payload):
+    import html
+
+    def text_parts(content_type):
+        if 'parts' in payload:
+            return [part for part in payload['parts'] if part['mimeType'] == content_type]
+        return [payload] if payload['mimeType'] == content_type else []
+
+    parts = text_parts('text/plain') or text_parts('text/html')
+    content = ' '.join(decode_part(part) for part in parts)
+    if parts and parts[0]['mimeType'] == 'text/html':
+        content = re.sub('<[^<]+?>', '', html.unescape(content))
+    content = re.sub(r'\r\n|\r|\n', ' ', content)
+    return re.sub(r'\s+', ' ', content).strip()
+
+def _corpus():
+    def part(mime_type, text, **extra):
+        data = base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+        return {'mimeType': mime_type, 'filename': '', 'headers': [], 'body': {'data': data}, **extra}
+
+    def multipart(mime_type, *parts):
+        return {'mimeType': mime_type, 'filename': '', 'headers': [], 'body': {}, 'parts': list(parts)}
+
+    paragraph = 'Could you research retrieval augmented generation and long context evaluation? '
+    row = ('<tr><td style="padding:8px"><a href="https://example.com/story?id={i}">Story {i}</a></td>'
+           '<td><p>A &amp; B announce results <b>today</b>, with details &gt; below.</p></td></tr>')
+    newsletter = ('<html><head><style>td {{ color: #333 }}</style></head><body><table>'
+                  + ''.join(row.format(i=i) for i in range(400)) + '</table><script>track()</script></body></html>')
+    huge = newsletter.replace('<table>', '<table>' + ''.join(row.format(i=i) for i in range(20000)), 1)
+    return {
+        'plain': part('text/plain', paragraph * 20),
+        'html newsletter': part('text/html', newsletter),
+        'nested multipart': multipart('multipart/mixed',
+                                      multipart('multipart/alternative', part('text/plain', paragraph * 20), part('text/html', newsletter)),
+                                      part('application/pdf', 'x' * 50000, filename='report.pdf')),
+        'huge html': part('text/html', huge),
+    }
+
+if __name__ == '__main__':
+    import time
+
+    for name, payload in _corpus().items():
+        results = {}
+        for label, extract in (('regex', _regex_extract), ('extractor', extract_text)):
+            runs = 3 if name == 'huge html' else 50
+            started = time.perf_counter()
+            for _ in range(runs):
+                text = extract(payload)
+            results[label] = (1000 * (time.perf_counter() - started) / runs, len(text))
+        print(f"{name:>16}: " + ', '.join(f"{label} {ms:8.2f}ms -> {chars:>7} chars" for label, (ms, chars) in results.items()))
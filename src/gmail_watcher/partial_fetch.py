@@ -0,0 +1,150 @@
+import logging
+
+from batch_fetch import BatchResult, DEFAULT_BATCH_SIZE, execute_batch, fetch_messages
+from mime_extract import is_attachment
+
+
+logger = logging.getLogger(__name__)
+
+MAX_PART_DEPTH = 5
+
+
+def _part_fields(depth):
+    fields = 'partId,mimeType,filename,headers,body(size,attachmentId)'
+    if depth > 1:
+        fields += f',parts({_part_fields(depth - 1)})'
+    return fields
+
+# Headers and MIME structure with part sizes but no body data, so the text part to
+# download can be chosen before any body bytes are transferred
+STRUCTURE_FIELDS = f'id,threadId,labelIds,sizeEstimate,payload({_part_fields(MAX_PART_DEPTH)})'
+
+
+def _iter_parts(part):
+    yield part
+    for child in part.get('parts', []):
+        yield from _iter_parts(child)
+
+def _size(parts):
+    return sum(part.get('body', {}).get('size', 0) for part in parts)
+
+def part_depth(part):
+    # The payload is partId '' at depth 0, '0' is depth 1, '0.1' depth 2 and so on
+    part_id = part.get('partId', '')
+    return part_id.count('.') + 1 if part_id else 0
+
+def is_truncated(payload):
+    # The field mask stops MAX_PART_DEPTH levels down, deeper multiparts come back without parts
+    return any(part.get('mimeType', '').lower().startswith('multipart/') and not part.get('parts')
+               for part in _iter_parts(payload))
+
+def choose_parts(payload, byte_budget):
+    # The text parts that make up the body within byte_budget decoded bytes: of a
+    # multipart/alternative the plain text version if it fits, otherwise the smallest
+    # alternative that does, and of mixed and related messages every body part in order
+    # while the budget lasts. Attachments and parts over the budget are skipped.
+    mime_type = payload.get('mimeType', '').lower()
+    if mime_type.startswith('multipart/'):
+        children = [part for part in payload.get('parts', []) if not is_attachment(part)]
+        if mime_type == 'multipart/alternative':
+            options = [parts for parts in (choose_parts(part, byte_budget) for part in children) if parts]
+            plain = [parts for parts in options if all(part['mimeType'].lower() == 'text/plain' for part in parts)]
+            return min(plain or options, key=_size) if options else []
+        chosen = []
+        for part in children:
+            chosen.extend(choose_parts(part, byte_budget - _size(chosen)))
+        return chosen
+    if mime_type not in ('text/plain', 'text/html') or is_attachment(payload):
+        return []
+    size = payload.get('body', {}).get('size', 0)
+    if size > byte_budget:
+        logger.info(f"Not downloading {mime_type} part {payload.get('partId')} of {size} bytes, over the {byte_budget} byte budget")
+        return []
+    return [payload]
+
+def data_fields(depths, depth=0):
+    # Field mask for the body data of the parts at the given depths. A mask cannot pick
+    # single array elements, so siblings at the same depth come along.
+    fields = ['partId']
+    if depth in depths:
+        fields.append('body/data')
+    if any(wanted > depth for wanted in depths):
+        fields.append(f'parts({data_fields(depths, depth + 1)})')
+    return ','.join(fields)
+
+def decoded_size(data):
+    # Gmail returns unpadded base64url, four characters per three bytes
+    return len(data) * 3 // 4
+
+def fetch_partial_messages(service, message_ids, byte_budget, batch_size=DEFAULT_BATCH_SIZE, max_attempts=3):
+    fetched = fetch_messages(
+        service, message_ids, batch_size=batch_size, max_attempts=max_attempts,
+        format='full', fields=STRUCTURE_FIELDS,
+    )
+    messages = fetched.results
+    failures = dict(fetched.failures)
+    round_trips = fetched.round_trips
+
+    truncated = [message_id for message_id, msg in messages.items() if is_truncated(msg['payload'])]
+    if truncated:
+        logger.warning(f"MIME trees deeper than {MAX_PART_DEPTH} levels in {truncated}, refetching them in full")
+        refetched = fetch_messages(service, truncated, batch_size=batch_size, max_attempts=max_attempts, format='full')
+        round_trips += refetched.round_trips
+        failures.update(refetched.failures)
+        for message_id in truncated:
+            messages.pop(message_id)
+    else:
+        refetched = None
+
+    users_messages = service.users().messages()
+    request_factories = {}
+    wanted = {}
+    for message_id, msg in messages.items():
+        wanted[message_id] = choose_parts(msg['payload'], byte_budget)
+        inline = [part for part in wanted[message_id] if not part['body'].get('attachmentId') and part['body'].get('size')]
+        if inline:
+            fields = f'payload({data_fields({part_depth(part) for part in inline})})'
+            request_factories[message_id] = (
+                lambda message_id=message_id, fields=fields: users_messages.get(userId='me', id=message_id, format='full', fields=fields)
+            )
+        for part in wanted[message_id]:
+            if part['body'].get('attachmentId'):
+                request_factories[f'{message_id}:{part.get("partId", "")}'] = (
+                    lambda message_id=message_id, attachment_id=part['body']['attachmentId']: users_messages.attachments().get(
+                        userId='me', messageId=message_id, id=attachment_id, fields='data'
+                    )
+                )
+
+    bodies = execute_batch(service, request_factories, batch_size=batch_size, max_attempts=max_attempts)
+    round_trips += bodies.round_trips
+
+    results = {}
+    total_saved = 0
+    for message_id, msg in messages.items():
+        body_failures = [error for key, error in bodies.failures.items() if key.split(':', 1)[0] == message_id]
+        if body_failures:
+            failures[message_id] = body_failures[0]
+            continue
+        received = {}
+        if message_id in bodies.results:
+            received = {part.get('partId', ''): part['body']['data']
+                        for part in _iter_parts(bodies.results[message_id]['payload']) if part.get('body', {}).get('data')}
+        downloaded = sum(map(decoded_size, received.values()))
+        for part in wanted[message_id]:
+            key = f'{message_id}:{part.get("partId", "")}'
+            if key in bodies.results:
+                part['body']['data'] = bodies.results[key]['data']
+                downloaded += decoded_size(part['body']['data'])
+            elif part.get('partId', '') in received:
+                part['body']['data'] = received[part.get('partId', '')]
+        # Both sides in decoded bytes, sizeEstimate is the size of the whole message
+        saved = max(0, int(msg.get('sizeEstimate', 0)) - downloaded)
+        total_saved += saved
+        logger.info(f"Email {message_id}: downloaded {downloaded} body bytes, saved about {saved} bytes")
+        results[message_id] = msg
+
+    if refetched is not None:
+        results.update(refetched.results)
+
+    logger.info(f"Partial fetch of {len(results)} emails saved about {total_saved} bytes in {round_trips} round trips")
+    return BatchResult(results, failures, round_trips)
@@ -0,0 +1,111 @@
+import logging
+import os
+import socket
+import time
+import uuid
+
+from state_store import SYNC_BUSY, SYNC_COVERED
+
+
+logger = logging.getLogger(__name__)
+
+# The platform kills an invocation at the function timeout, the lease outlives it by a
+# margin so a killed sync's lease expires soon after instead of blocking the mailbox
+function_timeout_seconds = int(os.environ.get('FUNCTION_TIMEOUT_SECONDS', '90'))
+sync_lease_margin_seconds = int(os.environ.get('SYNC_LEASE_MARGIN_SECONDS', '30'))
+sync_lease_seconds = int(os.environ.get('SYNC_LEASE_SECONDS', str(function_timeout_seconds + sync_lease_margin_seconds)))
+# Wait before a follow-up round so the rest of a notification burst folds into it
+sync_debounce_seconds = float(os.environ.get('SYNC_DEBOUNCE_SECONDS', '2'))
+sync_max_rounds = int(os.environ.get('SYNC_MAX_ROUNDS', '5'))
+
+
+def new_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def run_single_flight(store, user_email, history_id, sync, owner=None, lease_seconds=sync_lease_seconds,
+                      debounce_seconds=sync_debounce_seconds, max_rounds=sync_max_rounds):
+    # Runs sync(history_id) unless the notification is already covered by the stored
+    # cursor or another invocation holds the mailbox's lease. Returns the begin_sync outcome.
+    owner = owner or new_owner()
+    status = store.begin_sync(user_email, history_id, owner, lease_seconds)
+    if status == SYNC_COVERED:
+        logger.info(f"History ID {history_id} for {user_email} is already synced, dropping notification")
+        return status
+    if status == SYNC_BUSY:
+        logger.info(f"Sync for {user_email} already running, folded history ID {history_id} into it")
+        return status
+
+    try:
+        for _ in range(max_rounds):
+            sync(history_id)
+            pending = store.end_sync(user_email, owner, lease_seconds)
+            if pending is None:
+                return status
+            logger.info(f"Notifications up to history ID {pending} arrived during the sync for {user_email}, syncing again")
+            # Only a burst that is already underway is worth waiting for
+            if debounce_seconds:
+                time.sleep(debounce_seconds)
+            history_id = pending
+        logger.warning(f"Sync for {user_email} hit {max_rounds} rounds, leaving the rest to the next notification")
+    finally:
+        store.release_sync(user_email, owner)
+    return status
+
+
+# Replays a notification burst against a simulated mailbox: python single_flight.py
+if __name__ == '__main__':
+    import threading
+    from state_store import SQLiteStateStore
+
+    class SimulatedMailbox:
+        def __init__(self, store, user_email, sync_seconds=0.05):
+            self.store = store
+            self.user_email = user_email
+            self.sync_seconds = sync_seconds
+            self.history_id = 100
+            self.messages = {}
+            self.api_calls = 0
+            self.publishes = []
+            self._lock = threading.Lock()
+
+        def receive(self):
+            with self._lock:
+                self.history_id += 1
+                self.messages[self.history_id] = f'msg-{self.history_id}'
+                return str(self.history_id)
+
+        def sync(self, notified_history_id):
+            # getProfile, one history().list page and one batched get, like fetch_changes
+            state = self.store.get(self.user_email)
+            start = int(state['history_id']) if state else int(notified_history_id) - 1
+            with self._lock:
+                current = self.history_id
+                new = [self.messages[h] for h in range(start + 1, current + 1)]
+                self.api_calls += 3
+                self.publishes.extend(new)
+            time.sleep(self.sync_seconds)
+            self.store.advance(self.user_email, current)
+
+    def replay(single_flight, burst=20, spacing=0.01):
+        store = SQLiteStateStore()
+        mailbox = SimulatedMailbox(store, 'user@example.com')
+        store.advance(mailbox.user_email, mailbox.history_id)
+        threads = []
+        for _ in range(burst):
+            history_id = mailbox.receive()
+            if single_flight:
+                target = lambda history_id=history_id: run_single_flight(store, mailbox.user_email, history_id, mailbox.sync, debounce_seconds=0.1)
+            else:
+                target = lambda history_id=history_id: mailbox.sync(history_id)
+            thread = threading.Thread(target=target)
+            thread.start()
+            threads.append(thread)
+            time.sleep(spacing)
+        for thread in threads:
+            thread.join()
+        duplicates = len(mailbox.publishes) - len(set(mailbox.publishes))
+        return mailbox.api_calls, len(mailbox.publishes), duplicates, len(set(mailbox.publishes)) == burst
+
+    for label, single_flight in (('per notification', False), ('single flight', True)):
+        api_calls, publishes, duplicates, complete = replay(single_flight)
+        print(f"{label:>16}: {api_calls:>3} API calls, {publishes:>3} publishes, {duplicates:>3} duplicates, all messages published: {complete}")
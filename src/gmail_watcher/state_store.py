@@ -0,0 +1,367 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from google.cloud import datastore
+
+
+logger = logging.getLogger(__name__)
+
+KIND = 'LastProcessedHistoryId'
+LEASE_KIND = 'MailboxSyncLease'
+# begin_sync outcomes
+SYNC_ACQUIRED = 'acquired'
+SYNC_BUSY = 'busy'
+SYNC_COVERED = 'covered'
+# Datastore caps lookups at 1000 keys and writes at 500 entities per call
+GET_BATCH_SIZE = 1000
+PUT_BATCH_SIZE = 500
+
+
+def _is_forward(current, history_id):
+    return current is None or int(history_id) >= int(current)
+
+def _is_covered(current, history_id):
+    return current is not None and int(history_id) <= int(current)
+
+def _max_history_id(*history_ids):
+    history_ids = [int(history_id) for history_id in history_ids if history_id is not None]
+    return str(max(history_ids)) if history_ids else None
+
+class DatastoreStateStore:
+    # Sync cursors in Datastore. Writes are compare-and-set inside a transaction and
+    # only ever move a mailbox's historyId forward.
+
+    def __init__(self, client=None):
+        self._client = client
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = datastore.Client()
+        return self._client
+
+    def get(self, user_email):
+        entity = self.client.get(self.client.key(KIND, user_email))
+        return dict(entity) if entity else None
+
+    def get_many(self, user_emails):
+        states = {}
+        user_emails = list(user_emails)
+        for start in range(0, len(user_emails), GET_BATCH_SIZE):
+            keys = [self.client.key(KIND, user_email) for user_email in user_emails[start:start + GET_BATCH_SIZE]]
+            for entity in self.client.get_multi(keys):
+                states[entity.key.name] = dict(entity)
+        return states
+
+    def advance(self, user_email, history_id, seen_message_ids=None):
+        key = self.client.key(KIND, user_email)
+        with self.client.transaction():
+            entity = self.client.get(key)
+            if entity and not _is_forward(entity.get('history_id'), history_id):
+                logger.info(f"Not moving history ID for {user_email} back from {entity['history_id']} to {history_id}")
+                return False
+            self.client.put(self._entity(key, entity, history_id, seen_message_ids))
+        return True
+
+    def put_many(self, history_ids):
+        # history_ids maps user email to history ID. Returns the users whose cursor moved.
+        advanced = []
+        items = list(history_ids.items())
+        for start in range(0, len(items), PUT_BATCH_SIZE):
+            chunk = dict(items[start:start + PUT_BATCH_SIZE])
+            keys = [self.client.key(KIND, user_email) for user_email in chunk]
+            with self.client.transaction():
+                existing = {entity.key.name: entity for entity in self.client.get_multi(keys)}
+                entities = []
+                for key in keys:
+                    entity = existing.get(key.name)
+                    if entity and not _is_forward(entity.get('history_id'), chunk[key.name]):
+                        continue
+                    entities.append(self._entity(key, entity, chunk[key.name]))
+                    advanced.append(key.name)
+                if entities:
+                    self.client.put_multi(entities)
+        return advanced
+
+    def seed_many(self, history_ids):
+        # Writes a first cursor for the users that have none, an existing cursor is never
+        # touched. Returns the users that were seeded.
+        seeded = []
+        items = list(history_ids.items())
+        for start in range(0, len(items), PUT_BATCH_SIZE):
+            chunk = dict(items[start:start + PUT_BATCH_SIZE])
+            keys = [self.client.key(KIND, user_email) for user_email in chunk]
+            with self.client.transaction():
+                existing = {entity.key.name for entity in self.client.get_multi(keys)}
+                entities = [self._entity(key, None, chunk[key.name]) for key in keys if key.name not in existing]
+                if entities:
+                    self.client.put_multi(entities)
+            seeded.extend(entity.key.name for entity in entities)
+        return seeded
+
+    def begin_sync(self, user_email, history_id, owner, lease_seconds):
+        # One sync per mailbox at a time. Notifications that arrive while another instance
+        # holds the lease only raise its pending_history_id for it to pick up.
+        cursor_key = self.client.key(KIND, user_email)
+        lease_key = self.client.key(LEASE_KIND, user_email)
+        now = time.time()
+        with self.client.transaction():
+            cursor = self.client.get(cursor_key)
+            lease = self.client.get(lease_key)
+            if cursor and _is_covered(cursor.get('history_id'), history_id):
+                return SYNC_COVERED
+            if lease is None:
+                lease = datastore.Entity(key=lease_key)
+            lease['pending_history_id'] = _max_history_id(lease.get('pending_history_id'), history_id)
+            if lease.get('owner') and lease['owner'] != owner and lease.get('lease_expires', 0) > now:
+                self.client.put(lease)
+                return SYNC_BUSY
+            lease['owner'] = owner
+            lease['lease_expires'] = now + lease_seconds
+            self.client.put(lease)
+        return SYNC_ACQUIRED
+
+    def end_sync(self, user_email, owner, lease_seconds):
+        # Returns the pending history ID when notifications arrived that the finished sync
+        # did not cover, the caller keeps the lease and syncs again. Otherwise releases it.
+        cursor_key = self.client.key(KIND, user_email)
+        lease_key = self.client.key(LEASE_KIND, user_email)
+        with self.client.transaction():
+            cursor = self.client.get(cursor_key)
+            lease = self.client.get(lease_key)
+            if lease is None or lease.get('owner') != owner:
+                return None
+            pending = lease.get('pending_history_id')
+            if pending and not _is_covered(cursor.get('history_id') if cursor else None, pending):
+                lease['lease_expires'] = time.time() + lease_seconds
+                self.client.put(lease)
+                return pending
+            lease['owner'] = None
+            lease['pending_history_id'] = None
+            self.client.put(lease)
+        return None
+
+    def release_sync(self, user_email, owner):
+        lease_key = self.client.key(LEASE_KIND, user_email)
+        with self.client.transaction():
+            lease = self.client.get(lease_key)
+            if lease is not None and lease.get('owner') == owner:
+                lease['owner'] = None
+                self.client.put(lease)
+
+    def _entity(self, key, existing, history_id, seen_message_ids=None):
+        entity = datastore.Entity(key=key, exclude_from_indexes=('seen_message_ids',))
+        if existing:
+            entity.update(existing)
+        entity['history_id'] = str(history_id)
+        entity['updated_at'] = time.time()
+        if seen_message_ids is not None:
+            entity['seen_message_ids'] = list(seen_message_ids)
+        return entity
+
+class SQLiteStateStore:
+    # Local backend with the same semantics, for running the watcher without the
+    # Datastore emulator. Defaults to an in-memory database.
+
+    def __init__(self, path=':memory:'):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS sync_state ('
+            'user_email TEXT PRIMARY KEY, history_id INTEGER NOT NULL, '
+            'updated_at REAL NOT NULL, seen_message_ids TEXT)'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS sync_lease ('
+            'user_email TEXT PRIMARY KEY, owner TEXT, lease_expires REAL NOT NULL DEFAULT 0, '
+            'pending_history_id INTEGER)'
+        )
+
+    def get(self, user_email):
+        return self.get_many([user_email]).get(user_email)
+
+    def get_many(self, user_emails):
+        user_emails = list(user_emails)
+        states = {}
+        with self._lock:
+            for start in range(0, len(user_emails), GET_BATCH_SIZE):
+                chunk = user_emails[start:start + GET_BATCH_SIZE]
+                rows = self._conn.execute(
+                    f'SELECT user_email, history_id, updated_at, seen_message_ids FROM sync_state '
+                    f'WHERE user_email IN ({",".join("?" * len(chunk))})',
+                    chunk,
+                ).fetchall()
+                for user_email, history_id, updated_at, seen_message_ids in rows:
+                    state = {'history_id': str(history_id), 'updated_at': updated_at}
+                    if seen_message_ids is not None:
+                        state['seen_message_ids'] = json.loads(seen_message_ids)
+                    states[user_email] = state
+        return states
+
+    def advance(self, user_email, history_id, seen_message_ids=None):
+        with self._lock:
+            return self._advance(user_email, history_id, seen_message_ids)
+
+    def put_many(self, history_ids):
+        advanced = []
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                for user_email, history_id in history_ids.items():
+                    if self._advance(user_email, history_id, None):
+                        advanced.append(user_email)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return advanced
+
+    def seed_many(self, history_ids):
+        seeded = []
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                for user_email, history_id in history_ids.items():
+                    cursor = self._conn.execute(
+                        'INSERT INTO sync_state (user_email, history_id, updated_at) VALUES (?, ?, ?) '
+                        'ON CONFLICT(user_email) DO NOTHING',
+                        (user_email, int(history_id), time.time()),
+                    )
+                    if cursor.rowcount > 0:
+                        seeded.append(user_email)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return seeded
+
+    def begin_sync(self, user_email, history_id, owner, lease_seconds):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                current, lease_owner, lease_expires, pending = self._sync_row(user_email)
+                if _is_covered(current, history_id):
+                    status = SYNC_COVERED
+                elif lease_owner and lease_owner != owner and lease_expires > now:
+                    status = SYNC_BUSY
+                else:
+                    status = SYNC_ACQUIRED
+                    lease_owner, lease_expires = owner, now + lease_seconds
+                if status != SYNC_COVERED:
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO sync_lease (user_email, owner, lease_expires, pending_history_id) VALUES (?, ?, ?, ?)',
+                        (user_email, lease_owner, lease_expires, int(_max_history_id(pending, history_id))),
+                    )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return status
+
+    def end_sync(self, user_email, owner, lease_seconds):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                current, lease_owner, _, pending = self._sync_row(user_email)
+                if lease_owner != owner:
+                    pending = None
+                elif pending is not None and not _is_covered(current, pending):
+                    self._conn.execute('UPDATE sync_lease SET lease_expires = ? WHERE user_email = ?', (time.time() + lease_seconds, user_email))
+                    pending = str(pending)
+                else:
+                    self._conn.execute('UPDATE sync_lease SET owner = NULL, pending_history_id = NULL WHERE user_email = ?', (user_email,))
+                    pending = None
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return pending
+
+    def release_sync(self, user_email, owner):
+        with self._lock:
+            self._conn.execute('UPDATE sync_lease SET owner = NULL WHERE user_email = ? AND owner = ?', (user_email, owner))
+
+    def _sync_row(self, user_email):
+        row = self._conn.execute(
+            'SELECT s.history_id, l.owner, COALESCE(l.lease_expires, 0), l.pending_history_id FROM (SELECT ? AS user_email) u '
+            'LEFT JOIN sync_state s ON s.user_email = u.user_email LEFT JOIN sync_lease l ON l.user_email = u.user_email',
+            (user_email,),
+        ).fetchone()
+        return row
+
+    def _advance(self, user_email, history_id, seen_message_ids):
+        seen = json.dumps(list(seen_message_ids)) if seen_message_ids is not None else None
+        cursor = self._conn.execute(
+            'INSERT INTO sync_state (user_email, history_id, updated_at, seen_message_ids) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(user_email) DO UPDATE SET history_id = excluded.history_id, '
+            'updated_at = excluded.updated_at, '
+            'seen_message_ids = COALESCE(excluded.seen_message_ids, sync_state.seen_message_ids) '
+            'WHERE excluded.history_id >= sync_state.history_id',
+            (user_email, int(history_id), time.time(), seen),
+        )
+        return cursor.rowcount > 0
+
+def get_state_store():
+    backend = os.environ.get('STATE_STORE_BACKEND', 'datastore')
+    if backend == 'sqlite':
+        return SQLiteStateStore(os.environ.get('STATE_STORE_SQLITE_PATH', ':memory:'))
+    if backend == 'datastore':
+        return DatastoreStateStore()
+    raise ValueError(f"Unknown STATE_STORE_BACKEND: {backend}")
+
+
+
+# Local benchmark on an SQLite file, no Datastore emulator needed: python state_store.py
+# Compares the old pattern (a new client and a blind overwrite per call) with the store's
+# reused connection, per-user compare-and-set and batched get_many/put_many.
+def _benchmark(users=2000):
+    import tempfile
+
+    emails = [f'user{i}@example.com' for i in range(users)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'state.db')
+        store = SQLiteStateStore(path)
+        results = {}
+
+        started = time.perf_counter()
+        for i, user_email in enumerate(emails):
+            conn = sqlite3.connect(path)
+            conn.execute('INSERT OR REPLACE INTO sync_state (user_email, history_id, updated_at) VALUES (?, ?, ?)',
+                         (user_email, 1000 + i, time.time()))
+            conn.commit()
+            conn.close()
+        results['blind put per call'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i, user_email in enumerate(emails):
+            store.advance(user_email, 2000 + i)
+        results['advance per user'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        store.put_many({user_email: 3000 + i for i, user_email in enumerate(emails)})
+        results['put_many'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for user_email in emails:
+            conn = sqlite3.connect(path)
+            conn.execute('SELECT history_id FROM sync_state WHERE user_email = ?', (user_email,)).fetchone()
+            conn.close()
+        results['get per call'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        store.get_many(emails)
+        results['get_many'] = time.perf_counter() - started
+
+    for name, elapsed in results.items():
+        print(f"{name:>19}: {1e6 * elapsed / users:8.1f} us per user, {users / elapsed:9.0f} users/s")
+
+if __name__ == '__main__':
+    _benchmark()
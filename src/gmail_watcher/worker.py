@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+
+# Importing main sets up logging, tracing, the state store and the warm client caches
+import main
+from cloud_logging_helper import flush_logging
+from tracing_helper import flush_traces, stage_latency
+
+
+logger = logging.getLogger(__name__)
+
+subscription_name = os.environ.get('EMAIL_UPDATES_SUBSCRIPTION', 'email_updates-sub').split('/')[-1]
+worker_concurrency = int(os.environ.get('WORKER_CONCURRENCY', '16'))
+# Leased but unprocessed messages, a little above the concurrency keeps the executor busy
+worker_max_messages = int(os.environ.get('WORKER_MAX_MESSAGES', str(worker_concurrency * 2)))
+worker_max_bytes = int(os.environ.get('WORKER_MAX_BYTES', str(10 * 1024 * 1024)))
+# Upper bound on how long the client keeps extending a message's ack deadline
+worker_max_lease_seconds = int(os.environ.get('WORKER_MAX_LEASE_SECONDS', '600'))
+worker_min_lease_extension = int(os.environ.get('WORKER_MIN_LEASE_EXTENSION_SECONDS', '60'))
+worker_shutdown_seconds = float(os.environ.get('WORKER_SHUTDOWN_SECONDS', '30'))
+worker_stats_interval = float(os.environ.get('WORKER_STATS_INTERVAL_SECONDS', '60'))
+
+
+class WorkerStats:
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._lags = deque(maxlen=window)
+        self._done_at = deque(maxlen=window)
+        self.started_at = time.monotonic()
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = 0
+
+    def start(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def record(self, lag_seconds, ok):
+        with self._lock:
+            self.in_flight -= 1
+            if ok:
+                self.processed += 1
+            else:
+                self.failed += 1
+            self._lags.append(lag_seconds)
+            self._done_at.append(time.monotonic())
+
+    def snapshot(self, rate_window=60.0):
+        now = time.monotonic()
+        with self._lock:
+            lags = sorted(self._lags)
+            recent = sum(1 for done_at in self._done_at if now - done_at <= rate_window)
+            window = min(rate_window, now - self.started_at) or 1.0
+            return {
+                'processed': self.processed,
+                'failed': self.failed,
+                'in_flight': self.in_flight,
+                'notifications_per_second': round(recent / window, 3),
+                'lag_p50_seconds': round(lags[len(lags) // 2], 3) if lags else 0.0,
+                'lag_p95_seconds': round(lags[int(len(lags) * 0.95)], 3) if lags else 0.0,
+                'lag_max_seconds': round(lags[-1], 3) if lags else 0.0,
+            }
+
+stats = WorkerStats()
+
+
+def handle_message(message):
+    stats.start()
+    ok = False
+    try:
+        data = json.loads(message.data.decode('utf-8'))
+        logger.debug("Received Pub/Sub message data: %s", data)
+        main.handle_notification(data)
+        message.ack()
+        ok = True
+    except Exception as e:
+        logger.exception(f"Failed to handle notification {message.message_id}: {str(e)}")
+        # Redelivered after the subscription's retry delay
+        message.nack()
+    finally:
+        # End-to-end lag, from Gmail publishing the notification to the sync finishing
+        stats.record(time.time() - message.publish_time.timestamp(), ok)
+
+def run():
+    subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(main.project_id, subscription_name)
+    flow_control = pubsub_v1.types.FlowControl(
+        max_messages=worker_max_messages,
+        max_bytes=worker_max_bytes,
+        max_lease_duration=worker_max_lease_seconds,
+        min_duration_per_lease_extension=worker_min_lease_extension,
+    )
+    executor = ThreadPoolExecutor(max_workers=worker_concurrency, thread_name_prefix='notification')
+    streaming_pull = subscriber.subscribe(
+        subscription_path, callback=handle_message, flow_control=flow_control,
+        scheduler=ThreadScheduler(executor=executor),
+        # cancel() only resolves once the running callbacks have returned, so their acks go out
+        await_callbacks_on_shutdown=True,
+    )
+    logger.info(f"Streaming pull from {subscription_path} with {worker_concurrency} workers")
+
+    stopping = threading.Event()
+
+    def shutdown(signum, frame):
+        logger.info(f"Received signal {signum}, draining in-flight notifications")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    try:
+        while not stopping.wait(worker_stats_interval):
+            if streaming_pull.done():
+                # The stream failed, surface the error and let the platform restart us
+                streaming_pull.result()
+            logger.info(f"Worker stats: {stats.snapshot()}, cache: {main.service_cache.stats()}")
+            logger.info(f"Stage latency: {stage_latency.snapshot()}")
+    finally:
+        # Stop leasing new messages, then give the running syncs time to finish and ack
+        streaming_pull.cancel()
+        try:
+            streaming_pull.result(timeout=worker_shutdown_seconds)
+        except Exception:
+            pass
+        executor.shutdown(wait=True)
+        subscriber.close()
+        logger.info(f"Worker stopped: {stats.snapshot()}")
+        flush_traces()
+        flush_logging()
+
+def publish_load(count, user_emails, history_id='1'):
+    # Load generator for the Pub/Sub emulator (PUBSUB_EMULATOR_HOST), publishes Gmail-style notifications
+    publisher = pubsub_v1.PublisherClient()
+    topic_path = publisher.topic_path(main.project_id, os.environ.get('EMAIL_UPDATES_TOPIC', 'email_updates'))
+    futures = [
+        publisher.publish(topic_path, json.dumps({'emailAddress': user_emails[i % len(user_emails)], 'historyId': history_id}).encode('utf-8'))
+        for i in range(count)
+    ]
+    for future in futures:
+        future.result()
+    logger.info(f"Published {count} notifications for {len(user_emails)} mailboxes to {topic_path}")
+
+if __name__ == '__main__':
+    # python worker.py                         run the streaming-pull worker
+    # python worker.py publish COUNT USERS     publish COUNT notifications for comma separated USERS
+    if len(sys.argv) > 1 and sys.argv[1] == 'publish':
+        publish_load(int(sys.argv[2]), sys.argv[3].split(','))
+    else:
+        run()
@@ -0,0 +1,129 @@
+import bisect
+import logging
+import os
+import threading
+
+from opentelemetry import propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+
+logger = logging.getLogger(__name__)
+
+# 'gcp' exports to Cloud Trace, 'memory' keeps finished spans in memory_exporter for
+# offline runs, 'console' prints them and 'none' only feeds the latency histograms
+trace_exporter = os.environ.get('TRACE_EXPORTER', 'gcp')
+trace_sample_ratio = float(os.environ.get('TRACE_SAMPLE_RATIO', '1.0'))
+
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000, 300000]
+
+
+class LatencyHistogram:
+    # Fixed-bucket latency histogram per stage, cheap enough to update on every span.
+
+    def __init__(self, buckets_ms=LATENCY_BUCKETS_MS):
+        self.buckets_ms = list(buckets_ms)
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        elapsed_ms = seconds * 1000
+        index = bisect.bisect_left(self.buckets_ms, elapsed_ms)
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = {'count': 0, 'sum_ms': 0.0, 'max_ms': 0.0, 'counts': [0] * (len(self.buckets_ms) + 1)}
+            stats['count'] += 1
+            stats['sum_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['counts'][index] += 1
+
+    def _quantile(self, stats, q):
+        target = q * stats['count']
+        seen = 0
+        for index, count in enumerate(stats['counts']):
+            seen += count
+            if seen >= target:
+                return self.buckets_ms[index] if index < len(self.buckets_ms) else stats['max_ms']
+        return stats['max_ms']
+
+    def snapshot(self, buckets=True):
+        with self._lock:
+            return {stage: self._summary(stats, buckets) for stage, stats in self._stages.items()}
+
+    def _summary(self, stats, buckets):
+        summary = {
+            'count': stats['count'],
+            'avg_ms': round(stats['sum_ms'] / stats['count'], 1),
+            'max_ms': round(stats['max_ms'], 1),
+            'p50_ms': self._quantile(stats, 0.5),
+            'p95_ms': self._quantile(stats, 0.95),
+            'p99_ms': self._quantile(stats, 0.99),
+        }
+        if buckets:
+            summary['buckets'] = {
+                (f'le_{bound}' if index < len(self.buckets_ms) else 'inf'): count
+                for index, (bound, count) in enumerate(zip(self.buckets_ms + [None], stats['counts']))
+            }
+        return summary
+
+class StageLatencyProcessor(SpanProcessor):
+    # Records the duration of every finished span under its name
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def on_end(self, span):
+        if span.start_time and span.end_time:
+            self.histogram.record(span.name, (span.end_time - span.start_time) / 1e9)
+
+stage_latency = LatencyHistogram()
+memory_exporter = InMemorySpanExporter()
+_setup_lock = threading.Lock()
+_configured = False
+
+
+def _span_processor():
+    if trace_exporter == 'gcp':
+        from opentelemetry.exporter.cloud_trace import CloudTraceSpanExporter
+        return BatchSpanProcessor(CloudTraceSpanExporter())
+    if trace_exporter == 'memory':
+        return SimpleSpanProcessor(memory_exporter)
+    if trace_exporter == 'console':
+        return SimpleSpanProcessor(ConsoleSpanExporter())
+    if trace_exporter == 'none':
+        return None
+    raise ValueError(f"Unknown TRACE_EXPORTER: {trace_exporter}")
+
+def setup_tracing(service_name):
+    global _configured
+    with _setup_lock:
+        if not _configured:
+            provider = TracerProvider(
+                resource=Resource.create({'service.name': service_name}),
+                sampler=ParentBased(TraceIdRatioBased(trace_sample_ratio)),
+            )
+            provider.add_span_processor(StageLatencyProcessor(stage_latency))
+            processor = _span_processor()
+            if processor is not None:
+                provider.add_span_processor(processor)
+            trace.set_tracer_provider(provider)
+            _configured = True
+            logger.info(f"Tracing for {service_name} exporting to {trace_exporter}")
+    return trace.get_tracer(service_name)
+
+def flush_traces(timeout_millis=5000):
+    provider = trace.get_tracer_provider()
+    if hasattr(provider, 'force_flush'):
+        provider.force_flush(timeout_millis)
+
+def inject_context():
+    # W3C trace context as a plain str dict, usable as Pub/Sub attributes or in a job payload
+    carrier = {}
+    propagate.inject(carrier)
+    return carrier
+
+def extract_context(carrier):
+    return propagate.extract(carrier or {})
@@ -1,15 +1,34 @@
 import os
 import json
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from google.cloud import secretmanager, datastore
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 import logging
 import cloud_logging_helper
+from state_store import DatastoreStateStore
 
 PROJECT_ID = os.environ.get('PROJECT_ID')
 SECRETS_PROJECT_ID = os.environ.get('SECRETS_PROJECT_ID')
 SECRET_ID = os.environ.get('SECRET_ID')
 USER_EMAIL = os.environ.get('USER_EMAIL')
+# Comma separated mailboxes and/or a file with one mailbox per line
+USER_EMAILS = os.environ.get('USER_EMAILS', '')
+USER_EMAILS_FILE = os.environ.get('USER_EMAILS_FILE')
+# Gmail watches expire after 7 days, renew the ones that expire within this window
+RENEW_WITHIN_SECONDS = int(os.environ.get('RENEW_WITHIN_SECONDS', str(24 * 3600)))
+RENEWAL_CONCURRENCY = int(os.environ.get('RENEWAL_CONCURRENCY', '16'))
+# Watch calls per second per mailbox domain, 0 or less turns the limit off
+DOMAIN_RATE_PER_SECOND = float(os.environ.get('DOMAIN_RATE_PER_SECOND', '10'))
+WRITE_BATCH_SIZE = 500
+READ_BATCH_SIZE = 1000
+
+WATCH_KIND = 'GmailWatch'
 
 logger = cloud_logging_helper.setup_logging()
 
@@ -19,37 +38,161 @@ def access_secret_version(version_id="latest"):
     response = client.access_secret_version(request={"name": name})
     return response.payload.data.decode('UTF-8')
 
-def get_gmail_service():
-    service_account_info = json.loads(access_secret_version())
-    creds = service_account.Credentials.from_service_account_info(
-        service_account_info,
-        scopes=['https://mail.google.com/']
-    )
-    delegated_creds = creds.with_subject(USER_EMAIL)
-    return build('gmail', 'v1', credentials=delegated_creds)
+def get_gmail_service(creds):
+    # Built once per sweep, each request is executed with the mailbox's own delegated http
+    return build('gmail', 'v1', credentials=creds, cache_discovery=False)
+
+def load_user_emails():
+    emails = [email.strip() for email in USER_EMAILS.split(',') if email.strip()]
+    if USER_EMAILS_FILE:
+        with open(USER_EMAILS_FILE) as f:
+            emails.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    if USER_EMAIL:
+        emails.append(USER_EMAIL)
+    return list(dict.fromkeys(emails))
+
+class DomainRateLimiter:
+    # Token bucket per mailbox domain so a large tenant cannot exhaust its quota
+    # while other domains wait. A rate of 0 or less means no limit.
+
+    def __init__(self, rate_per_second, burst=None):
+        self.rate = rate_per_second
+        self.burst = burst or max(1.0, self.rate)
+        self._buckets = defaultdict(lambda: [self.burst, time.monotonic()])
+        self._lock = threading.Lock()
+
+    def acquire(self, user_email):
+        if self.rate <= 0:
+            return
+        domain = user_email.rsplit('@', 1)[-1].lower()
+        while True:
+            with self._lock:
+                bucket = self._buckets[domain]
+                now = time.monotonic()
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                if bucket[0] >= 1:
+                    bucket[0] -= 1
+                    return
+                wait = (1 - bucket[0]) / self.rate
+            time.sleep(wait)
+
+class DelegatedCredentialsCache:
+    # Delegated credentials per mailbox, like GmailServiceCache in the watcher, so a
+    # mailbox's access token is minted once and reused until it expires.
+
+    def __init__(self, creds):
+        self.creds = creds
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_email):
+        with self._lock:
+            delegated = self._entries.get(user_email)
+            if delegated is None:
+                self.misses += 1
+                delegated = self._entries[user_email] = self.creds.with_subject(user_email)
+            else:
+                self.hits += 1
+            return delegated
 
-def setup_gmail_watch():
-    service = get_gmail_service()
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+def load_watches(client, user_emails):
+    watches = {}
+    for start in range(0, len(user_emails), READ_BATCH_SIZE):
+        keys = [client.key(WATCH_KIND, email) for email in user_emails[start:start + READ_BATCH_SIZE]]
+        for entity in client.get_multi(keys):
+            watches[entity.key.name] = entity
+    return watches
+
+def due_for_renewal(user_emails, watches, now_ms):
+    threshold = now_ms + RENEW_WITHIN_SECONDS * 1000
+    return [email for email in user_emails
+            if email not in watches or int(watches[email].get('expiration', 0)) <= threshold]
+
+def setup_gmail_watch(user_email, service, credentials_cache, limiter):
+    limiter.acquire(user_email)
+    http = AuthorizedHttp(credentials_cache.get(user_email), http=httplib2.Http())
     topic_name = f'projects/{PROJECT_ID}/topics/email_updates'
     request = {
         'labelIds': ['INBOX'],
         'topicName': topic_name
     }
-    try:
-        response = service.users().watch(userId='me', body=request).execute()
-        logging.info(f"Watch setup successful. Expires at: {response.get('expiration')}")
-        
-        # Store the historyId
-        client = datastore.Client()
-        key = client.key('LastProcessedHistoryId', USER_EMAIL)
-        entity = datastore.Entity(key=key)
-        entity['history_id'] = response['historyId']
-        client.put(entity)
-        
-        logging.info(f"Stored initial historyId: {response['historyId']}")
-    except Exception as e:
-        logging.error(f"Failed to set up watch: {str(e)}")
-        raise
+    response = service.users().watch(userId='me', body=request).execute(http=http)
+    logging.info(f"Watch setup successful for {user_email}. Expires at: {response.get('expiration')}")
+    return response
+
+def write_results(client, state_store, results):
+    # Watch expirations are always overwritten. The history cursor is only seeded for
+    # mailboxes that have none yet, an existing one is owned by the watcher function and
+    # moving it to the watch's historyId would skip unprocessed changes. The seeding is an
+    # insert-if-absent transaction in the state store, so it cannot race the watcher's writes.
+    items = list(results.items())
+    for start in range(0, len(items), WRITE_BATCH_SIZE):
+        chunk = items[start:start + WRITE_BATCH_SIZE]
+        watch_entities = []
+        for email, response in chunk:
+            watch = datastore.Entity(key=client.key(WATCH_KIND, email))
+            watch['expiration'] = int(response['expiration'])
+            watch['history_id'] = response['historyId']
+            watch['renewed_at'] = time.time()
+            watch_entities.append(watch)
+        client.put_multi(watch_entities)
+        seeded = state_store.seed_many({email: response['historyId'] for email, response in chunk})
+        logging.info(f"Stored {len(watch_entities)} watch expirations and {len(seeded)} initial historyIds")
+
+def renew_watches(user_emails):
+    started = time.monotonic()
+    client = datastore.Client()
+    state_store = DatastoreStateStore(client)
+    watches = load_watches(client, user_emails)
+    due = due_for_renewal(user_emails, watches, int(time.time() * 1000))
+    logging.info(f"{len(due)} of {len(user_emails)} mailboxes need a watch renewal")
+    if not due:
+        return 0, {}
+
+    service_account_info = json.loads(access_secret_version())
+    creds = service_account.Credentials.from_service_account_info(
+        service_account_info,
+        scopes=['https://mail.google.com/']
+    )
+    service = get_gmail_service(creds)
+    credentials_cache = DelegatedCredentialsCache(creds)
+    limiter = DomainRateLimiter(DOMAIN_RATE_PER_SECOND)
+    renewed = 0
+    results = {}
+    failures = {}
+    with ThreadPoolExecutor(max_workers=RENEWAL_CONCURRENCY) as executor:
+        futures = {executor.submit(setup_gmail_watch, email, service, credentials_cache, limiter): email for email in due}
+        for future in as_completed(futures):
+            email = futures[future]
+            try:
+                results[email] = future.result()
+                renewed += 1
+            except Exception as e:
+                logging.error(f"Failed to set up watch for {email}: {str(e)}")
+                failures[email] = e
+            if len(results) >= WRITE_BATCH_SIZE:
+                write_results(client, state_store, results)
+                results = {}
+    if results:
+        write_results(client, state_store, results)
+    logging.info(f"Renewed {renewed} watches in {time.monotonic() - started:.1f}s with {len(failures)} failures, "
+                 f"credentials: {credentials_cache.stats()}")
+    return renewed, failures
+
+def setup_gmail_watch_for_all():
+    user_emails = load_user_emails()
+    if not user_emails:
+        raise ValueError("No mailboxes configured, set USER_EMAILS, USER_EMAILS_FILE or USER_EMAIL")
+    _, failures = renew_watches(user_emails)
+    if failures:
+        raise RuntimeError(f"Failed to renew {len(failures)} watches: {sorted(failures)}")
 
 if __name__ == "__main__":
-    setup_gmail_watch()
\ No newline at end of file
+    setup_gmail_watch_for_all()
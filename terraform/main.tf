@@ -80,7 +80,8 @@ resource "google_project_iam_member" "service_account_roles" {
     "roles/secretmanager.secretAccessor",
     "roles/pubsub.publisher",
     "roles/pubsub.subscriber",
-    "roles/datastore.user"
+    "roles/datastore.user",
+    "roles/cloudtrace.agent"
   ])
   project = var.project_id
   role    = each.key
@@ -123,7 +124,8 @@ resource "google_storage_bucket" "function_bucket" {
   project  = var.project_id
 }
 
-# Create a zip of the function source code
+# Create a zip of the function source code. The shared helpers in src/ must be copied
+# into src/gmail_watcher first, as the CI workflow does before terraform runs.
 data "archive_file" "function_source" {
   type        = "zip"
   source_dir  = "${path.module}/../src/gmail_watcher"
@@ -157,7 +159,7 @@ resource "google_cloudfunctions2_function" "gmail_watcher" {
   service_config {
     max_instance_count = 1
     available_memory   = "512Mi"
-    timeout_seconds    = 90
+    timeout_seconds    = var.watcher_timeout_seconds
     environment_variables = {
       PROJECT_ID         = var.project_id
       SECRETS_PROJECT_ID = var.project_id
@@ -166,6 +168,7 @@ resource "google_cloudfunctions2_function" "gmail_watcher" {
       PUSH_TOPIC_NAME    = google_pubsub_topic.parsed_emails.id
       LOG_EXECUTION_ID   = "true"
       GOOGLE_CLOUD_LOGGING_LEVEL = "INFO"
+      FUNCTION_TIMEOUT_SECONDS   = var.watcher_timeout_seconds
     }
     service_account_email = google_service_account.gmail_watcher.email
   }
@@ -212,6 +215,10 @@ resource "google_cloud_run_service" "ai_agent_processor" {
           name  = "ANTHROPIC_API_KEY"
           value = "ANTHROPIC_API_KEY"
         }
+        env {
+          name  = "RESULT_SINK_BUCKET"
+          value = google_storage_bucket.research_reports.name
+        }
         ports {
           container_port = 8080
           name           = "http1"
@@ -244,6 +251,9 @@ resource "google_cloud_run_service" "ai_agent_processor" {
         "autoscaling.knative.dev/maxScale"      = "10"
         "run.googleapis.com/client-name"        = "terraform"
         "run.googleapis.com/startup-cpu-boost"  = "true"
+        # Crew jobs run on background workers after the push request is acked
+        "run.googleapis.com/cpu-throttling"     = "false"
+        "autoscaling.knative.dev/minScale"      = "1"
       }
     }
   }
@@ -282,6 +292,12 @@ resource "google_pubsub_subscription" "ai_agent_processor_subscription" {
     }
   }
 
+  # The processor answers 429 while its crew queue is full, back off before redelivering
+  retry_policy {
+    minimum_backoff = "10s"
+    maximum_backoff = "600s"
+  }
+
   depends_on = [google_cloud_run_service.ai_agent_processor]
 }
 
@@ -331,6 +347,22 @@ resource "google_storage_bucket" "gcf_v2_uploads" {
   }
 }
 
+# Research reports too large to store inline in Firestore
+resource "google_storage_bucket" "research_reports" {
+  name          = "research-reports-${var.project_id}"
+  location      = var.region
+  project       = var.project_id
+  force_destroy = false
+
+  uniform_bucket_level_access = true
+}
+
+resource "google_storage_bucket_iam_member" "research_reports_writer" {
+  bucket = google_storage_bucket.research_reports.name
+  role   = "roles/storage.objectAdmin"
+  member = "serviceAccount:${google_service_account.gmail_watcher.email}"
+}
+
 resource "google_storage_bucket" "gcf_v2_sources" {
   name          = "gcf-v2-sources-99383323365-europe-west2"
   location      = var.region
@@ -30,4 +30,9 @@ variable "watcher_service_account_id" {
   description = "The ID of the service account for the Gmail watcher"
   type        = string
   default     = "service-99383323365@research-assistant-424819.iam.gserviceaccount.com"
-}
\ No newline at end of file
+}
+variable "watcher_timeout_seconds" {
+  description = "Timeout of the Gmail watcher function, the per-mailbox sync lease is derived from it"
+  type        = number
+  default     = 90
+}
@@ -0,0 +1,11 @@
+import os
+import sys
+
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# Each service imports its modules by bare name from its own directory, and the shared
+# helpers from src/, which the builds copy next to them
+for path in (SRC, os.path.join(SRC, 'gmail_watcher'), os.path.join(SRC, 'agents'), os.path.join(SRC, 'watcher_renewal')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
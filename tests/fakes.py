@@ -0,0 +1,79 @@
+import threading
+from contextlib import contextmanager
+
+from google.cloud import datastore
+
+
+class FakeQuery:
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+        self.filters = []
+
+    def add_filter(self, name, operator, value):
+        assert operator in ('=', 'IN'), operator
+        self.filters.append((name, operator, value))
+
+    def fetch(self):
+        for entity in self.client.all(self.kind):
+            if all(entity.get(name) in value if operator == 'IN' else entity.get(name) == value
+                   for name, operator, value in self.filters):
+                yield entity
+
+
+class FakeDatastoreClient:
+    # Just enough of datastore.Client for the stores. Transactions are serialized and their
+    # writes only land on commit; reads inside one see committed data, as in Datastore.
+
+    def __init__(self):
+        self.entities = {}
+        self.writes = 0
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def key(self, kind, name):
+        return datastore.Key(kind, name, project='test-project')
+
+    def get(self, key):
+        with self._lock:
+            stored = self.entities.get(key.flat_path)
+            if stored is None:
+                return None
+            entity = datastore.Entity(key=key)
+            entity.update(stored)
+            return entity
+
+    def get_multi(self, keys):
+        return [entity for entity in map(self.get, keys) if entity is not None]
+
+    def put(self, entity):
+        buffered = getattr(self._local, 'writes', None)
+        if buffered is not None:
+            buffered.append(entity)
+            return
+        with self._lock:
+            self.entities[entity.key.flat_path] = dict(entity)
+            self.writes += 1
+
+    def put_multi(self, entities):
+        for entity in entities:
+            self.put(entity)
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            self._local.writes = []
+            try:
+                yield
+                writes = self._local.writes
+            finally:
+                self._local.writes = None
+            for entity in writes:
+                self.put(entity)
+
+    def query(self, kind):
+        return FakeQuery(self, kind)
+
+    def all(self, kind):
+        with self._lock:
+            return [self.get(self.key(kind, path[1])) for path in list(self.entities) if path[0] == kind]
@@ -0,0 +1,151 @@
+import time
+
+import pytest
+from googleapiclient.errors import HttpError
+
+from batch_fetch import execute_batch, fetch_messages
+
+
+class FakeResponse(dict):
+    def __init__(self, status):
+        super().__init__(status=str(status))
+        self.status = status
+        self.reason = 'fake'
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.keys = []
+
+    def add(self, request, request_id):
+        self.keys.append(request_id)
+
+    def execute(self):
+        self.service.attempts += 1
+        self.service.sent.append(list(self.keys))
+        outcomes = self.service.script.pop(0)
+        for key in self.keys:
+            outcome = outcomes.get(key, 'ok')
+            if outcome == 'ok':
+                self.callback(key, {'id': key}, None)
+            elif outcome == 'raise':
+                raise ConnectionError(f'batch failed on attempt {self.service.attempts}')
+            else:
+                self.callback(key, None, HttpError(FakeResponse(outcome), b''))
+
+
+class FakeService:
+    # Each execute() plays the next entry of script: key -> 'ok', an HTTP status, or
+    # 'raise' to fail the whole batch when that key is reached
+    def __init__(self, script):
+        self.script = list(script)
+        self.attempts = 0
+        self.sent = []
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+
+@pytest.fixture
+def factories():
+    return {key: (lambda: None) for key in ('a', 'b')}
+
+
+def test_whole_batch_failure_requeues_unanswered_calls(factories):
+    # 'b' gets a 503, then the whole batch raises after 'a' succeeded, then 'b' succeeds
+    result = execute_batch(FakeService([{'b': 503}, {'b': 'raise'}, {}]), factories, backoff_seconds=0)
+    assert set(result.results) == {'a', 'b'}
+    assert not result.failures
+    assert result.round_trips == 3
+
+
+def test_persistent_failure_reports_latest_error(factories):
+    result = execute_batch(FakeService([{'b': 503}, {'b': 'raise'}]), factories, max_attempts=2, backoff_seconds=0)
+    assert 'a' in result.results
+    assert isinstance(result.failures['b'], ConnectionError)
+
+
+def test_non_retryable_error_is_not_resent(factories):
+    service = FakeService([{'b': 404}])
+    result = execute_batch(service, factories, backoff_seconds=0)
+    assert service.attempts == 1
+    assert result.failures['b'].resp.status == 404
+
+
+def test_non_retryable_error_survives_a_whole_batch_failure():
+    # 'b' answers 404 before the batch raises at 'c', only 'c' goes again
+    service = FakeService([{'b': 404, 'c': 'raise'}, {}])
+    result = execute_batch(service, {key: (lambda: None) for key in 'abc'}, backoff_seconds=0)
+    assert service.sent == [['a', 'b', 'c'], ['c']]
+    assert set(result.results) == {'a', 'c'}
+    assert result.failures['b'].resp.status == 404
+
+
+class LatencyRequest:
+    def __init__(self, endpoint, message_id):
+        self.endpoint = endpoint
+        self.message_id = message_id
+
+    def execute(self):
+        self.endpoint.round_trip()
+        return {'id': self.message_id}
+
+
+class LatencyBatch:
+    def __init__(self, endpoint, callback):
+        self.endpoint = endpoint
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.endpoint.round_trip()
+        for request_id, request in self.requests:
+            self.callback(request_id, {'id': request.message_id}, None)
+
+
+class LatencyEndpoint:
+    # A Gmail endpoint where every HTTP round trip, single get or whole batch, costs latency
+    def __init__(self, latency):
+        self.latency = latency
+        self.http_requests = 0
+
+    def round_trip(self):
+        self.http_requests += 1
+        time.sleep(self.latency)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, userId, id, **kwargs):
+        return LatencyRequest(self, id)
+
+    def new_batch_http_request(self, callback):
+        return LatencyBatch(self, callback)
+
+
+def test_batching_cuts_round_trips_and_latency():
+    message_ids = [f'm{i}' for i in range(100)]
+
+    sequential = LatencyEndpoint(latency=0.005)
+    started = time.perf_counter()
+    for message_id in message_ids:
+        sequential.users().messages().get(userId='me', id=message_id, format='full').execute()
+    sequential_seconds = time.perf_counter() - started
+
+    batched = LatencyEndpoint(latency=0.005)
+    started = time.perf_counter()
+    result = fetch_messages(batched, message_ids)
+    batched_seconds = time.perf_counter() - started
+
+    assert set(result.results) == set(message_ids)
+    assert sequential.http_requests == 100
+    assert batched.http_requests == result.round_trips == 2
+    assert batched_seconds * 10 < sequential_seconds
@@ -0,0 +1,38 @@
+import pytest
+
+pytest.importorskip('langchain.agents')
+
+from crews.ai_research_crew import crew_factory as crew_factory_module
+from crews.ai_research_crew.crew_factory import CrewFactory
+from email_compaction import count_tokens
+
+
+def unbuildable_llm():
+    raise AssertionError('the default LLM client was built')
+
+
+@pytest.fixture
+def factory():
+    configs = {name: {**config, 'llm': unbuildable_llm} for name, config in crew_factory_module.AGENT_CONFIGS.items()}
+    return CrewFactory(agent_configs=configs)
+
+
+def test_templates_build_no_default_llm_and_carry_no_memory(factory):
+    templates = factory.agent_templates()
+    assert all('llm' not in template and 'memory' not in template for template in templates.values())
+    assert factory.build_agent('writer', llm='gpt-4o').memory in (None, False)
+
+
+def test_cap_inputs_caps_tokens(factory, monkeypatch):
+    monkeypatch.setattr(crew_factory_module, 'max_input_tokens', 100)
+    capped = factory.cap_inputs({'email_body': 'word ' * 1000, 'email_from': 'a@example.com', 'count': 3})
+    assert count_tokens(capped['email_body']) <= 100
+    assert capped['email_from'] == 'a@example.com'
+    assert capped['count'] == 3
+
+
+def test_run_memory_is_off_when_disabled(factory, monkeypatch):
+    monkeypatch.setattr(crew_factory_module, 'crew_memory', False)
+    with factory.run_memory() as memory:
+        assert memory is None
+    assert factory._memory is None
@@ -0,0 +1,38 @@
+import pytest
+
+from email_compaction import TRUNCATION_MARKER, _thread_fixture, compact_email, count_tokens, strip_tracking
+
+REQUEST = "Please research privileged-access management and how confidential computing works."
+NOTICE = "This email and any attachments are confidential and intended solely for the addressee."
+
+
+def test_requests_about_footer_subjects_are_kept():
+    assert compact_email(REQUEST).text == REQUEST
+
+
+def test_only_trailing_footers_are_dropped():
+    body = f"{REQUEST}\n\nAlso cover disclaimer wording in AI output.\n\n{NOTICE}"
+    assert compact_email(body).text == f"{REQUEST}\n\nAlso cover disclaimer wording in AI output."
+    assert compact_email(f"{NOTICE}\n\n{REQUEST}").text == f"{NOTICE}\n\n{REQUEST}"
+    # The first paragraph is never dropped, even when it reads like a footer
+    assert compact_email(NOTICE).text == NOTICE
+
+
+def test_quoted_history_signature_and_tracking_are_removed():
+    result = compact_email(_thread_fixture(5))
+    assert result.text.startswith('Reply 4:')
+    assert 'wrote:' not in result.text and '> ' not in result.text
+    assert 'Jane Doe' not in result.text and 'CONFIDENTIALITY NOTICE' not in result.text
+    assert 'utm_source' not in result.text and 'id=42' in result.text
+    assert result.tokens_after < result.tokens_before
+
+
+def test_tracking_parameters_are_stripped_from_urls():
+    assert strip_tracking('see https://example.com/a?x=1&utm_campaign=y&gclid=z') == 'see https://example.com/a?x=1'
+
+
+@pytest.mark.parametrize('max_tokens', [20, 50])
+def test_output_stays_within_the_token_budget(max_tokens):
+    result = compact_email(' '.join(['word'] * 500), max_tokens=max_tokens)
+    assert result.text.endswith(TRUNCATION_MARKER)
+    assert count_tokens(result.text) <= max_tokens + 1
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import email_dedup
+from email_dedup import KIND, EmailDeduplicator
+from tests.fakes import FakeDatastoreClient
+
+
+@pytest.fixture
+def client():
+    return FakeDatastoreClient()
+
+
+def lease_expires(client, email_id):
+    return client.get(client.key(KIND, email_id))['lease_expires']
+
+
+def expire(client, email_id):
+    entity = client.get(client.key(KIND, email_id))
+    entity['lease_expires'] = datetime.now(timezone.utc) - timedelta(seconds=1)
+    client.put(entity)
+
+
+def test_claim_is_single_use_across_instances(client):
+    assert EmailDeduplicator(client).claim('m1')
+    assert not EmailDeduplicator(client).claim('m1')
+
+
+def test_renewed_claim_outlives_its_original_lease(client, monkeypatch):
+    dedup = EmailDeduplicator(client)
+    monkeypatch.setattr(email_dedup, 'lease_seconds', 1)
+    assert dedup.claim('m1')
+    first = lease_expires(client, 'm1')
+    monkeypatch.setattr(email_dedup, 'lease_seconds', 900)
+    assert dedup.renew('m1')
+    assert lease_expires(client, 'm1') - first > timedelta(seconds=800)
+    # A redelivery on another instance still finds the claim taken
+    assert not EmailDeduplicator(client).claim('m1')
+
+
+def test_expired_claim_can_be_taken_again(client):
+    assert EmailDeduplicator(client).claim('m1')
+    expire(client, 'm1')
+    assert EmailDeduplicator(client).claim('m1')
+
+
+def test_renew_refuses_finished_or_missing_claims(client):
+    dedup = EmailDeduplicator(client)
+    assert not dedup.renew('never-claimed')
+    dedup.claim('m1')
+    dedup.complete('m1')
+    assert not dedup.renew('m1')
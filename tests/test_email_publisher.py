@@ -0,0 +1,55 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import email_publisher
+from email_publisher import PendingPublishes, PublishError
+
+
+def resolved(result=None, error=None):
+    future = Future()
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+
+def test_wait_returns_server_ids_and_clears():
+    pending = PendingPublishes()
+    assert pending.wait() == {}
+    pending.add('m1', resolved('server-1'))
+    pending.add('m2', resolved('server-2'))
+    assert len(pending) == 2
+    assert pending.wait() == {'m1': 'server-1', 'm2': 'server-2'}
+    assert len(pending) == 0
+
+
+def test_wait_awaits_every_future_and_names_only_failures():
+    pending = PendingPublishes()
+    pending.add('m3', resolved(error=RuntimeError('deadline exceeded')))
+    pending.add('m4', resolved('server-4'))
+    with pytest.raises(PublishError) as raised:
+        pending.wait()
+    assert list(raised.value.failures) == ['m3']
+    assert len(pending) == 0
+
+
+def test_concurrent_callers_share_one_client(monkeypatch):
+    created = []
+    fake_pubsub = SimpleNamespace(
+        types=SimpleNamespace(
+            BatchSettings=lambda **kwargs: kwargs,
+            PublishFlowControl=lambda **kwargs: kwargs,
+            PublisherOptions=lambda **kwargs: kwargs,
+            LimitExceededBehavior=SimpleNamespace(BLOCK='block'),
+        ),
+        PublisherClient=lambda **kwargs: created.append(kwargs) or object(),
+    )
+    monkeypatch.setattr(email_publisher, 'pubsub_v1', fake_pubsub)
+    monkeypatch.setattr(email_publisher, '_publisher', None)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        publishers = set(map(id, executor.map(lambda _: email_publisher.get_publisher(), range(32))))
+    assert len(created) == 1 and len(publishers) == 1
+    assert created[0]['batch_settings']['max_messages'] == email_publisher.batch_max_messages
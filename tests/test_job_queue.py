@@ -0,0 +1,162 @@
+import time
+
+import pytest
+from google.cloud import datastore
+
+from job_queue import (
+    PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, STATUS_DEAD, STATUS_DONE, STATUS_QUEUED, STATUS_RUNNING,
+    DatastoreJobQueue, FairReadyQueue, InMemoryJobQueue, JobWorkerPool,
+)
+from tests.fakes import FakeDatastoreClient
+
+
+def run_until_idle(queue, pool, timeout=10):
+    pool.start()
+    deadline = time.monotonic() + timeout
+    while (queue.depth() or pool.busy) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pool.stop()
+
+
+class FastRetryQueue(InMemoryJobQueue):
+    def fail(self, job, error, **kwargs):
+        return super().fail(job, error, attempts_allowed=2, retry_delay=0)
+
+
+def test_success_completes_once_and_calls_hook_after_handler():
+    queue, completed = InMemoryJobQueue(), []
+    queue.enqueue('ok', {})
+    pool = JobWorkerPool(queue, lambda job: None, workers=1, on_complete=lambda job: completed.append(job['status']))
+    run_until_idle(queue, pool)
+    assert completed == [STATUS_DONE]
+    assert pool.completed == 1
+    assert queue.heartbeat({'status': STATUS_DONE}) is False
+
+
+def test_failure_retries_then_dead_letters():
+    queue, attempts, dead = FastRetryQueue(), [], []
+    queue.enqueue('bad', {})
+    pool = JobWorkerPool(queue, lambda job: attempts.append(job['attempts']) or 1 / 0, workers=1,
+                         on_dead_letter=lambda job, error: dead.append(job['status']))
+    run_until_idle(queue, pool)
+    assert attempts == [1, 2]
+    assert dead == [STATUS_DEAD]
+    assert pool.retried == 1 and pool.dead == 1
+
+
+def test_completion_hook_failure_never_reruns_the_handler(monkeypatch):
+    monkeypatch.setattr('job_queue.bookkeeping_attempts', 2)
+    queue, runs = InMemoryJobQueue(), []
+    queue.enqueue('flaky-complete', {})
+    pool = JobWorkerPool(queue, lambda job: runs.append(job['id']), workers=1, on_complete=lambda job: 1 / 0)
+    run_until_idle(queue, pool)
+    assert runs == ['flaky-complete']
+    assert pool.retried == 0
+    # The job itself was marked done, only the hook failed
+    assert pool.completed == 1 and pool.bookkeeping_failures == 1
+
+
+def test_failed_done_write_is_not_counted_as_completed(monkeypatch):
+    monkeypatch.setattr('job_queue.bookkeeping_attempts', 2)
+
+    class BrokenCompleteQueue(InMemoryJobQueue):
+        def complete(self, job):
+            raise ConnectionError('datastore unavailable')
+
+    queue, hooked = BrokenCompleteQueue(), []
+    queue.enqueue('unrecorded', {})
+    pool = JobWorkerPool(queue, lambda job: None, workers=1, on_complete=lambda job: hooked.append(job['id']))
+    run_until_idle(queue, pool)
+    assert pool.completed == 0 and pool.bookkeeping_failures == 1
+    assert pool.stats()['bookkeeping_failures'] == 1
+    # The dedup hook still runs so a redelivery does not send the reply again
+    assert hooked == ['unrecorded']
+
+
+def test_lease_errors_back_off_instead_of_killing_the_worker(monkeypatch):
+    monkeypatch.setattr('job_queue.lease_error_max_backoff', 0)
+
+    class FlakyLeaseQueue(InMemoryJobQueue):
+        errors = 1
+
+        def lease(self, owner, **kwargs):
+            if self.errors:
+                self.errors -= 1
+                raise ConnectionError('datastore unavailable')
+            return super().lease(owner, **kwargs)
+
+    queue, runs = FlakyLeaseQueue(), []
+    queue.enqueue('after-outage', {})
+    run_until_idle(queue, JobWorkerPool(queue, lambda job: runs.append(job['id']), workers=1))
+    assert runs == ['after-outage']
+
+
+def test_job_held_elsewhere_is_dropped_for_recovery():
+    class ContendedQueue(InMemoryJobQueue):
+        def _acquire(self, job, owner, lease_for):
+            return None
+
+    queue = ContendedQueue()
+    queue.enqueue('contended', {})
+    assert queue.lease('worker', timeout=0.05) is None
+    assert 'contended' not in queue._jobs
+
+
+@pytest.mark.parametrize('status', ['queued', 'running'])
+def test_enqueue_refuses_a_live_duplicate(status):
+    queue = InMemoryJobQueue()
+    assert queue.enqueue('dup', {})
+    if status == 'running':
+        assert queue.lease('worker', timeout=0.05)['id'] == 'dup'
+    assert not queue.enqueue('dup', {})
+
+
+@pytest.fixture
+def datastore_client():
+    return FakeDatastoreClient()
+
+
+def stored(client, job_id):
+    return client.get(client.key(DatastoreJobQueue.KIND, job_id))
+
+
+def test_datastore_enqueue_never_overwrites_a_running_job(datastore_client):
+    first = DatastoreJobQueue(client=datastore_client)
+    assert first.enqueue('email-1', {'id': 'email-1'})
+    job = first.lease('worker-a', timeout=0.05)
+    assert job['status'] == STATUS_RUNNING
+
+    # Another instance receives a redelivery of the same email
+    second = DatastoreJobQueue(client=datastore_client)
+    assert not second.enqueue('email-1', {'id': 'email-1'})
+    entity = stored(datastore_client, 'email-1')
+    assert entity['status'] == STATUS_RUNNING and entity['attempts'] == 1 and entity['owner'] == 'worker-a'
+    assert second.depth() == 0
+
+
+@pytest.mark.parametrize('status, accepted', [(STATUS_QUEUED, False), (STATUS_DONE, False), (STATUS_DEAD, True)])
+def test_datastore_enqueue_respects_the_stored_status(datastore_client, status, accepted):
+    entity = datastore.Entity(key=datastore_client.key(DatastoreJobQueue.KIND, 'email-2'))
+    entity.update({'status': status, 'attempts': 3, 'payload': {}})
+    datastore_client.put(entity)
+    assert DatastoreJobQueue(client=datastore_client).enqueue('email-2', {}) is accepted
+    assert stored(datastore_client, 'email-2')['status'] == (STATUS_QUEUED if accepted else status)
+
+
+def test_heartbeat_hook_runs_when_the_job_starts_and_on_every_heartbeat(monkeypatch):
+    monkeypatch.setattr('job_queue.heartbeat_seconds', 0.02)
+    queue, renewals = InMemoryJobQueue(), []
+    queue.enqueue('long-crew', {})
+    pool = JobWorkerPool(queue, lambda job: time.sleep(0.15), workers=1, on_heartbeat=lambda job: renewals.append(job['status']))
+    run_until_idle(queue, pool)
+    assert len(renewals) >= 3
+    assert set(renewals) == {'running'}
+
+
+def test_fair_queue_serves_every_priority_lane():
+    ready = FairReadyQueue(burst=2)
+    for priority in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW):
+        for i in range(10):
+            ready.put({'id': f'{priority}-{i}', 'user': 'u', 'priority': priority, 'enqueued_at': 0})
+    served = [ready.pop_ready(now=1)['priority'] for _ in range(9)]
+    assert served == [PRIORITY_HIGH, PRIORITY_HIGH, PRIORITY_NORMAL] * 2 + [PRIORITY_HIGH, PRIORITY_HIGH, PRIORITY_LOW]
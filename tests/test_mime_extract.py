@@ -0,0 +1,56 @@
+import base64
+
+from mime_extract import extract_text, select_text_parts
+
+
+def encode(text, charset='utf-8'):
+    return base64.urlsafe_b64encode(text.encode(charset)).decode('ascii').rstrip('=')
+
+
+def leaf(mime_type, text, charset='utf-8', filename=''):
+    return {
+        'mimeType': mime_type,
+        'filename': filename,
+        'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'}],
+        'body': {'data': encode(text, charset)},
+    }
+
+
+def multipart(subtype, *parts):
+    return {'mimeType': f'multipart/{subtype}', 'parts': list(parts)}
+
+
+def test_nested_multipart_prefers_plain_and_skips_attachments():
+    # mixed > [alternative > [plain, related > [html, image]], plain attachment, latin-1 part]
+    payload = multipart(
+        'mixed',
+        multipart(
+            'alternative',
+            leaf('text/plain', 'Plain body wins'),
+            multipart('related', leaf('text/html', '<p>HTML body</p>'), {'mimeType': 'image/png', 'filename': 'logo.png', 'body': {}}),
+        ),
+        leaf('text/plain', 'attachment text', filename='notes.txt'),
+        leaf('text/plain', 'Grüße', charset='latin-1'),
+    )
+    assert extract_text(payload) == 'Plain body wins\nGrüße'
+
+
+def test_nested_html_alternative_drops_scripts_and_styles():
+    payload = multipart(
+        'mixed',
+        multipart('alternative', multipart('related', leaf('text/html', '<style>p {}</style><p>Hello</p><script>x()</script><div>World</div>'))),
+    )
+    assert [part['mimeType'] for part in select_text_parts(payload)] == ['text/html']
+    assert extract_text(payload) == 'Hello\n\nWorld'
+
+
+def test_attachment_disposition_is_skipped():
+    attachment = leaf('text/plain', 'report')
+    attachment['headers'].append({'name': 'Content-Disposition', 'value': 'attachment'})
+    assert extract_text(multipart('mixed', leaf('text/plain', 'Body'), attachment)) == 'Body'
+
+
+def test_truncation_and_undecodable_parts():
+    assert extract_text(leaf('text/plain', 'x' * 50), max_chars=10) == 'x' * 10
+    assert extract_text({'mimeType': 'text/plain', 'body': {'data': '!!!'}}) == ''
+    assert extract_text(multipart('mixed', {'mimeType': 'text/plain', 'body': {}})) == ''
@@ -0,0 +1,185 @@
+import base64
+import copy
+import json
+
+from mime_extract import extract_text
+from partial_fetch import STRUCTURE_FIELDS, choose_parts, data_fields, fetch_partial_messages
+
+
+def parse_fields(spec):
+    # Google partial response syntax: a,b/c,d(e,f)
+    pos = 0
+
+    def parse_list():
+        nonlocal pos
+        tree = {}
+        while pos < len(spec) and spec[pos] != ')':
+            start = pos
+            while pos < len(spec) and spec[pos] not in ',()':
+                pos += 1
+            path = spec[start:pos].split('/')
+            sub = None
+            if pos < len(spec) and spec[pos] == '(':
+                pos += 1
+                sub = parse_list()
+                pos += 1
+            node = tree
+            for name in path[:-1]:
+                node = node.setdefault(name, {})
+            node[path[-1]] = sub
+            if pos < len(spec) and spec[pos] == ',':
+                pos += 1
+        return tree
+
+    return parse_list()
+
+def apply_fields(value, tree):
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(item, tree) for item in value]
+    return {key: apply_fields(value[key], sub) for key, sub in tree.items() if key in value}
+
+
+class FakeRequest:
+    def __init__(self, service, response):
+        self.service = service
+        self.response = response
+
+
+class FakeBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            request.service.bytes_sent += len(json.dumps(request.response))
+            self.callback(request_id, request.response, None)
+
+
+class FakeGmail:
+    # users().messages().get() and attachments().get() over a dict of full messages,
+    # honouring field masks and counting the response bytes
+    def __init__(self, messages, attachments=None):
+        self.stored = messages
+        self.attachments_by_id = attachments or {}
+        self.bytes_sent = 0
+        self.gets = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def attachments(self):
+        return FakeAttachments(self)
+
+    def get(self, userId, id, format='full', fields=None):
+        self.gets.append(fields)
+        message = copy.deepcopy(self.stored[id])
+        return FakeRequest(self, apply_fields(message, parse_fields(fields)) if fields else message)
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(callback)
+
+
+class FakeAttachments:
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, userId, messageId, id, fields=None):
+        return FakeRequest(self.service, apply_fields(self.service.attachments_by_id[id], parse_fields(fields)))
+
+
+def encode(text):
+    return base64.urlsafe_b64encode(text.encode()).decode().rstrip('=')
+
+def text_part(part_id, mime_type, text, attachment_id=None):
+    body = {'size': len(text.encode())}
+    if attachment_id:
+        body['attachmentId'] = attachment_id
+    else:
+        body['data'] = encode(text)
+    return {'partId': part_id, 'mimeType': mime_type, 'filename': '', 'headers': [], 'body': body}
+
+def message(message_id, payload, size_estimate):
+    return {'id': message_id, 'threadId': 't', 'labelIds': ['INBOX'], 'sizeEstimate': size_estimate,
+            'payload': payload}
+
+
+PLAIN = 'Please research retrieval augmented generation.'
+HTML = '<p>' + 'Please research retrieval augmented generation. ' * 200 + '</p>'
+
+
+def alternative(part_id='', plain=PLAIN, html=HTML):
+    prefix = f'{part_id}.' if part_id else ''
+    return {'partId': part_id, 'mimeType': 'multipart/alternative', 'filename': '',
+            'headers': [{'name': 'Subject', 'value': 'Research'}], 'body': {'size': 0},
+            'parts': [text_part(f'{prefix}0', 'text/plain', plain), text_part(f'{prefix}1', 'text/html', html)]}
+
+
+def test_structure_pass_carries_no_body_data():
+    assert 'data' not in STRUCTURE_FIELDS
+    service = FakeGmail({'m1': message('m1', alternative(), 20000)})
+    structure = apply_fields(copy.deepcopy(service.stored['m1']), parse_fields(STRUCTURE_FIELDS))
+    assert structure['payload']['parts'][1]['body'] == {'size': len(HTML)}
+
+def test_choose_parts_prefers_plain_and_skips_oversize_html():
+    payload = alternative()
+    assert [part['partId'] for part in choose_parts(payload, 1024)] == ['0']
+    # Without a plain alternative the html one goes over the budget and is skipped
+    payload['parts'] = payload['parts'][1:]
+    assert choose_parts(payload, 1024) == []
+    assert [part['partId'] for part in choose_parts(payload, len(HTML))] == ['1']
+
+def test_choose_parts_takes_the_smallest_alternative_that_fits():
+    payload = alternative(plain='x' * 5000, html='<p>short</p>')
+    assert [part['partId'] for part in choose_parts(payload, 1024)] == ['1']
+
+def test_choose_parts_skips_attachments():
+    payload = {'partId': '', 'mimeType': 'multipart/mixed', 'filename': '', 'headers': [], 'body': {'size': 0},
+               'parts': [alternative('0'),
+                         {'partId': '1', 'mimeType': 'text/plain', 'filename': 'notes.txt', 'headers': [],
+                          'body': {'size': 10, 'attachmentId': 'att'}}]}
+    assert [part['partId'] for part in choose_parts(payload, 1024)] == ['0.0']
+
+def test_data_fields_only_reach_the_needed_depths():
+    assert data_fields({0}) == 'partId,body/data'
+    assert data_fields({2}) == 'partId,parts(partId,parts(partId,body/data))'
+
+def test_partial_fetch_downloads_only_the_chosen_depth():
+    mixed = {'partId': '', 'mimeType': 'multipart/mixed', 'filename': '', 'headers': [], 'body': {'size': 0},
+             'parts': [alternative('0', html='<p>short</p>'), text_part('1', 'text/html', HTML)]}
+    service = FakeGmail({'m1': message('m1', mixed, 40000)})
+    result = fetch_partial_messages(service, ['m1'], 1024, max_attempts=1)
+
+    assert result.failures == {}
+    assert result.round_trips == 2
+    assert extract_text(result.results['m1']['payload']) == PLAIN
+    # Only data at depth 2 is requested, which brings the short html sibling along but
+    # never the large html part at depth 1
+    assert service.gets[1] == 'payload(partId,parts(partId,parts(partId,body/data)))'
+    assert service.bytes_sent < len(HTML)
+
+def test_partial_fetch_downloads_attachment_served_parts_individually():
+    payload = {'partId': '', 'mimeType': 'text/plain', 'filename': '', 'headers': [],
+               'body': {'size': len(PLAIN), 'attachmentId': 'big'}}
+    service = FakeGmail({'m1': message('m1', payload, 5000)},
+                        {'big': {'size': len(PLAIN), 'data': encode(PLAIN)}})
+    result = fetch_partial_messages(service, ['m1'], 1024, max_attempts=1)
+
+    assert extract_text(result.results['m1']['payload']) == PLAIN
+    assert len(service.gets) == 1
+
+def test_partial_fetch_skips_the_body_when_nothing_fits():
+    payload = text_part('', 'text/html', HTML)
+    service = FakeGmail({'m1': message('m1', payload, 20000)})
+    result = fetch_partial_messages(service, ['m1'], 1024, max_attempts=1)
+
+    assert result.round_trips == 1
+    assert extract_text(result.results['m1']['payload']) == ''
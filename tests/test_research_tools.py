@@ -0,0 +1,85 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('langchain.agents')
+
+from crews.ai_research_crew import research_tools
+from crews.ai_research_crew.research_tools import BUDGET_EXHAUSTED, MAX_QUERIES_PER_CALL, CachedSearch, budgeted_tools
+
+
+class FakeSerper:
+    # Blocks every call until released, queries starting with 'fail' raise
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, query):
+        with self._lock:
+            self.calls.append(query)
+        self.release.wait()
+        if query.startswith('fail'):
+            raise RuntimeError(f'upstream error for {query}')
+        return f'results for {query}'
+
+
+@pytest.fixture
+def serper():
+    return FakeSerper()
+
+
+@pytest.fixture
+def search(serper):
+    search = CachedSearch(serper, rate_per_second=1000, max_concurrency=4)
+    yield search
+    serper.release.set()
+    search._executor.shutdown(wait=True)
+
+
+def test_concurrent_equivalent_queries_share_one_upstream_call(search, serper):
+    queries = ['Mixture of experts'] * 4 + ['  mixture OF experts? '] * 4
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(search.run, query) for query in queries]
+        deadline = time.monotonic() + 5
+        while search.stats()['coalesced'] < 7 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        serper.release.set()
+        assert {future.result() for future in futures} == {'results for mixture of experts'}
+    assert serper.calls == ['mixture of experts']
+    assert search.stats()['coalesced'] == 7
+
+
+def test_cache_hits_and_uncached_failures(search, serper):
+    serper.release.set()
+    search.run('Mixture of experts')
+    assert search.run('"Mixture of Experts."') == 'results for mixture of experts'
+    assert serper.calls == ['mixture of experts']
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            search.run('fail once')
+    assert serper.calls.count('fail once') == 2
+    assert search.run('   ') == 'Empty search query'
+
+
+def test_run_many_deduplicates_caps_and_reports_failures_in_place(search, serper):
+    serper.release.set()
+    queries = 'RAG evaluation\nrag evaluation;fail twice|' + '\n'.join(f'query {i}' for i in range(10))
+    report = search.run_many(queries)
+    assert serper.calls.count('rag evaluation') == 1
+    assert len(serper.calls) == MAX_QUERIES_PER_CALL
+    assert '## fail twice\nSearch failed: upstream error for fail twice' in report
+
+
+def test_budgeted_tools_stop_at_the_budget(search, serper, monkeypatch):
+    serper.release.set()
+    monkeypatch.setattr(research_tools, 'cached_search', search)
+    search_tool, multi_tool = budgeted_tools(3)
+    assert search_tool.func('budget one') == 'results for budget one'
+    report = multi_tool.func('budget two\nbudget three\nbudget four')
+    assert '## budget three' in report and '## budget four' not in report
+    assert sorted(serper.calls) == ['budget one', 'budget three', 'budget two']
+    assert search_tool.func('budget five') == BUDGET_EXHAUSTED
+    assert multi_tool.func('budget six') == BUDGET_EXHAUSTED
@@ -0,0 +1,55 @@
+import threading
+import time
+
+from single_flight import run_single_flight
+from state_store import SYNC_ACQUIRED, SYNC_BUSY, SYNC_COVERED, SQLiteStateStore
+
+USER = 'user@example.com'
+
+
+def make_store(history_id=100):
+    store = SQLiteStateStore()
+    store.advance(USER, history_id)
+    return store
+
+
+def test_lone_notification_syncs_without_waiting_out_the_debounce():
+    store, synced = make_store(), []
+
+    def sync(history_id):
+        synced.append(history_id)
+        store.advance(USER, history_id)
+
+    started = time.monotonic()
+    assert run_single_flight(store, USER, '101', sync, debounce_seconds=1) == SYNC_ACQUIRED
+    assert time.monotonic() - started < 1
+    assert synced == ['101']
+
+
+def test_covered_notification_is_dropped():
+    store = make_store()
+    assert run_single_flight(store, USER, '100', lambda history_id: None) == SYNC_COVERED
+
+
+def test_notifications_during_a_sync_fold_into_one_follow_up_round():
+    store, synced = make_store(), []
+    in_sync = threading.Event()
+    release = threading.Event()
+
+    def sync(history_id):
+        synced.append(history_id)
+        if len(synced) == 1:
+            in_sync.set()
+            release.wait(5)
+            store.advance(USER, history_id)
+        else:
+            store.advance(USER, '103')
+
+    holder = threading.Thread(target=run_single_flight, args=(store, USER, '101', sync), kwargs={'debounce_seconds': 0})
+    holder.start()
+    assert in_sync.wait(5)
+    assert run_single_flight(store, USER, '102', sync) == SYNC_BUSY
+    assert run_single_flight(store, USER, '103', sync) == SYNC_BUSY
+    release.set()
+    holder.join(5)
+    assert synced == ['101', '103']
@@ -0,0 +1,61 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from state_store import SYNC_ACQUIRED, SYNC_BUSY, SYNC_COVERED, DatastoreStateStore, SQLiteStateStore
+from tests.fakes import FakeDatastoreClient
+
+
+@pytest.fixture(params=['sqlite', 'datastore'])
+def store(request):
+    if request.param == 'sqlite':
+        return SQLiteStateStore()
+    return DatastoreStateStore(client=FakeDatastoreClient())
+
+
+def history_ids(store, *user_emails):
+    return {email: state['history_id'] for email, state in store.get_many(user_emails).items()}
+
+
+def test_advance_only_moves_forward(store):
+    assert store.advance('a@example.com', '100', seen_message_ids=['m1'])
+    assert not store.advance('a@example.com', '99')
+    assert store.get('a@example.com')['history_id'] == '100'
+    # A cursor update without seen IDs keeps the stored ones
+    assert store.advance('a@example.com', '120')
+    state = store.get('a@example.com')
+    assert state['history_id'] == '120' and state['seen_message_ids'] == ['m1']
+
+
+def test_put_many_skips_backward_moves(store):
+    store.advance('a@example.com', '120')
+    assert store.put_many({'a@example.com': '110', 'b@example.com': '5'}) == ['b@example.com']
+    assert history_ids(store, 'a@example.com', 'b@example.com') == {'a@example.com': '120', 'b@example.com': '5'}
+
+
+def test_seed_many_never_touches_an_existing_cursor(store):
+    store.advance('a@example.com', '120')
+    assert store.seed_many({'a@example.com': '1', 'c@example.com': '7'}) == ['c@example.com']
+    assert store.seed_many({'c@example.com': '9'}) == []
+    assert history_ids(store, 'a@example.com', 'c@example.com') == {'a@example.com': '120', 'c@example.com': '7'}
+
+
+def test_racing_writers_leave_the_highest_history_id(store):
+    updates = [str(history_id) for history_id in range(1000, 1200)]
+    random.shuffle(updates)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda history_id: store.advance('race@example.com', history_id), updates))
+    assert store.get('race@example.com')['history_id'] == '1199'
+
+
+def test_sync_lease_hands_pending_notifications_to_the_holder(store):
+    store.advance('a@example.com', '120')
+    assert store.begin_sync('a@example.com', '120', 'one', 60) == SYNC_COVERED
+    assert store.begin_sync('a@example.com', '130', 'one', 60) == SYNC_ACQUIRED
+    assert store.begin_sync('a@example.com', '140', 'two', 60) == SYNC_BUSY
+    store.advance('a@example.com', '130')
+    assert store.end_sync('a@example.com', 'one', 60) == '140'
+    store.advance('a@example.com', '140')
+    assert store.end_sync('a@example.com', 'one', 60) is None
+    assert store.begin_sync('a@example.com', '150', 'two', 60) == SYNC_ACQUIRED
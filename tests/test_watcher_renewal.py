@@ -0,0 +1,29 @@
+import logging
+import time
+
+import pytest
+
+import cloud_logging_helper
+from watcher import DomainRateLimiter
+
+# Importing the job routes the root logger through Cloud Logging, hand it back to pytest
+logging.getLogger().removeHandler(cloud_logging_helper._queue_handler)
+cloud_logging_helper.stop_logging()
+
+
+@pytest.mark.parametrize('rate', [0, -1])
+def test_rate_limiter_treats_non_positive_rates_as_unlimited(rate):
+    limiter = DomainRateLimiter(rate)
+    started = time.monotonic()
+    for _ in range(100):
+        limiter.acquire('user@example.com')
+    assert time.monotonic() - started < 0.5
+
+
+def test_rate_limiter_throttles_per_domain():
+    limiter = DomainRateLimiter(20, burst=1)
+    started = time.monotonic()
+    for _ in range(3):
+        limiter.acquire('user@example.com')
+    limiter.acquire('user@other.example')
+    assert 0.08 <= time.monotonic() - started < 0.5